@@ -0,0 +1,65 @@
+"""Compare requests/sec of the bucket endpoints with and without module caching.
+
+Run with ``python benchmarks/connection.py [rounds]`` against a migrated
+database, configured the same way as the server. Requests go through the app
+in-process, so the numbers are dominated by database round trips:
+
+* ``SET/RESET MODULE per request`` - what ``connection()`` used to do, setting
+  the module on every acquire and resetting it on every release
+* ``module kept on connections`` - the module is only set when the connection
+  last had a different one
+"""
+
+import sys
+import tempfile
+import time
+
+from starlette.testclient import TestClient
+
+from gen3.server.app import Connection, app
+
+BUCKET = "benchConnection"
+
+
+async def set_module_every_time(self, module=None):
+    await self.execute("RESET MODULE")
+    if module is not None:
+        await self.execute(f"SET MODULE {module}")
+
+
+def run(client, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        assert client.get("/objects/buckets").status_code == 200
+        assert client.get(f"/objects/buckets/{BUCKET}").status_code == 200
+    return rounds * 2 / (time.perf_counter() - start)
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    set_module = Connection.set_module
+    with tempfile.TemporaryDirectory() as root, TestClient(app) as client:
+        resp = client.post(
+            "/objects/buckets",
+            json=dict(name=BUCKET, driver="fs", settings=dict(root_dir=root)),
+        )
+        assert resp.status_code == 201, resp.json()
+        try:
+            cases = [
+                ("SET/RESET MODULE per request", set_module_every_time),
+                ("module kept on connections", set_module),
+            ]
+            print(f"{rounds} x 2 requests")
+            for name, func in cases:
+                Connection.set_module = func
+                try:
+                    run(client, rounds // 10 or 1)  # warm up the pool
+                    print(f"{name:30} {run(client, rounds):9.1f} req/s")
+                finally:
+                    Connection.set_module = set_module
+        finally:
+            client.delete(resp.json()["href"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Compare the download response paths used by the ``fs`` bucket driver.
+
+Run with ``python benchmarks/download.py [size_mb]``. Each response is driven
+through an in-process ASGI ``send`` that writes the body to a local socket,
+drained by a reader thread, the way a server would write to its client:
+
+* ``FileResponse`` - Starlette's default chunked path, 4 KiB reads
+* ``SendfileResponse (fallback)`` - same path with 256 KiB reads, used when
+  the server offers no zero-copy extension
+* ``SendfileResponse (zerocopysend)`` - the server advertises
+  ``http.response.zerocopysend`` and calls ``os.sendfile()`` itself
+"""
+
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from starlette.responses import FileResponse
+
+from gen3.objects.responses import SendfileResponse, ZEROCOPYSEND
+
+
+def make_send(out_fd):
+    async def send(message):
+        if message["type"] == "http.response.body":
+            body = memoryview(message.get("body", b""))
+            while body:
+                body = body[os.write(out_fd, body) :]
+        elif message["type"] == ZEROCOPYSEND:
+            in_fd = message["file"].fileno()
+            offset, count = message.get("offset", 0), message["count"]
+            while count > 0:
+                sent = os.sendfile(out_fd, in_fd, offset, count)
+                if not sent:
+                    break
+                offset += sent
+                count -= sent
+
+    return send
+
+
+def _drain(sock):
+    buf = bytearray(1024 * 1024)
+    while sock.recv_into(buf):
+        pass
+
+
+async def receive():  # pragma: no cover
+    return {"type": "http.disconnect"}
+
+
+async def run(response_cls, path, extensions, out_fd, rounds):
+    scope = {"type": "http", "method": "GET", "extensions": extensions}
+    send = make_send(out_fd)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for _ in range(rounds):
+        await response_cls(path, stat_result=os.stat(path))(scope, receive, send)
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    rounds = 5
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(os.urandom(1024 * 1024) * size_mb)
+        f.flush()
+        out_sock, in_sock = socket.socketpair()
+        out_fd = out_sock.fileno()
+        drain = threading.Thread(target=_drain, args=(in_sock,), daemon=True)
+        drain.start()
+        try:
+            cases = [
+                ("FileResponse", FileResponse, {}),
+                ("SendfileResponse (fallback)", SendfileResponse, {}),
+                (
+                    "SendfileResponse (zerocopysend)",
+                    SendfileResponse,
+                    {ZEROCOPYSEND: {}},
+                ),
+            ]
+            loop = asyncio.get_event_loop()
+            total_mb = size_mb * rounds
+            print(f"{rounds} x {size_mb} MiB")
+            for name, cls, extensions in cases:
+                wall, cpu = loop.run_until_complete(
+                    run(cls, f.name, extensions, out_fd, rounds)
+                )
+                print(
+                    f"{name:34} {total_mb / wall:9.1f} MiB/s  "
+                    f"cpu {cpu:6.2f}s  wall {wall:6.2f}s"
+                )
+        finally:
+            out_sock.close()
+            drain.join()
+            in_sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+import asyncio
+import posixpath
+import shutil
+import struct
+import tarfile
+import zipfile
+import zlib
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.status import HTTP_400_BAD_REQUEST
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BUFFER_SIZE = 65536
+CHUNK_SIZE = 262144
+QUEUE_SIZE = 8
+FORMATS = {
+    "tar": ("application/x-tar", ".tar"),
+    "tar.gz": ("application/gzip", ".tar.gz"),
+    "tar.zst": ("application/zstd", ".tar.zst"),
+    "zip": ("application/zip", ".zip"),
+}
+_ZIP_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+_ZIP_LOCAL_SIG = b"PK\x03\x04"
+_ZIP_DESCRIPTOR_SIG = b"PK\x07\x08"
+_ZIP_END_SIG = b"PK\x05\x06"
+# what may follow the entries: central directory, zip64 end records, the end
+_ZIP_TRAILER_SIGS = (b"PK\x01\x02", b"PK\x06\x06", b"PK\x06\x07", _ZIP_END_SIG)
+_ARCHIVE_ERRORS = (tarfile.TarError, zlib.error) + (
+    (zstandard.ZstdError,) if zstandard is not None else ()
+)
+_EOF = object()
+
+
+class Cancelled(Exception):
+    pass
+
+
+class _QueueWriter:
+    """Write-only file object passing its data to the event loop in chunks.
+
+    Writes block while the queue is full, so a slow client slows the producer
+    down instead of growing memory.
+    """
+
+    def __init__(self, loop, queue):
+        self._loop = loop
+        self._queue = queue
+        self._buf = bytearray()
+        self.cancelled = False
+
+    def write(self, data):
+        if self.cancelled:
+            raise Cancelled()
+        self._buf += data
+        if len(self._buf) >= CHUNK_SIZE:
+            self._flush()
+        return len(data)
+
+    def _flush(self):
+        if self._buf:
+            chunk, self._buf = bytes(self._buf), bytearray()
+            asyncio.run_coroutine_threadsafe(
+                self._queue.put(chunk), self._loop
+            ).result()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.cancelled:
+            self._flush()
+
+
+async def iterate_writer(func, *args):
+    """Run ``func(fileobj, *args)`` in the threadpool and yield what it writes.
+
+    Closing the iterator early, e.g. when the client disconnects, makes the
+    next write in ``func`` raise :class:`Cancelled`.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    writer = _QueueWriter(loop, queue)
+
+    def _produce():
+        func(writer, *args)
+        writer.close()
+
+    async def _run():
+        try:
+            await run_in_threadpool(_produce)
+        except Exception as e:
+            rv = e
+        else:
+            rv = _EOF
+        if not writer.cancelled:
+            await queue.put(rv)
+
+    loop.create_task(_run())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _EOF:
+                break
+            elif isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        writer.cancelled = True
+        # unblock a pending write so the producer can see the cancellation
+        while not queue.empty():
+            queue.get_nowait()
+
+
+def check_format(fmt):
+    if fmt not in FORMATS:
+        raise HTTPException(
+            HTTP_400_BAD_REQUEST,
+            f"unknown archive format {fmt}, choose from: {', '.join(FORMATS)}",
+        )
+    if fmt == "tar.zst" and zstandard is None:
+        raise HTTPException(HTTP_400_BAD_REQUEST, "zstd is not available")
+
+
+def write_archive(fileobj, fmt, entries):
+    """Write ``entries`` of ``(arcname, path)`` into ``fileobj`` as ``fmt``.
+
+    An entry may have a third item ``open_content()``, returning a file object
+    with a ``size`` to read the file's content from instead of its bytes.
+    """
+    if fmt == "zip":
+        with zipfile.ZipFile(fileobj, "w", allowZip64=True) as zf:
+            for arcname, path, *content in entries:
+                if not content:
+                    zf.write(path, arcname)
+                    continue
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                with content[0]() as src:
+                    info.file_size = src.size
+                    with zf.open(info, "w") as dst:
+                        shutil.copyfileobj(src, dst)
+    elif fmt == "tar.zst":
+        cctx = zstandard.ZstdCompressor()
+        with cctx.stream_writer(fileobj) as zw:
+            write_archive(zw, "tar", entries)
+    else:
+        mode = "w|gz" if fmt == "tar.gz" else "w|"
+        with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+            for arcname, path, *content in entries:
+                if not content:
+                    tar.add(path, arcname, recursive=False)
+                    continue
+                info = tar.gettarinfo(path, arcname)
+                with content[0]() as src:
+                    info.size = src.size
+                    tar.addfile(info, src)
+
+
+class _StreamReader:
+    """Blocking file object over an async iterator of bytes, for use in threads."""
+
+    def __init__(self, loop, chunks):
+        self._loop = loop
+        self._it = chunks.__aiter__()
+        self._buf = bytearray()
+        self._eof = False
+
+    async def _next(self):
+        return await self._it.__anext__()
+
+    def _fill(self):
+        fut = asyncio.run_coroutine_threadsafe(self._next(), self._loop)
+        try:
+            self._buf += fut.result()
+        except StopAsyncIteration:
+            self._eof = True
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buf) < size):
+            self._fill()
+        if size is None or size < 0:
+            size = len(self._buf)
+        rv = bytes(self._buf[:size])
+        del self._buf[:size]
+        return rv
+
+    def read_exactly(self, size):
+        rv = self.read(size)
+        if len(rv) < size:
+            raise HTTPException(HTTP_400_BAD_REQUEST, "truncated archive")
+        return rv
+
+    def unread(self, data):
+        self._buf[:0] = data
+
+
+class _ZipMember:
+    """Reads one entry of a zip archive, right after its local header."""
+
+    def __init__(self, reader, flags, method, crc, csize, zip64):
+        self._reader = reader
+        self._descriptor = bool(flags & 0x08)
+        self._descriptor_struct = struct.Struct("<IQQ" if zip64 else "<III")
+        self._crc = crc
+        self._remaining = None if self._descriptor else csize
+        self._decomp = zlib.decompressobj(-15) if method == 8 else None
+        self._pending = bytearray()
+        self._offset = 0
+        self._actual_crc = 0
+        self._done = False
+
+    def _read_raw(self, size):
+        if self._remaining is None:
+            return self._reader.read(size)
+        data = self._reader.read(min(size, self._remaining))
+        self._remaining -= len(data)
+        return data
+
+    def _read_until_descriptor(self, size):
+        # Stored entries written by a streaming zip writer carry their size only
+        # in the data descriptor after the data, so look for a descriptor
+        # whose size and CRC-32 match the bytes before it.
+        desc_len = len(_ZIP_DESCRIPTOR_SIG) + self._descriptor_struct.size
+        while len(self._pending) < size + desc_len:
+            more = self._reader.read(BUFFER_SIZE)
+            if not more:
+                break
+            self._pending += more
+        limit = len(self._pending) - desc_len
+        if limit < 0:
+            raise HTTPException(HTTP_400_BAD_REQUEST, "truncated archive")
+        pos = self._pending.find(_ZIP_DESCRIPTOR_SIG, 0, limit + 4)
+        while pos >= 0:
+            crc, csize, _ = self._descriptor_struct.unpack_from(self._pending, pos + 4)
+            if csize == self._offset + pos and crc == zlib.crc32(
+                self._pending[:pos], self._actual_crc
+            ):
+                data = bytes(self._pending[:pos])
+                self._reader.unread(self._pending[pos + desc_len :])
+                self._crc = crc
+                self._done = True
+                return data
+            pos = self._pending.find(_ZIP_DESCRIPTOR_SIG, pos + 1, limit + 4)
+        size = min(size, limit + 1)
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+        return data
+
+    def read(self, size=BUFFER_SIZE):
+        if self._done:
+            return b""
+        if self._decomp is not None:
+            data = b""
+            while not data and not self._decomp.eof:
+                raw = self._read_raw(size)
+                if not raw:
+                    raise HTTPException(HTTP_400_BAD_REQUEST, "truncated archive")
+                data = self._decomp.decompress(raw)
+            if self._decomp.eof:
+                data += self._decomp.flush()
+                self._reader.unread(self._decomp.unused_data)
+                self._finish()
+        elif self._descriptor:
+            data = self._read_until_descriptor(size)
+        else:
+            data = self._read_raw(size)
+            if not data and size > 0 and self._remaining:
+                raise HTTPException(HTTP_400_BAD_REQUEST, "truncated archive")
+            if self._remaining == 0:
+                self._finish()
+        self._offset += len(data)
+        self._actual_crc = zlib.crc32(data, self._actual_crc)
+        return data
+
+    def _finish(self):
+        self._done = True
+        if self._descriptor:
+            sig = self._reader.read_exactly(len(_ZIP_DESCRIPTOR_SIG))
+            if sig != _ZIP_DESCRIPTOR_SIG:
+                self._reader.unread(sig)
+            self._crc = self._descriptor_struct.unpack(
+                self._reader.read_exactly(self._descriptor_struct.size)
+            )[0]
+
+    def skip(self):
+        while not self._done:
+            self.read()
+
+    def check(self):
+        if self._actual_crc != self._crc:
+            raise HTTPException(HTTP_400_BAD_REQUEST, "bad CRC-32 in zip archive")
+
+
+def _parse_zip64_extra(data, usize, csize):
+    """Return the sizes from a zip64 extra field, for those marked as such."""
+    count = (usize == 0xFFFFFFFF) + (csize == 0xFFFFFFFF)
+    if len(data) < 8 * count:
+        raise HTTPException(HTTP_400_BAD_REQUEST, "bad zip64 extra field")
+    values = iter(struct.unpack_from(f"<{count}Q", data))
+    if usize == 0xFFFFFFFF:
+        usize = next(values)
+    if csize == 0xFFFFFFFF:
+        csize = next(values)
+    return usize, csize
+
+
+def _iter_zip(reader):
+    trailer_sigs = (_ZIP_END_SIG,)
+    while True:
+        header = reader.read(_ZIP_LOCAL_HEADER.size)
+        if not header.startswith(_ZIP_LOCAL_SIG):
+            if header[:4] not in trailer_sigs:
+                raise HTTPException(HTTP_400_BAD_REQUEST, "not a zip archive")
+            # central directory or end of archive, everything has been seen
+            return
+        trailer_sigs = _ZIP_TRAILER_SIGS
+        if len(header) < _ZIP_LOCAL_HEADER.size:
+            raise HTTPException(HTTP_400_BAD_REQUEST, "truncated archive")
+        _, _, flags, method, _, _, crc, csize, usize, name_len, extra_len = (
+            _ZIP_LOCAL_HEADER.unpack(header)
+        )
+        name = reader.read_exactly(name_len)
+        name = name.decode("utf-8" if flags & 0x800 else "cp437")
+        extra = reader.read_exactly(extra_len)
+        zip64 = False
+        while len(extra) >= 4:
+            tag, size = struct.unpack("<HH", extra[:4])
+            if tag == 0x0001:
+                zip64 = True
+                usize, csize = _parse_zip64_extra(extra[4 : 4 + size], usize, csize)
+            extra = extra[4 + size :]
+        if flags & 0x01:
+            raise HTTPException(HTTP_400_BAD_REQUEST, "encrypted zip is not supported")
+        if method not in (0, 8):
+            raise HTTPException(
+                HTTP_400_BAD_REQUEST, f"zip entry {name} cannot be streamed"
+            )
+        member = _ZipMember(reader, flags, method, crc, csize, zip64)
+        if name.endswith("/"):
+            member.skip()
+            continue
+        yield name, member
+        member.skip()
+        member.check()
+
+
+def _iter_tar(fileobj):
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        for member in tar:
+            if member.isfile():
+                yield member.name, tar.extractfile(member)
+
+
+def _iter_members(reader, fmt):
+    if fmt == "zip":
+        return _iter_zip(reader)
+    elif fmt == "tar.zst":
+        return _iter_tar(zstandard.ZstdDecompressor().stream_reader(reader))
+    else:
+        return _iter_tar(reader)
+
+
+def _member_path(base, name):
+    norm = posixpath.normpath(name)
+    if norm.startswith("/") or norm == ".." or norm.startswith("../"):
+        raise HTTPException(HTTP_400_BAD_REQUEST, "escaping target folder")
+    return posixpath.join(base, norm) if base else norm
+
+
+async def _read_member(fileobj):
+    while True:
+        try:
+            chunk = await run_in_threadpool(fileobj.read, BUFFER_SIZE)
+        except _ARCHIVE_ERRORS as e:
+            raise HTTPException(HTTP_400_BAD_REQUEST, f"bad archive: {e}")
+        if not chunk:
+            break
+        yield chunk
+
+
+async def extract_archive(fmt, chunks, base, put):
+    """Extract the archive streamed in ``chunks`` under the ``base`` path.
+
+    Each regular file is stored with ``put(path, chunks)`` as soon as its bytes
+    arrive. Returns a result for each entry; entries that fail on their own,
+    like ones escaping ``base``, are reported without aborting the rest.
+    """
+    loop = asyncio.get_running_loop()
+    members = _iter_members(_StreamReader(loop, chunks), fmt)
+    results = []
+    try:
+        while True:
+            try:
+                member = await run_in_threadpool(next, members, None)
+            except _ARCHIVE_ERRORS as e:
+                raise HTTPException(HTTP_400_BAD_REQUEST, f"bad archive: {e}")
+            if member is None:
+                break
+            name, fileobj = member
+            try:
+                rv = await put(_member_path(base, name), _read_member(fileobj))
+            except HTTPException as e:
+                results.append(dict(name=name, error=e.detail))
+            else:
+                results.append(dict(rv, name=name))
+    finally:
+        await run_in_threadpool(members.close)
+    return results
@@ -1,20 +1,19 @@
+import asyncio
 import json
 import mimetypes
+import time
 import typing
+from functools import partial
 
 import edgedb
-
-try:
-    import magic
-except ImportError:
-    magic = None
 import pkg_resources
-from fastapi import Depends, HTTPException, UploadFile, File
+from fastapi import Depends, HTTPException, Query
 from pydantic import BaseModel, Schema, ValidationError
 from starlette.requests import Request
-from starlette.responses import Response
+from starlette.responses import JSONResponse, Response, StreamingResponse
 from starlette.status import (
     HTTP_201_CREATED,
+    HTTP_202_ACCEPTED,
     HTTP_204_NO_CONTENT,
     HTTP_400_BAD_REQUEST,
     HTTP_404_NOT_FOUND,
@@ -22,8 +21,14 @@ from starlette.status import (
     HTTP_422_UNPROCESSABLE_ENTITY,
 )
 
+from . import index, mime, usage
+from .archive import check_format, extract_archive
+from .cache import TTLCache
+from .cancel import CancelToken
+from .jobs import start_job
 from .server import mod
-from ..server.app import connection
+from ..server import config, logger, metrics
+from ..server.app import app, connection, db_pool
 from ..server.utils import ID_REGEX
 
 SCHEMA = """\
@@ -36,9 +41,26 @@ SCHEMA = """\
         required property enabled -> bool {
             default := true;
         }
+        property quota -> int64;
+    }
+
+    type BucketVersion {
+        required property version -> int64;
     }
 """
 installed_drivers = {}
+_driver_seconds = metrics.Histogram(
+    "gen3_objects_driver_seconds",
+    "Time spent in bucket drivers, by operation. Downloads are timed until "
+    "the response starts.",
+    labels=("driver", "operation"),
+)
+_driver_bytes = metrics.Counter(
+    "gen3_objects_driver_bytes_total",
+    "Bytes downloaded from and put to bucket drivers.",
+    labels=("driver", "operation"),
+)
+BUFFER_SIZE = 65536
 
 
 @mod.get("/drivers")
@@ -57,6 +79,7 @@ class Bucket(BaseModel):
     driver: str
     settings: dict = {}
     enabled: bool = True
+    quota: int = Schema(None, gt=0, description="Bytes the bucket may hold")
 
     @classmethod
     def parse_obj(cls, obj):
@@ -82,42 +105,125 @@ class Bucket(BaseModel):
 
     @staticmethod
     def guess_type(path=None, data=None):
-        ext_mime = mimetypes.guess_type(path, False)[0]
-        mime = type_ = None
-        if magic:
-            if data:
-                type_ = magic.from_buffer(data)
-                mime = magic.from_buffer(data, mime=True)
-            else:
-                try:
-                    type_ = magic.from_file(path)
-                    mime = magic.from_file(path, mime=True)
-                except OSError:
-                    pass
-        if (
-            mime
-            in [None, "text/plain", "application/x-empty", "application/octet-stream"]
-            and ext_mime
-        ):
-            mime = ext_mime
-        if not mime:
-            mime = "unknown"
-        if not type_:
-            type_ = mime
-        return mime, type_
-
-    async def get(self, path, recursive=True):  # pragma: no cover
+        return mime.guess_type(path, data)
+
+    async def detect_type(self, path, data=None, version=None):
+        """Guess ``(mime, type)`` of ``path`` from its leading bytes ``data``.
+
+        ``version`` identifies the object content, like ``(inode, size, mtime)``;
+        with it, results are cached so later calls skip libmagic.
+        """
+        key = None if version is None else (self.name, path, *version)
+        return await mime.detect_type(path, data, key)
+
+    async def stat(self, path):  # pragma: no cover
+        """Return ``dict(name, dir, size, mtime)`` of ``path`` without its content."""
+        raise NotImplementedError
+
+    async def get(
+        self,
+        path,
+        recursive=True,
+        max_depth=None,
+        limit=None,
+        cursor=None,
+        stream=False,
+        token=None,
+    ):  # pragma: no cover
+        """Return the details of ``path``, with the entries under it if a folder.
+
+        Drivers walking folders call ``token.check()`` for each entry, so the
+        walk stops once the :class:`~gen3.objects.cancel.CancelToken` is
+        cancelled, also when streamed after returning.
+        """
+        raise NotImplementedError
+
+    async def download(self, path, headers=None, archive="tar"):
+        """Return a response with the content of ``path``.
+
+        Folders are sent as an archive in the ``archive`` format.
+        """
         raise NotImplementedError
 
-    async def download(self, path):
+    def read_range(self, path, offset=0, length=None):  # pragma: no cover
+        """Return an async iterator of the bytes of ``path`` starting at ``offset``.
+
+        ``length=None`` reads to the end of the object.
+        """
         raise NotImplementedError
 
-    async def put(self, path, file):  # pragma: no cover
+    async def put(self, path, chunks):  # pragma: no cover
+        """Store the bytes from the async iterable ``chunks`` at ``path``.
+
+        Drivers should consume ``chunks`` as it arrives rather than buffering
+        the whole object.
+        """
         raise NotImplementedError
 
-    async def delete(self, path):  # pragma: no cover
+    async def put_by_digest(self, path, sha256):
+        """Store existing content with the hex ``sha256`` at ``path``.
+
+        Returns like :meth:`put`, or ``None`` if the driver doesn't have such
+        content, in which case the bytes must be uploaded.
+        """
+        return None
+
+    async def transfer(self, path, target, target_path, move=False):
+        """Copy or move ``path`` to ``target_path`` of bucket ``target`` natively.
+
+        Files return like :meth:`put`, and folders - which are only moved this
+        way, never copied - return ``{}``. Returns ``None`` if the driver can't
+        do it between these buckets, in which case the bytes are streamed.
+        """
+        return None
+
+    async def delete(self, path, job=None):  # pragma: no cover
+        """Remove ``path`` recursively.
+
+        With a :class:`~gen3.objects.jobs.Job`, drivers count removed
+        ``entries`` and ``bytes`` in ``job.progress`` and stop early once
+        ``job.cancelled`` is set.
+        """
+        raise NotImplementedError
+
+    async def create_upload(self, path, size, part_size):  # pragma: no cover
+        """Prepare a resumable upload of ``size`` bytes to ``path``.
+
+        The upload arrives in parts of ``part_size`` bytes, except the last;
+        drivers with a minimum part size reject smaller ones here.
+
+        Returns JSON-serializable driver state, which is passed back to the
+        other upload methods.
+        """
         raise NotImplementedError
 
+    async def put_part(self, path, state, offset, chunks):  # pragma: no cover
+        """Write the bytes from ``chunks`` into the upload starting at ``offset``.
+
+        Parts may arrive in any order and concurrently.
+        """
+        raise NotImplementedError
+
+    async def complete_upload(self, path, state):  # pragma: no cover
+        raise NotImplementedError
+
+    async def abort_upload(self, path, state):  # pragma: no cover
+        raise NotImplementedError
+
+    async def close(self):
+        """Release what the driver holds for this bucket, like connections.
+
+        Called once the bucket is deleted or reconfigured.
+        """
+
+    async def drop(self, conn):
+        """Remove what the driver records of the deleted bucket in the database.
+
+        Called in the transaction deleting the bucket. Returns a coroutine
+        function to call once that is committed, like to free storage, or
+        ``None``.
+        """
+
 
 @mod.get("/buckets")
 async def list_buckets(request: Request, conn=Depends(connection("objects"))):
@@ -127,7 +233,9 @@ async def list_buckets(request: Request, conn=Depends(connection("objects"))):
             installed=bucket.driver in installed_drivers,
             href=request.url_for("get_bucket", bucket_name=bucket.name),
         )
-        for bucket in await conn.fetchall("SELECT Bucket {name, driver, enabled}")
+        for bucket in await conn.fetchall(
+            "SELECT Bucket {name, driver, enabled, quota}"
+        )
     ]
     return rv
 
@@ -144,17 +252,21 @@ async def create_bucket(
         raise HTTPException(
             HTTP_400_BAD_REQUEST, [dict(loc=["driver"], msg="must not be empty")]
         )
+    values = bucket.dict(dump_json=True)
+    if values["quota"] is None:
+        del values["quota"]
     try:
         rv = await conn.fetchone(
-            """
-                INSERT Bucket {
+            f"""
+                INSERT Bucket {{
                     name := <str>$name,
                     driver := <str>$driver,
                     settings := to_json(<str>$settings),
                     enabled := <bool>$enabled,
-                }
+                    {"quota := <int64>$quota," if "quota" in values else ""}
+                }}
                 """,
-            **bucket.dict(dump_json=True),
+            **values,
         )
     except edgedb.ConstraintViolationError as e:
         raise HTTPException(HTTP_409_CONFLICT, [dict(loc=["name"], msg=str(e))])
@@ -164,29 +276,154 @@ async def create_bucket(
         )
 
 
-async def _get_bucket(bucket_name: str, conn=Depends(connection("objects"))):
-    bucket = await conn.fetchall(
-        "SELECT Bucket {name, driver, enabled, settings} FILTER .name = <str>$name",
-        name=bucket_name,
-    )
-    if bucket:
-        yield Bucket.parse_obj(bucket[0])
-    else:
+class BucketRegistry:
+    """In-process cache of ready-to-use bucket driver instances by bucket name.
+
+    Entries expire after ``OBJECTS_BUCKET_CACHE_TTL`` seconds, and are dropped
+    locally by :meth:`invalidate`. Changes made by other workers are noticed by
+    polling the ``BucketVersion`` counter at most once every
+    ``OBJECTS_BUCKET_CACHE_CHECK_INTERVAL`` seconds.
+
+    The last instance handed out for each bucket is kept apart from the cache,
+    and closed once the bucket turns out deleted or reconfigured; one that
+    merely expired is reloaded as it was, sharing what the driver holds.
+    """
+
+    def __init__(self):
+        self._cache = TTLCache(ttl=config.OBJECTS_BUCKET_CACHE_TTL)
+        self._version = None
+        self._checked = None
+        self._generation = 0
+        self._open = {}
+
+    async def get(self, pool, name):
+        now = time.monotonic()
+        check = (
+            self._checked is None
+            or now - self._checked >= config.OBJECTS_BUCKET_CACHE_CHECK_INTERVAL
+        )
+        bucket = self._cache.get(name)
+        if bucket is not None and not check:
+            return bucket
+
+        generation = self._generation
+        async with pool.acquire() as conn:
+            if check:
+                version = await conn.fetchone(
+                    "SELECT sum(objects::BucketVersion.version)"
+                )
+                self._checked = now
+                if version != self._version:
+                    self.clear()
+                    self._version = version
+                    generation = self._generation
+                    bucket = None
+                    await self._reload_open(conn)
+            if bucket is None:
+                rv = await conn.fetchall(
+                    """
+                    SELECT objects::Bucket {name, driver, enabled, settings, quota}
+                    FILTER .name = <str>$name
+                    """,
+                    name=name,
+                )
+                bucket = Bucket.parse_obj(rv[0]) if rv else None
+                self._replace(name, bucket)
+                if bucket is None:
+                    return None
+        if generation == self._generation:
+            self._cache.set(name, bucket)
+        return bucket
+
+    async def _reload_open(self, conn):
+        """Close the open instances of buckets other workers changed."""
+        if not self._open:
+            return
+        rv = await conn.fetchall(
+            """
+            SELECT objects::Bucket {name, driver, enabled, settings, quota}
+            FILTER .name IN array_unpack(<array<str>>$names)
+            """,
+            names=list(self._open),
+        )
+        current = {row.name: Bucket.parse_obj(row) for row in rv}
+        for name in list(self._open):
+            self._replace(name, current.get(name))
+
+    def _replace(self, name, bucket):
+        """Make ``bucket`` the open instance of ``name``, closing the one before.
+
+        The one before is kept if nothing changed, as ``bucket`` is then the
+        same to the driver.
+        """
+        old = self._open.pop(name, None)
+        if bucket is not None:
+            self._open[name] = bucket
+        if old is None:
+            return
+        if (
+            bucket is not None
+            and old.driver == bucket.driver
+            and old.settings == bucket.settings
+        ):
+            return
+        asyncio.get_event_loop().create_task(_close_bucket(old))
+
+    def invalidate(self, name):
+        self._generation += 1
+        self._cache.pop(name)
+
+    def clear(self):
+        self._generation += 1
+        self._cache.clear()
+
+    def release(self, name):
+        """Close the open instance of the deleted bucket ``name``, if any."""
+        self.invalidate(name)
+        self._replace(name, None)
+
+
+async def _close_bucket(bucket):
+    # noinspection PyBroadException
+    try:
+        await bucket.close()
+    except Exception:
+        logger.exception("Failed to close bucket %s", bucket.name)
+
+
+registry = BucketRegistry()
+
+
+async def _bump_version(conn):
+    if not await conn.fetchall("UPDATE BucketVersion SET { version := .version + 1 }"):
+        await conn.fetchall("INSERT BucketVersion { version := 1 }")
+
+
+async def _get_bucket(bucket_name: str, pool=Depends(db_pool)):
+    bucket = await registry.get(pool, bucket_name)
+    if bucket is None:
         raise HTTPException(HTTP_404_NOT_FOUND, f"bucket {bucket_name} not found")
+    return bucket
 
 
 @mod.get("/buckets/{bucket_name}")
-async def get_bucket(request: Request, bucket=Depends(_get_bucket)):
+async def get_bucket(
+    request: Request, bucket=Depends(_get_bucket), pool=Depends(db_pool)
+):
+    async with pool.acquire() as conn:
+        rv = await usage.get_usage(conn, bucket.name)
     return dict(
         bucket.dict(),
         href=request.url_for("get_bucket", bucket_name=bucket.name),
         installed=bucket.driver in installed_drivers,
+        usage=dict(bytes=rv["bytes"], files=rv["files"]),
     )
 
 
 class UpdateBucket(BaseModel):
     settings: dict = None
     enabled: bool = None
+    quota: int = Schema(None, ge=0, description="0 removes the quota")
 
 
 @mod.put("/buckets/{bucket_name}")
@@ -204,12 +441,22 @@ async def update_bucket(
     if bucket.settings is not None:
         sets.append("settings := <json>$settings")
         values["settings"] = json.dumps(bucket.settings)
+    if bucket.quota == 0:
+        sets.append("quota := <int64>{}")
+    elif bucket.quota is not None:
+        sets.append("quota := <int64>$quota")
+        values["quota"] = bucket.quota
     if not sets:
         raise HTTPException(HTTP_422_UNPROCESSABLE_ENTITY, "no update specified")
 
-    bucket = await conn.fetchall(
-        f"UPDATE Bucket FILTER .name = <str>$name SET {{{', '.join(sets)}}}", **values
-    )
+    async with conn.transaction():
+        bucket = await conn.fetchall(
+            f"UPDATE Bucket FILTER .name = <str>$name SET {{{', '.join(sets)}}}",
+            **values,
+        )
+        if bucket:
+            await _bump_version(conn)
+    registry.invalidate(bucket_name)
     if bucket:
         return dict(
             id=str(bucket[0].id),
@@ -223,15 +470,30 @@ async def update_bucket(
 async def delete_bucket(
     bucket_name: str, request: Request, conn=Depends(connection("objects"))
 ):
-    buckets = await conn.fetchall(
-        "DELETE Bucket FILTER .name = <str>$name", name=bucket_name
-    )
+    finish = None
+    async with conn.transaction():
+        buckets = await conn.fetchall(
+            """
+            SELECT (
+                DELETE Bucket FILTER .name = <str>$name
+            ) {id, name, driver, enabled, settings, quota}
+            """,
+            name=bucket_name,
+        )
+        if buckets:
+            await _bump_version(conn)
+            await index.forget(conn, bucket_name)
+            finish = await Bucket.parse_obj(buckets[0]).drop(conn)
     if buckets:
+        registry.release(bucket_name)
+        if finish is not None:
+            await finish()
         return dict(
             id=str(buckets[0].id),
             href=request.url_for("get_bucket", bucket_name=bucket_name),
         )
     else:
+        registry.invalidate(bucket_name)
         raise HTTPException(HTTP_404_NOT_FOUND, f"bucket {bucket_name} not found")
 
 
@@ -240,27 +502,184 @@ async def get_bucket_path(
     request: Request,
     path: str = None,
     bucket=Depends(_get_bucket),
+    pool=Depends(db_pool),
     recursive: bool = True,
+    max_depth: int = Query(None, gt=0),
+    limit: int = Query(None, gt=0),
+    cursor: str = None,
+    stream: bool = False,
     download: bool = False,
+    archive: str = "tar",
 ):
     request.scope.get('add_close_watcher', lambda: None)()
     if download:
-        return await bucket.download(path)
+        with _driver_seconds.time(driver=bucket.driver, operation="download"):
+            rv = await bucket.download(path, request.headers, archive=archive)
+        _count_download(rv, bucket.driver)
+        if "want-digest" in request.headers:
+            # the index lookup and the extra stat are only paid for on demand
+            async with pool.acquire() as conn:
+                info = await index.lookup(conn, bucket.name, path)
+            if info is not None and index.matches(info, await bucket.stat(path)):
+                rv.headers["digest"] = index.digest_header(info)
+        return rv
+    else:
+        token = CancelToken("get")
+        with token, _driver_seconds.time(driver=bucket.driver, operation="get"):
+            rv = await bucket.get(
+                path,
+                recursive=recursive,
+                max_depth=max_depth,
+                limit=limit,
+                cursor=cursor,
+                stream=stream,
+                token=token,
+            )
+        if isinstance(rv, StreamingResponse):
+            rv.body_iterator = token.guard(rv.body_iterator)
+        if isinstance(rv, dict) and not rv["dir"]:
+            async with pool.acquire() as conn:
+                info = await index.lookup(conn, bucket.name, path)
+            if index.matches(info, rv):
+                rv.update((key, info[key]) for key in ("md5", "sha256", "crc32c"))
+        return rv
+
+
+async def _counted(chunks, driver, operation):
+    async for chunk in chunks:
+        _driver_bytes.inc(len(chunk), driver=driver, operation=operation)
+        yield chunk
+
+
+def _count_download(rv, driver):
+    if isinstance(rv, StreamingResponse):
+        # counted as it's sent, so abandoned downloads only count what was sent
+        rv.body_iterator = _counted(rv.body_iterator, driver, "download")
     else:
-        return await bucket.get(path, recursive=recursive)
+        _driver_bytes.inc(
+            int(rv.headers.get("content-length", 0)),
+            driver=driver,
+            operation="download",
+        )
+
+
+async def _read_upload(file):
+    while True:
+        chunk = await file.read(BUFFER_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def _put_indexed(pool, bucket, path, chunks):
+    left = await usage.check_quota(pool, bucket)
+    if left is not None:
+        # the object replaced, if any, still counts until it's replaced
+        chunks = usage.limited(chunks, left, bucket.name)
+    hasher = index.Hasher()
+    with _driver_seconds.time(driver=bucket.driver, operation="put"):
+        rv = await bucket.put(path, hasher.wrap(chunks))
+    _driver_bytes.inc(rv["size"], driver=bucket.driver, operation="put")
+    rv = dict(rv, **hasher.digests())
+    if hasher.head:
+        mime_type = (await bucket.detect_type(path, bytes(hasher.head)))[0]
+    else:
+        mime_type = mimetypes.guess_type(path, False)[0]
+    async with pool.acquire() as conn:
+        await index.record(conn, bucket.name, path, mime=mime_type, **rv)
+    return rv
 
 
 @mod.put("/buckets/{bucket_name}/{path:path}")
 async def put_bucket_path(
-    path: str = None, bucket=Depends(_get_bucket), file: UploadFile = File(...)
+    request: Request,
+    path: str = None,
+    bucket=Depends(_get_bucket),
+    pool=Depends(db_pool),
+    extract: str = None,
 ):
-    return await bucket.put(path, file)
+    # The form is parsed only for multipart bodies: any other body, including
+    # one sent as application/x-www-form-urlencoded, is the content itself.
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        file = (await request.form()).get("file")
+        if file is None or isinstance(file, str):
+            raise HTTPException(
+                HTTP_422_UNPROCESSABLE_ENTITY,
+                [dict(loc=["file"], msg="field required")],
+            )
+        chunks = _read_upload(file)
+    else:
+        sha256 = index.parse_digest(request.headers.get("digest")).get("sha256")
+        if sha256 and not extract:
+            await usage.check_quota(pool, bucket)
+            rv = await bucket.put_by_digest(path, sha256)
+            if rv is not None:
+                # the body is never read, so clients sending "Expect:
+                # 100-continue" skip the transfer entirely
+                async with pool.acquire() as conn:
+                    await index.record(
+                        conn,
+                        bucket.name,
+                        path,
+                        mime=mimetypes.guess_type(path, False)[0],
+                        **rv,
+                    )
+                return rv
+        # raw request body, streamed straight to the driver
+        chunks = request.stream()
+    if extract:
+        check_format(extract)
+        files = await extract_archive(
+            extract, chunks, path, partial(_put_indexed, pool, bucket)
+        )
+        return dict(
+            files=files,
+            size=sum(f.get("size", 0) for f in files),
+            errors=sum(1 for f in files if "error" in f),
+        )
+    return await _put_indexed(pool, bucket, path, chunks)
+
+
+async def _delete(job, pool, bucket, path):
+    try:
+        with _driver_seconds.time(driver=bucket.driver, operation="delete"):
+            await bucket.delete(path, job)
+    finally:
+        # forget what is gone, even if only partially
+        async with pool.acquire() as conn:
+            await index.forget(conn, bucket.name, path)
+    return job.progress
 
 
 @mod.delete("/buckets/{bucket_name}/{path:path}", status_code=HTTP_204_NO_CONTENT)
-async def delete_bucket_path(path: str = None, bucket=Depends(_get_bucket)):
-    await bucket.delete(path)
-    return Response(status_code=HTTP_204_NO_CONTENT)
+async def delete_bucket_path(
+    request: Request,
+    path: str = None,
+    bucket=Depends(_get_bucket),
+    pool=Depends(db_pool),
+):
+    job = start_job(
+        "delete", _delete, pool, bucket, path, bucket=bucket.name, path=path
+    )
+    if await job.wait(config.OBJECTS_DELETE_WAIT):
+        if job.exception is not None:
+            raise job.exception
+        return Response(status_code=HTTP_204_NO_CONTENT)
+    # large deletes carry on in the background
+    return JSONResponse(
+        dict(job.dict(), href=request.url_for("get_job_status", job_id=job.id)),
+        status_code=HTTP_202_ACCEPTED,
+    )
+
+
+@app.on_event("startup")
+def start_type_detection():
+    mime.start()
+
+
+@app.on_event("shutdown")
+def shutdown_type_detection():
+    mime.shutdown()
 
 
 def load_extras():
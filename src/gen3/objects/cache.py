@@ -0,0 +1,106 @@
+import posixpath
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """A size-bounded LRU mapping whose entries also expire after ``ttl`` seconds.
+
+    ``maxsize=None`` disables the size bound and ``ttl=None`` disables expiry.
+    """
+
+    def __init__(self, maxsize=None, ttl=None, timer=time.monotonic):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._timer = timer
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        try:
+            expire, value = self._data[key]
+        except KeyError:
+            return default
+        if expire is not None and expire <= self._timer():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=_MISSING):
+        if ttl is _MISSING:
+            ttl = self._ttl
+        expire = None if ttl is None else self._timer() + ttl
+        self._data[key] = expire, value
+        self._data.move_to_end(key)
+        if self._maxsize is not None:
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def values(self):
+        now = self._timer()
+        for key, (expire, value) in list(self._data.items()):
+            if expire is not None and expire <= now:
+                del self._data[key]
+            else:
+                yield value
+
+    def pop(self, key, default=None):
+        try:
+            return self._data.pop(key)[1]
+        except KeyError:
+            return default
+
+    def pop_if(self, predicate):
+        """Remove all entries whose key satisfies ``predicate``."""
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+
+class PathCache:
+    """Metadata of a remote tree by path, like stats, folder listings or previews.
+
+    Each ``kind`` of metadata is cached separately for a path. Changing a path
+    with :meth:`invalidate` drops what is known about it, everything under it
+    and its parent folders, whose listings and stats include it.
+    """
+
+    def __init__(self, maxsize=None, ttl=None):
+        self._enabled = ttl is None or ttl > 0
+        self._data = TTLCache(maxsize, ttl)
+
+    def get(self, kind, path, default=None):
+        return self._data.get((kind, posixpath.normpath(path)), default)
+
+    def set(self, kind, path, value):
+        if self._enabled:
+            self._data.set((kind, posixpath.normpath(path)), value)
+
+    def invalidate(self, path):
+        path = posixpath.normpath(path)
+        ancestors = set()
+        parent = path
+        while True:
+            parent = posixpath.dirname(parent)
+            ancestors.add(posixpath.normpath(parent))
+            if parent in ("/", ""):
+                break
+        prefix = path.rstrip("/") + "/"
+        self._data.pop_if(
+            lambda key: key[1] == path
+            or key[1] in ancestors
+            or key[1].startswith(prefix)
+        )
+
+    def clear(self):
+        self._data.clear()
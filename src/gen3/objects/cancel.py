@@ -0,0 +1,104 @@
+import asyncio
+import collections
+
+from .server import mod
+from ..server import metrics
+
+_stats = collections.defaultdict(collections.Counter)
+
+
+def _collect(name):
+    return lambda: {(kind,): counts[name] for kind, counts in list(_stats.items())}
+
+
+metrics.Counter(
+    "gen3_objects_cancelled_total",
+    "Operations abandoned, like by a client disconnecting, by kind.",
+    labels=("kind",),
+    collect=_collect("cancelled"),
+)
+metrics.Counter(
+    "gen3_objects_cancel_stopped_total",
+    "Cancelled operations still running in a driver that stopped early.",
+    labels=("kind",),
+    collect=_collect("stopped"),
+)
+metrics.Counter(
+    "gen3_objects_cancel_stopped_entries_total",
+    "Entries processed by cancelled operations before they stopped.",
+    labels=("kind",),
+    collect=_collect("entries"),
+)
+
+
+class CancelToken:
+    """Tells driver code that the work it's doing is no longer wanted.
+
+    Cancelling an asyncio task doesn't stop code running in the threadpool or
+    in tasks of its own, so drivers call :meth:`check` in their loops, e.g. for
+    each entry of a walk, and stop once the token is cancelled.
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.cancelled = False
+        self.entries = 0
+        self._stopped = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            _stats[self.kind]["cancelled"] += 1
+
+    def check(self, entries=1):
+        """Count ``entries`` of work, or raise ``CancelledError`` if cancelled.
+
+        Safe to call from threads.
+        """
+        if self.cancelled:
+            if not self._stopped:
+                self._stopped = True
+                _stats[self.kind]["stopped"] += 1
+                _stats[self.kind]["entries"] += self.entries
+            raise asyncio.CancelledError()
+        self.entries += entries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is asyncio.CancelledError:
+            self.cancel()
+
+    async def guard(self, chunks):
+        """Pass ``chunks`` through, cancelling the token if they're abandoned.
+
+        This is for response bodies still produced by driver code after the
+        endpoint has returned.
+        """
+        finished = False
+        try:
+            async for chunk in chunks:
+                yield chunk
+            finished = True
+        finally:
+            if not finished:
+                self.cancel()
+
+
+@mod.get("/cancellations")
+async def get_cancellations():
+    """Count cancelled work by kind.
+
+    ``cancelled`` operations were abandoned, like by a client disconnecting;
+    ``stopped`` of them were still running in the driver and stopped early,
+    after processing ``entries`` entries in total.
+    """
+    return {
+        kind: dict(
+            cancelled=counts["cancelled"],
+            stopped=counts["stopped"],
+            entries=counts["entries"],
+        )
+        for kind, counts in _stats.items()
+    }
@@ -0,0 +1,246 @@
+import asyncio
+import mimetypes
+import posixpath
+
+from fastapi import Depends, HTTPException
+from pydantic import BaseModel, Schema
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.status import (
+    HTTP_202_ACCEPTED,
+    HTTP_400_BAD_REQUEST,
+    HTTP_404_NOT_FOUND,
+    HTTP_500_INTERNAL_SERVER_ERROR,
+)
+
+from . import index, usage
+from .bucket import _get_bucket, _put_indexed
+from .jobs import start_job
+from .server import mod
+from ..server import config, logger
+from ..server.app import db_pool
+from ..server.utils import ID_REGEX
+
+MAX_ERRORS = 10
+
+
+class Location(BaseModel):
+    bucket: str = Schema(..., regex=ID_REGEX)
+    path: str = ""
+
+
+class CopyRequest(BaseModel):
+    source: Location
+    target: Location
+    move: bool = False
+
+
+async def _stat(bucket, path):
+    try:
+        return await bucket.stat(path)
+    except HTTPException as e:
+        if e.status_code == HTTP_404_NOT_FOUND:
+            return None
+        raise
+
+
+async def _up_to_date(pool, source, path, stat, target, target_path):
+    """Whether ``target_path`` already has the same content as ``path``.
+
+    This is how a copy run again after a failure resumes, skipping the files
+    it already copied. Only digests in the index are trusted, as moves delete
+    the source of skipped files, so anything unindexed or stale is copied.
+    """
+    target_stat = await _stat(target, target_path)
+    if target_stat is None or target_stat["dir"] or target_stat["size"] != stat["size"]:
+        return False
+    async with pool.acquire() as conn:
+        info = await index.lookup(conn, source.name, path)
+        target_info = await index.lookup(conn, target.name, target_path)
+    return (
+        index.matches(info, stat)
+        and index.matches(target_info, target_stat)
+        and info["sha256"] is not None
+        and info["sha256"] == target_info["sha256"]
+    )
+
+
+async def _copy_file(pool, source, path, target, target_path, move, progress):
+    stat = await source.stat(path)
+    if await _up_to_date(pool, source, path, stat, target, target_path):
+        progress["skipped"] += 1
+        if move:
+            await source.delete(path)
+            async with pool.acquire() as conn:
+                await index.forget(conn, source.name, path)
+        return
+    if not (move and source.name == target.name):
+        await usage.check_quota(pool, target, stat["size"])
+    async with pool.acquire() as conn:
+        info = await index.lookup(conn, source.name, path)
+    rv = await source.transfer(path, target, target_path, move)
+    if rv is None:
+        rv = await _put_indexed(
+            pool, target, target_path, source.read_range(path, 0, stat["size"])
+        )
+        if move:
+            await source.delete(path)
+    else:
+        # same bytes, so digests of the source still apply
+        values = dict(info) if index.matches(info, stat) else {}
+        values.setdefault("mime", mimetypes.guess_type(target_path, False)[0])
+        values.update(rv)
+        async with pool.acquire() as conn:
+            await index.record(conn, target.name, target_path, **values)
+    if move:
+        async with pool.acquire() as conn:
+            await index.forget(conn, source.name, path)
+    progress["files"] += 1
+    progress["bytes"] += rv["size"]
+
+
+async def _retrying(job, name, func, *args):
+    """Run ``func(*args)``, retrying failures that may be transient."""
+    progress = job.progress
+    for attempt in range(config.OBJECTS_COPY_RETRIES + 1):
+        try:
+            return await func(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            client_error = isinstance(e, HTTPException) and e.status_code < 500
+            if attempt < config.OBJECTS_COPY_RETRIES and not client_error:
+                logger.warning("Retrying %s of job %s: %r", name, job.id, e)
+                await asyncio.sleep(2 ** attempt)
+                continue
+            progress["failed"] += 1
+            if len(progress["errors"]) < MAX_ERRORS:
+                progress["errors"].append(
+                    dict(path=name, error=getattr(e, "detail", None) or repr(e))
+                )
+            return
+
+
+async def _has_files(bucket, path):
+    cursor = None
+    while True:
+        rv = await bucket.get(
+            path, limit=config.OBJECTS_CRAWL_BATCH_SIZE, cursor=cursor
+        )
+        if any(not f["dir"] for f in rv["files"]):
+            return True
+        cursor = rv["next_cursor"]
+        if cursor is None:
+            return False
+
+
+async def _copy(job, pool, source, path, target, target_path, move):
+    progress = job.progress
+    progress.update(files=0, bytes=0, skipped=0, failed=0, errors=[])
+    stat = await source.stat(path)
+    if not stat["dir"]:
+        await _copy_file(pool, source, path, target, target_path, move, progress)
+        return progress
+
+    if move and path.strip("/") and target_path.strip("/"):
+        if target.quota is not None and source.name != target.name:
+            async with pool.acquire() as conn:
+                size = (await usage.get_usage(conn, source.name, path))["bytes"]
+            await usage.check_quota(pool, target, size)
+        if await source.transfer(path, target, target_path, move=True) is not None:
+            async with pool.acquire() as conn:
+                await index.move(conn, source.name, path, target.name, target_path)
+            progress["moved"] = True
+            return progress
+
+    # files are copied as the listing goes, at most OBJECTS_COPY_CONCURRENCY
+    # at a time
+    slots = asyncio.Semaphore(config.OBJECTS_COPY_CONCURRENCY)
+    tasks = set()
+    cursor = None
+    try:
+        while True:
+            rv = await source.get(
+                path,
+                limit=config.OBJECTS_CRAWL_BATCH_SIZE,
+                cursor=cursor,
+                token=job.token,
+            )
+            for f in rv["files"]:
+                if f["dir"]:
+                    continue
+                await slots.acquire()
+                task = asyncio.ensure_future(
+                    _retrying(
+                        job,
+                        f["name"],
+                        _copy_file,
+                        pool,
+                        source,
+                        posixpath.join(path, f["name"]),
+                        target,
+                        posixpath.join(target_path, f["name"]),
+                        move,
+                        progress,
+                    )
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: slots.release())
+            cursor = rv["next_cursor"]
+            if cursor is None:
+                break
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if progress["failed"]:
+        raise HTTPException(
+            HTTP_500_INTERNAL_SERVER_ERROR,
+            f"{progress['failed']} files failed, copy again to resume",
+        )
+    if move and path.strip("/") and not await _has_files(source, path):
+        # only empty folders are left
+        await source.delete(path)
+    return progress
+
+
+@mod.post("/copy")
+async def copy_objects(req: CopyRequest, request: Request, pool=Depends(db_pool)):
+    """Copy or move objects between or within buckets, without downloading them.
+
+    Folders are copied recursively in a background job, retrying failures.
+    Files already copied since they last changed are skipped, so running a
+    failed copy again resumes it.
+    """
+    source = await _get_bucket(req.source.bucket, pool)
+    target = await _get_bucket(req.target.bucket, pool)
+    path = req.source.path.strip("/")
+    target_path = req.target.path.strip("/")
+    if source.name == target.name and (
+        path == target_path or target_path.startswith(path + "/") or not path
+    ):
+        raise HTTPException(HTTP_400_BAD_REQUEST, "cannot copy a path into itself")
+
+    job = start_job(
+        "move" if req.move else "copy",
+        _copy,
+        pool,
+        source,
+        path,
+        target,
+        target_path,
+        req.move,
+        source=f"{source.name}/{path}",
+        target=f"{target.name}/{target_path}",
+    )
+    if await job.wait(config.OBJECTS_COPY_WAIT):
+        if job.exception is not None:
+            raise job.exception
+        return job.result
+    return JSONResponse(
+        dict(job.dict(), href=request.url_for("get_job_status", job_id=job.id)),
+        status_code=HTTP_202_ACCEPTED,
+    )
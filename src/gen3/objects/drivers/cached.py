@@ -0,0 +1,473 @@
+import asyncio
+import collections
+import fcntl
+import hashlib
+import itertools
+import json
+import mimetypes
+import os
+import uuid
+from functools import partial
+
+from fastapi import HTTPException
+from pydantic import BaseModel, Schema, validator
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse
+from starlette.status import HTTP_502_BAD_GATEWAY
+
+from .fs import BUFFER_SIZE, _discard
+from ..bucket import Bucket, installed_drivers
+from ..responses import SendfileResponse, conditional_response
+from ...server import logger
+from ...server.app import app
+
+TEMP_SUFFIX = ".gen3-fetch"
+LOCK_FILE = ".lock"
+STREAM_QUEUE_SIZE = 64
+_DONE = object()
+_caches = {}
+
+
+class CachedSettings(BaseModel):
+    upstream: dict = Schema(
+        ...,
+        description='The bucket to front, like {"driver": "ftp", "settings": {...}}',
+    )
+    cache_dir: str = Schema(..., title="Cache Directory")
+    max_bytes: int = Schema(
+        10 * 1024 ** 3,
+        gt=0,
+        description="Bytes cached by each worker process, in a folder of its own",
+    )
+
+    @validator("upstream")
+    def check_upstream(cls, value):
+        driver = value.get("driver")
+        if driver not in installed_drivers or driver == "cached":
+            raise ValueError(f"unsupported upstream driver: {driver}")
+        installed_drivers[driver].parse_obj(dict(value, name="upstream"))
+        return value
+
+
+class _Entry:
+    __slots__ = ("path", "size", "mtime")
+
+    def __init__(self, path, size, mtime):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+
+
+class _Tee:
+    """The chunks of a fetch, handed to one reader as they are stored.
+
+    The fetch waits for a slow reader, and stops handing chunks to one that
+    went away.
+    """
+
+    def __init__(self):
+        self._queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self._active = True
+
+    async def put(self, item):
+        if self._active:
+            await self._queue.put(item)
+
+    def close(self):
+        self._active = False
+        # unblock a pending put
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    async def chunks(self):
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is _DONE:
+                    break
+                elif isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+
+class DiskCache:
+    """Whole objects in a local folder, evicted least recently used first.
+
+    Each object is stored as a data file named by the hash of its key, beside
+    a JSON file with its upstream path, size and mtime, so the cache survives
+    restarts.
+
+    Worker processes sharing ``cache_dir`` each hold a ``worker-N`` folder in
+    it, locked with ``flock()`` while the process lives, so none of them
+    touches files another one is using. A restarted worker takes over a free
+    folder and the objects in it.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total = 0
+        self.slot_dir = None
+        self._lock_fd = None
+        self._entries = collections.OrderedDict()
+        self._fetches = {}
+        self._loaded = None
+
+    def _file(self, name):
+        return os.path.join(self.slot_dir, name)
+
+    def _claim_slot(self):
+        for i in itertools.count():
+            slot_dir = os.path.join(self.cache_dir, f"worker-{i}")
+            os.makedirs(slot_dir, exist_ok=True)
+            fd = os.open(os.path.join(slot_dir, LOCK_FILE), os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            self._lock_fd = fd
+            self.slot_dir = slot_dir
+            return
+
+    def close(self):
+        """Give up the folder of this cache for another process to take."""
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _load(self):
+        self._claim_slot()
+        found = []
+        for entry in os.scandir(self.slot_dir):
+            if entry.name == LOCK_FILE:
+                continue
+            if entry.name.endswith(TEMP_SUFFIX):
+                # left over by an interrupted fetch
+                os.unlink(entry.path)
+            elif entry.name.endswith(".json"):
+                name = entry.name[: -len(".json")]
+                try:
+                    with open(entry.path) as f:
+                        meta = json.load(f)
+                    atime = os.stat(self._file(name)).st_atime
+                except (OSError, ValueError):
+                    self._unlink(name)
+                    continue
+                found.append((atime, name, _Entry(**meta)))
+        for _, name, entry in sorted(found, key=lambda x: x[0]):
+            self._entries[name] = entry
+            self.total += entry.size
+
+    async def ensure_loaded(self):
+        if self._loaded is None:
+            self._loaded = asyncio.ensure_future(run_in_threadpool(self._load))
+        await asyncio.shield(self._loaded)
+
+    def _unlink(self, name):
+        for path in (self._file(name), self._file(name + ".json")):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def lookup(self, name, size, mtime):
+        """Return the data file of ``name`` if it matches ``size`` and ``mtime``.
+
+        The file is removed once evicted, so open it before handing it out.
+        """
+        entry = self._entries.get(name)
+        if entry is None or entry.size != size or entry.mtime != mtime:
+            return None
+        self._entries.move_to_end(name)
+        return self._file(name)
+
+    async def discard(self, predicate):
+        names = [name for name, entry in self._entries.items() if predicate(entry.path)]
+        for name in names:
+            self.total -= self._entries.pop(name).size
+        if names:
+            await run_in_threadpool(lambda: [self._unlink(name) for name in names])
+
+    def prefetch(self, name, path, size, mtime, read, tee=None):
+        """Store ``read()`` as ``name`` in the background, unless under way.
+
+        Returns whether a fetch was started. Readers that go away don't cancel
+        it, it fills the cache for the next request anyway.
+        """
+        if name in self._fetches:
+            return False
+        fetch = asyncio.ensure_future(self._fetch(name, path, size, mtime, read, tee))
+        self._fetches[name] = fetch
+        fetch.add_done_callback(partial(self._fetched, name))
+        return True
+
+    def stream(self, name, path, size, mtime, read):
+        """Like :meth:`prefetch`, also yielding the chunks as they are stored.
+
+        Returns ``None`` if a fetch of ``name`` is already under way.
+        """
+        tee = _Tee()
+        if not self.prefetch(name, path, size, mtime, read, tee):
+            return None
+        return tee.chunks()
+
+    def _fetched(self, name, fetch):
+        self._fetches.pop(name, None)
+        if not fetch.cancelled() and fetch.exception() is not None:
+            logger.warning("Failed to cache %s: %r", name, fetch.exception())
+
+    async def _fetch(self, name, path, size, mtime, read, tee=None):
+        try:
+            await self._store(name, path, size, mtime, read, tee)
+        except BaseException as e:
+            if tee is not None:
+                await tee.put(e)
+            raise
+
+    async def _store(self, name, path, size, mtime, read, tee):
+        tmp = self._file(f"{name}.{uuid.uuid4().hex}{TEMP_SUFFIX}")
+        f = await run_in_threadpool(open, tmp, "wb")
+        try:
+            received = 0
+            async for chunk in read():
+                received += len(chunk)
+                await run_in_threadpool(f.write, chunk)
+                if tee is not None:
+                    await tee.put(chunk)
+            await run_in_threadpool(f.close)
+            if received != size:
+                raise HTTPException(
+                    HTTP_502_BAD_GATEWAY, "object changed while being cached"
+                )
+            if tee is not None:
+                await tee.put(_DONE)
+            await self.discard(lambda p: p == path)
+
+            def _commit():
+                with open(self._file(name + ".json"), "w") as meta:
+                    json.dump(dict(path=path, size=size, mtime=mtime), meta)
+                os.replace(tmp, self._file(name))
+
+            await run_in_threadpool(_commit)
+        except BaseException:
+            await run_in_threadpool(_discard, f, tmp)
+            raise
+        self._entries[name] = _Entry(path, size, mtime)
+        self.total += size
+        await self._evict()
+
+    async def _evict(self):
+        names = []
+        while self.total > self.max_bytes and len(self._entries) > 1:
+            name, entry = self._entries.popitem(last=False)
+            self.total -= entry.size
+            names.append(name)
+        if names:
+            logger.debug("Evicting %d objects from %s", len(names), self.cache_dir)
+            await run_in_threadpool(lambda: [self._unlink(name) for name in names])
+
+
+async def _read_file(f, offset=0, length=None):
+    fd = f.fileno()
+    while length is None or length > 0:
+        size = BUFFER_SIZE if length is None else min(length, BUFFER_SIZE)
+        chunk = await run_in_threadpool(os.pread, fd, size, offset)
+        if not chunk:
+            break
+        offset += len(chunk)
+        if length is not None:
+            length -= len(chunk)
+        yield chunk
+
+
+class CachedBucket(Bucket):
+    """Read-through local disk cache in front of another bucket."""
+
+    settings: CachedSettings = {}
+
+    @property
+    def upstream(self):
+        return Bucket.parse_obj(dict(self.settings.upstream, name=self.name))
+
+    async def _cache(self):
+        settings = self.settings
+        cache = _caches.get(settings.cache_dir)
+        if cache is None:
+            cache = _caches[settings.cache_dir] = DiskCache(
+                settings.cache_dir, settings.max_bytes
+            )
+        cache.max_bytes = settings.max_bytes
+        await cache.ensure_loaded()
+        return cache
+
+    def _name(self, path):
+        return hashlib.sha256(f"{self.name}/{path}".encode()).hexdigest()
+
+    def _fetch_args(self, path, stat):
+        return (
+            self._name(path),
+            f"{self.name}/{path}",
+            stat["size"],
+            stat["mtime"],
+            partial(self.upstream.read_range, path),
+        )
+
+    async def _open_cached(self, path, stat):
+        """Open the local copy of file ``path``, or return ``None`` on a miss.
+
+        An open copy stays readable after it's evicted.
+        """
+        if stat["size"] > self.settings.max_bytes:
+            return None
+        cache = await self._cache()
+        target = cache.lookup(self._name(path), stat["size"], stat["mtime"])
+        if target is None:
+            return None
+        try:
+            return await run_in_threadpool(open, target, "rb")
+        except FileNotFoundError:
+            return None
+
+    async def _read_miss(self, path, stat, offset=0, length=None):
+        """Read a range of ``path`` from upstream, caching it in the background."""
+        (await self._cache()).prefetch(*self._fetch_args(path, stat))
+        async for chunk in self.upstream.read_range(path, offset, length):
+            yield chunk
+
+    async def _stream_miss(self, path, stat):
+        """Read ``path`` from upstream as it's being cached."""
+        chunks = (await self._cache()).stream(*self._fetch_args(path, stat))
+        if chunks is None:
+            # another request is caching it, this one reads upstream alone
+            chunks = self.upstream.read_range(path)
+        async for chunk in chunks:
+            yield chunk
+
+    async def _forget(self, path):
+        prefix = f"{self.name}/{path.rstrip('/')}"
+        cache = await self._cache()
+        await cache.discard(lambda p: p == prefix or p.startswith(prefix + "/"))
+
+    async def stat(self, path):
+        return await self.upstream.stat(path)
+
+    async def get(
+        self,
+        path,
+        recursive=True,
+        max_depth=None,
+        limit=None,
+        cursor=None,
+        stream=False,
+        token=None,
+    ):
+        return await self.upstream.get(
+            path,
+            recursive=recursive,
+            max_depth=max_depth,
+            limit=limit,
+            cursor=cursor,
+            stream=stream,
+            token=token,
+        )
+
+    async def download(self, path, headers=None, archive="tar"):
+        upstream = self.upstream
+        stat = await upstream.stat(path)
+        if stat["dir"] or stat["size"] > self.settings.max_bytes:
+            return await upstream.download(path, headers, archive=archive)
+        media_type = mimetypes.guess_type(path)[0]
+        # validators come from upstream, so they survive evictions
+        etag = f'"{stat["size"]:x}-{int(stat["mtime"] * 1000):x}"'
+        f = await self._open_cached(path, stat)
+        if f is None:
+            # a miss is answered without waiting for the whole object, which
+            # is cached as it's sent, or alongside for ranges
+
+            def full_response(headers):
+                headers["content-length"] = str(stat["size"])
+                return StreamingResponse(
+                    self._stream_miss(path, stat),
+                    media_type=media_type,
+                    headers=headers,
+                )
+
+            return conditional_response(
+                headers or {},
+                size=stat["size"],
+                mtime=stat["mtime"],
+                etag=etag,
+                read_range=partial(self._read_miss, path, stat),
+                full_response=full_response,
+                media_type=media_type,
+            )
+        try:
+            rv = conditional_response(
+                headers or {},
+                size=stat["size"],
+                mtime=stat["mtime"],
+                etag=etag,
+                read_range=partial(_read_file, f),
+                full_response=partial(
+                    SendfileResponse, f.name, stat_result=os.fstat(f.fileno()), file=f
+                ),
+                media_type=media_type,
+            )
+        except BaseException:
+            f.close()
+            raise
+        rv.background = BackgroundTask(f.close)
+        return rv
+
+    async def read_range(self, path, offset=0, length=None):
+        stat = await self.upstream.stat(path)
+        f = await self._open_cached(path, stat)
+        if f is None:
+            async for chunk in self.upstream.read_range(path, offset, length):
+                yield chunk
+            return
+        try:
+            async for chunk in _read_file(f, offset, length):
+                yield chunk
+        finally:
+            f.close()
+
+    async def put(self, path, chunks):
+        try:
+            return await self.upstream.put(path, chunks)
+        finally:
+            await self._forget(path)
+
+    async def delete(self, path, job=None):
+        try:
+            await self.upstream.delete(path, job)
+        finally:
+            await self._forget(path)
+
+    async def create_upload(self, path, size, part_size):
+        return await self.upstream.create_upload(path, size, part_size)
+
+    async def put_part(self, path, state, offset, chunks):
+        await self.upstream.put_part(path, state, offset, chunks)
+
+    async def complete_upload(self, path, state):
+        try:
+            return await self.upstream.complete_upload(path, state)
+        finally:
+            await self._forget(path)
+
+    async def abort_upload(self, path, state):
+        await self.upstream.abort_upload(path, state)
+
+    async def close(self):
+        await self.upstream.close()
+
+
+@app.on_event("shutdown")
+def close_disk_caches():
+    while _caches:
+        _caches.popitem()[1].close()
@@ -0,0 +1,535 @@
+import asyncio
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import time
+import uuid
+import weakref
+from contextlib import asynccontextmanager
+from functools import partial
+
+import edgedb
+from fastapi import HTTPException
+from pydantic import BaseModel, Schema
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse
+from starlette.status import HTTP_404_NOT_FOUND, HTTP_409_CONFLICT
+
+from .flat import cursor_after, limited, walk_keys
+from .fs import BUFFER_SIZE, FileSystemBucket
+from ..archive import FORMATS as ARCHIVE_FORMATS
+from ..archive import check_format, iterate_writer, write_archive
+from ..bucket import Bucket
+from ..mime import preview, read_head
+from ..responses import SendfileResponse, conditional_response
+from ...server.app import app
+
+SCHEMA = """\
+    type CasEntry {
+        required property bucket -> str;
+        required property path -> str;
+        required property key -> str {
+            constraint exclusive;
+        }
+        required property sha256 -> str;
+        required property size -> int64;
+        required property mtime -> float64;
+        property root -> str;
+
+        index cas_entry_bucket on (__subject__.bucket);
+        index cas_entry_path on (__subject__.path);
+        index cas_entry_sha256 on (__subject__.sha256);
+    }
+
+    type CasLock {
+        required property key -> str {
+            constraint exclusive;
+        }
+        required property token -> str;
+        required property expires -> float64;
+    }
+"""
+PAGE_SIZE = 1000
+LOCK_TIMEOUT = 60
+LOCK_POLL_INTERVAL = 0.05
+# entries recorded before roots were, could be in any root
+_SAME_ROOT = "(.root ?? <str>$root) = <str>$root"
+_locks = weakref.WeakValueDictionary()
+
+
+class CasSettings(BaseModel):
+    root_dir: str = Schema(
+        ...,
+        title="Blob Directory",
+        description="Buckets sharing it store each distinct content only once",
+    )
+
+
+def _key(bucket_name, path):
+    return f"{bucket_name}/{path}"
+
+
+def _local_lock(key):
+    rv = _locks.get(key)
+    if rv is None:
+        rv = _locks[key] = asyncio.Lock()
+    return rv
+
+
+@asynccontextmanager
+async def _lock(root, sha256):
+    """Serialize linking and collecting the blob of ``sha256`` in ``root``.
+
+    Workers sharing the blob directory take turns through a ``CasLock`` row.
+    A lock left by a worker that died is taken over after ``LOCK_TIMEOUT``.
+    """
+    key = f"{root}/{sha256}"
+    token = uuid.uuid4().hex
+    async with _local_lock(key):
+        pool = await app.pool
+        while True:
+            now = time.time()
+            async with pool.acquire() as conn:
+                await conn.fetchall(
+                    """
+                    DELETE objects::CasLock
+                    FILTER .key = <str>$key AND .expires < <float64>$now
+                    """,
+                    key=key,
+                    now=now,
+                )
+                try:
+                    await conn.fetchall(
+                        """
+                        INSERT objects::CasLock {
+                            key := <str>$key,
+                            token := <str>$token,
+                            expires := <float64>$expires,
+                        }
+                        """,
+                        key=key,
+                        token=token,
+                        expires=now + LOCK_TIMEOUT,
+                    )
+                    break
+                except edgedb.ConstraintViolationError:
+                    pass
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            async with pool.acquire() as conn:
+                await conn.fetchall(
+                    """
+                    DELETE objects::CasLock
+                    FILTER .key = <str>$key AND .token = <str>$token
+                    """,
+                    key=key,
+                    token=token,
+                )
+
+
+def _hash_file(path):
+    rv = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), b""):
+            rv.update(chunk)
+    return rv.hexdigest()
+
+
+class CasBucket(Bucket):
+    """Content-addressed bucket storing each distinct content once.
+
+    Contents are stored as files named by their SHA-256 under ``root_dir``,
+    while paths are mapped to them in the database.
+    """
+
+    settings: CasSettings = {}
+
+    @property
+    def _store(self):
+        return FileSystemBucket(
+            name=self.name, driver="fs", settings=dict(root_dir=self.settings.root_dir)
+        )
+
+    @property
+    def _root(self):
+        return os.path.realpath(self.settings.root_dir)
+
+    @staticmethod
+    def _blob(sha256):
+        return posixpath.join("blobs", sha256[:2], sha256[2:4], sha256)
+
+    def _dir_prefix(self, path):
+        path = path.strip("/")
+        return path + "/" if path else ""
+
+    async def _lookup(self, path):
+        async with (await app.pool).acquire() as conn:
+            rv = await conn.fetchall(
+                """
+                SELECT objects::CasEntry { sha256, size, mtime }
+                FILTER .key = <str>$key
+                """,
+                key=_key(self.name, path),
+            )
+        return rv[0] if rv else None
+
+    async def _entries(self, prefix, after="", fields="size, mtime"):
+        """Yield pages of the entries under ``prefix`` after ``after``, by path."""
+        while True:
+            async with (await app.pool).acquire() as conn:
+                rv = await conn.fetchall(
+                    f"""
+                    SELECT objects::CasEntry {{ key, path, {fields} }}
+                    FILTER .bucket = <str>$bucket
+                        AND .path[:<int64>$length] = <str>$prefix
+                        AND .path > <str>$after
+                    ORDER BY .path
+                    LIMIT <int64>$limit
+                    """,
+                    bucket=self.name,
+                    length=len(prefix),
+                    prefix=prefix,
+                    after=after,
+                    limit=PAGE_SIZE,
+                )
+            if rv:
+                yield rv
+            if len(rv) < PAGE_SIZE:
+                break
+            after = rv[-1].path
+
+    async def _is_dir(self, path):
+        async for _ in self._entries(self._dir_prefix(path)):
+            return True
+        return False
+
+    async def stat(self, path):
+        if path.strip("/"):
+            entry = await self._lookup(path)
+            if entry is not None:
+                return dict(name=path, dir=False, size=entry.size, mtime=entry.mtime)
+            if not await self._is_dir(path):
+                raise HTTPException(HTTP_404_NOT_FOUND)
+        return dict(name=path, dir=True, size=0, mtime=None)
+
+    async def _pages(self, prefix, after):
+        async for page in self._entries(prefix, after):
+            yield [(entry.path, entry.size, entry.mtime) for entry in page]
+
+    async def get(
+        self,
+        path,
+        recursive=True,
+        max_depth=None,
+        limit=None,
+        cursor=None,
+        stream=False,
+        token=None,
+    ):
+        entry = await self._lookup(path) if path.strip("/") else None
+        preview_ = files = next_cursor = None
+        if entry is None:
+            if path.strip("/") and not await self._is_dir(path):
+                raise HTTPException(HTTP_404_NOT_FOUND)
+            type_ = "Directory"
+            mime = "inode/directory"
+            if not recursive:
+                max_depth = 1
+            prefix = self._dir_prefix(path)
+            entries = walk_keys(
+                self._pages(prefix, prefix + cursor if cursor else ""),
+                prefix,
+                max_depth,
+                cursor,
+                token,
+            )
+            if limit is not None:
+                entries = limited(entries, limit)
+            if stream:
+                return StreamingResponse(
+                    (json.dumps(e) + "\n" async for e in entries),
+                    media_type="application/x-ndjson",
+                )
+            files = [e async for e in entries]
+            next_cursor = cursor_after(files, limit)
+            size, mtime = 0, None
+        else:
+            target = self._store._get_target(self._blob(entry.sha256))
+            head = await run_in_threadpool(read_head, target)
+            preview_ = preview(head)
+            # the type only depends on the content
+            mime, type_ = await self.detect_type(path, head, version=(entry.sha256,))
+            size, mtime = entry.size, entry.mtime
+
+        return dict(
+            name=path,
+            dir=entry is None,
+            size=size,
+            mtime=mtime,
+            type=type_,
+            mime=mime,
+            files=files,
+            next_cursor=next_cursor,
+            preview=preview_,
+            sha256=None if entry is None else entry.sha256,
+        )
+
+    async def download(self, path, headers=None, archive="tar"):
+        entry = await self._lookup(path) if path.strip("/") else None
+        if entry is None:
+            check_format(archive)
+            media_type, ext = ARCHIVE_FORMATS[archive]
+            prefix = self._dir_prefix(path)
+            entries = [
+                (e.path[len(prefix) :], self._store._get_target(self._blob(e.sha256)))
+                async for page in self._entries(prefix, fields="sha256")
+                for e in page
+            ]
+            if not entries and prefix:
+                raise HTTPException(HTTP_404_NOT_FOUND)
+            name = posixpath.basename(path.rstrip("/")) or self.name
+            return StreamingResponse(
+                iterate_writer(write_archive, archive, entries),
+                media_type=media_type,
+                headers={"content-disposition": f'attachment; filename="{name}{ext}"'},
+            )
+        blob = self._blob(entry.sha256)
+        target = self._store._get_target(blob)
+        try:
+            st = await run_in_threadpool(os.stat, target)
+        except FileNotFoundError:
+            raise HTTPException(HTTP_404_NOT_FOUND)
+        media_type = mimetypes.guess_type(path)[0]
+        return conditional_response(
+            headers or {},
+            size=entry.size,
+            mtime=entry.mtime,
+            # contents never change, their hash is a strong validator
+            etag=f'"{entry.sha256}"',
+            read_range=partial(self._store.read_range, blob),
+            full_response=partial(
+                SendfileResponse,
+                target,
+                stat_result=st,
+                media_type=media_type or "application/octet-stream",
+            ),
+            media_type=media_type,
+        )
+
+    async def read_range(self, path, offset=0, length=None):
+        entry = await self._lookup(path)
+        if entry is None:
+            raise HTTPException(HTTP_404_NOT_FOUND)
+        async for chunk in self._store.read_range(
+            self._blob(entry.sha256), offset, length
+        ):
+            yield chunk
+
+    async def _record(self, path, sha256, size, mtime):
+        """Map ``path`` to ``sha256``, returning the hash it was mapped to."""
+        async with (await app.pool).acquire() as conn:
+            async with conn.transaction():
+                old = await conn.fetchall(
+                    """
+                    SELECT (
+                        DELETE objects::CasEntry FILTER .key = <str>$key
+                    ) { sha256 }
+                    """,
+                    key=_key(self.name, path),
+                )
+                await conn.fetchall(
+                    """
+                    INSERT objects::CasEntry {
+                        bucket := <str>$bucket,
+                        path := <str>$path,
+                        key := <str>$key,
+                        sha256 := <str>$sha256,
+                        size := <int64>$size,
+                        mtime := <float64>$mtime,
+                        root := <str>$root,
+                    }
+                    """,
+                    bucket=self.name,
+                    path=path,
+                    key=_key(self.name, path),
+                    sha256=sha256,
+                    size=size,
+                    mtime=mtime,
+                    root=self._root,
+                )
+        return old[0].sha256 if old else None
+
+    async def _link(self, path, sha256, size, tmp=None):
+        """Map ``path`` to the blob of ``sha256``, made of ``tmp`` if it's new.
+
+        Without ``tmp``, returns ``None`` if there is no such blob.
+        """
+        if await self._is_dir(path):
+            raise HTTPException(HTTP_409_CONFLICT, "cannot overwrite folder")
+        blob = self._store._get_target(self._blob(sha256))
+
+        def _store():
+            if os.path.exists(blob):
+                # known content, the new copy is dropped
+                if tmp is not None:
+                    os.unlink(self._store._get_target(tmp))
+                return True
+            if tmp is None:
+                return False
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(self._store._get_target(tmp), blob)
+            return True
+
+        async with _lock(self._root, sha256):
+            if not await run_in_threadpool(_store):
+                return None
+            mtime = time.time()
+            old = await self._record(path, sha256, size, mtime)
+        if old is not None and old != sha256:
+            await self._collect([old])
+        return dict(size=size, mtime=mtime, sha256=sha256)
+
+    async def _collect(self, hashes):
+        """Remove the blobs of ``hashes`` no longer mapped from any path.
+
+        Only paths of buckets sharing the blob directory count.
+        """
+        for sha256 in set(hashes):
+            async with _lock(self._root, sha256):
+                async with (await app.pool).acquire() as conn:
+                    used = await conn.fetchall(
+                        f"""
+                        SELECT EXISTS (
+                            SELECT objects::CasEntry
+                            FILTER .sha256 = <str>$sha256 AND {_SAME_ROOT}
+                        )
+                        """,
+                        sha256=sha256,
+                        root=self._root,
+                    )
+                if not used[0]:
+                    try:
+                        await run_in_threadpool(
+                            os.unlink, self._store._get_target(self._blob(sha256))
+                        )
+                    except FileNotFoundError:
+                        pass
+
+    async def put(self, path, chunks):
+        hasher = hashlib.sha256()
+
+        async def _hashed():
+            async for chunk in chunks:
+                hasher.update(chunk)
+                yield chunk
+
+        tmp = posixpath.join("tmp", uuid.uuid4().hex)
+        rv = await self._store.put(tmp, _hashed())
+        sha256 = hasher.hexdigest()
+        try:
+            return await self._link(path, sha256, rv["size"], tmp)
+        except BaseException:
+            try:
+                await run_in_threadpool(os.unlink, self._store._get_target(tmp))
+            except FileNotFoundError:
+                # linked already, the blob may be left without any path
+                await self._collect([sha256])
+            raise
+
+    async def put_by_digest(self, path, sha256):
+        entry = None
+        async with (await app.pool).acquire() as conn:
+            rv = await conn.fetchall(
+                f"""
+                SELECT objects::CasEntry {{ size }}
+                FILTER .sha256 = <str>$sha256 AND {_SAME_ROOT}
+                LIMIT 1
+                """,
+                sha256=sha256,
+                root=self._root,
+            )
+            if rv:
+                entry = rv[0]
+        if entry is None:
+            return None
+        return await self._link(path, sha256, entry.size)
+
+    async def delete(self, path, job=None):
+        progress = {} if job is None else job.progress
+        progress.update(entries=0, bytes=0)
+        entry = await self._lookup(path) if path.strip("/") else None
+        if entry is not None:
+            async with (await app.pool).acquire() as conn:
+                await conn.fetchall(
+                    "DELETE objects::CasEntry FILTER .key = <str>$key",
+                    key=_key(self.name, path),
+                )
+            progress.update(entries=1, bytes=entry.size)
+            await self._collect([entry.sha256])
+            return
+        prefix = self._dir_prefix(path)
+        found = False
+        while True:
+            # entries are removed as they go, so always take the first page
+            page = None
+            async for page in self._entries(prefix, fields="size, sha256"):
+                break
+            if not page:
+                break
+            found = True
+            if job is not None:
+                job.token.check()
+            async with (await app.pool).acquire() as conn:
+                await conn.fetchall(
+                    """
+                    DELETE objects::CasEntry
+                    FILTER .key IN array_unpack(<array<str>>$keys)
+                    """,
+                    keys=[e.key for e in page],
+                )
+            progress["entries"] += len(page)
+            progress["bytes"] += sum(e.size for e in page)
+            await self._collect([e.sha256 for e in page])
+        if not found and prefix:
+            raise HTTPException(HTTP_404_NOT_FOUND)
+
+    async def create_upload(self, path, size, part_size):
+        return await self._store.create_upload(
+            posixpath.join("tmp", uuid.uuid4().hex), size, part_size
+        )
+
+    async def put_part(self, path, state, offset, chunks):
+        await self._store.put_part(path, state, offset, chunks)
+
+    async def complete_upload(self, path, state):
+        tmp = self._store._get_target(state["tmp"])
+        try:
+            sha256 = await run_in_threadpool(_hash_file, tmp)
+            size = (await run_in_threadpool(os.stat, tmp)).st_size
+        except FileNotFoundError:
+            raise HTTPException(HTTP_404_NOT_FOUND, "upload not found")
+        try:
+            return await self._link(path, sha256, size, state["tmp"])
+        except BaseException:
+            # the upload is kept for a retry, unless it was linked already
+            if not await run_in_threadpool(os.path.exists, tmp):
+                await self._collect([sha256])
+            raise
+
+    async def abort_upload(self, path, state):
+        await self._store.abort_upload(path, state)
+
+    async def drop(self, conn):
+        rv = await conn.fetchall(
+            """
+            SELECT (
+                DELETE objects::CasEntry FILTER .bucket = <str>$bucket
+            ) { sha256 }
+            """,
+            bucket=self.name,
+        )
+        return partial(self._collect, [entry.sha256 for entry in rv])
@@ -0,0 +1,66 @@
+import mimetypes
+
+
+def entry(name, dir_, size=0, mtime=None):
+    return dict(
+        name=name,
+        dir=dir_,
+        size=size,
+        mtime=mtime,
+        mime=mimetypes.guess_type(name, False)[0],
+    )
+
+
+async def limited(entries, limit):
+    count = 0
+    async for item in entries:
+        yield item
+        count += 1
+        if count == limit:
+            break
+
+
+def cursor_after(files, limit):
+    """Return the cursor to resume a listing after ``files``, if it was cut."""
+    if limit is None or len(files) < limit:
+        return None
+    last = files[-1]
+    return last["name"] + "/" if last["dir"] else last["name"]
+
+
+async def walk_keys(pages, prefix="", max_depth=None, cursor=None, token=None):
+    """Yield listing entries of a flat key space, where folders are key prefixes.
+
+    ``pages`` is an async iterable of lists of ``(key, size, mtime)``, sorted by
+    key and all starting with ``prefix``; keys ending with a slash are folders.
+    Folders are sent right before their first entry. ``cursor`` is the name of
+    the last entry a client has seen, with a trailing slash for folders, as
+    keys in them sort after names like ``a-b``; ``pages`` should start right
+    after ``prefix + cursor``.
+    """
+    # folders already sent, to send only new ones
+    sent = tuple(cursor.rstrip("/").split("/")) if cursor else ()
+    async for items in pages:
+        for key, size, mtime in items:
+            if token is not None:
+                token.check()
+            name = key[len(prefix) :]
+            is_dir = name.endswith("/")
+            parts = tuple(name.rstrip("/").split("/"))
+            if not parts[-1] or is_dir and sent[: len(parts)] == parts:
+                continue
+            same = 0
+            while same < min(len(sent), len(parts) - 1):
+                if sent[same] != parts[same]:
+                    break
+                same += 1
+            for depth in range(same + 1, len(parts)):
+                if max_depth is None or depth <= max_depth:
+                    yield entry("/".join(parts[:depth]), True)
+            sent = parts if is_dir else parts[:-1]
+            if max_depth is not None and len(parts) > max_depth:
+                continue
+            if is_dir:
+                yield entry("/".join(parts), True)
+            else:
+                yield entry("/".join(parts), False, size, mtime)
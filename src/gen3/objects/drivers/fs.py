@@ -1,23 +1,192 @@
+import errno
+import fcntl
+import json
 import mimetypes
 import os
 import shutil
 import stat
-from collections import deque
+import uuid
+from functools import partial
+from itertools import islice
 
 from fastapi import HTTPException
-from pydantic import BaseModel, Schema
+from pydantic import BaseModel, Schema, validator
 from starlette.concurrency import run_in_threadpool
-from starlette.responses import FileResponse
-from starlette.status import HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND, HTTP_409_CONFLICT
+from starlette.responses import StreamingResponse
+from starlette.status import (
+    HTTP_400_BAD_REQUEST,
+    HTTP_404_NOT_FOUND,
+    HTTP_409_CONFLICT,
+    HTTP_501_NOT_IMPLEMENTED,
+)
 
+from ..archive import FORMATS as ARCHIVE_FORMATS
+from ..archive import check_format, iterate_writer, write_archive
 from ..bucket import Bucket
+from ..cache import TTLCache
+from ..mime import HEAD_SIZE, preview, read_head
+from ..responses import SendfileResponse, conditional_response, make_etag
+from ..seekable import SeekableReader, SeekableWriter, read_frame, read_table
+from ..seekable import zstandard
 from ...server import logger
 
 BUFFER_SIZE = 65536
+STREAM_BATCH_SIZE = 256
+TEMP_SUFFIX = ".gen3-upload"
+PACKED_SUFFIX = ".gen3-zst"
+# ioctl sharing the blocks of a file with another, on Btrfs, XFS and the like
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+_tables = TTLCache(maxsize=4096)
+
+
+def _display(name):
+    """Return the name of the object stored in the file ``name``."""
+    if name.endswith(PACKED_SUFFIX):
+        return name[: -len(PACKED_SUFFIX)]
+    return name
+
+
+def _check_name(path):
+    """Refuse to write objects that would pass for compressed files."""
+    if any(part.endswith(PACKED_SUFFIX) for part in path.split("/")):
+        raise HTTPException(
+            HTTP_400_BAD_REQUEST, f"names ending with {PACKED_SUFFIX} are reserved"
+        )
+
+
+def _scandir(path, packed=False):
+    with os.scandir(path) as it:
+        if not packed:
+            return sorted(it, key=lambda entry: entry.name)
+        # a plain file sorts before a compressed copy of the same object
+        return sorted(it, key=lambda entry: (_display(entry.name), entry.name))
+
+
+def _seek_table(path, st):
+    """Return the seek table of the compressed file ``path`` with stat ``st``."""
+    key = path, st.st_ino, st.st_size, st.st_mtime_ns
+    table = _tables.get(key)
+    if table is None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            table = read_table(fd)
+        finally:
+            os.close(fd)
+        _tables.set(key, table)
+    return table
+
+
+def _read_head_packed(path, table):
+    """Like ``read_head()``, of the content of a compressed file."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            head = b"".join(
+                read_frame(fd, table, index) for index in table.span(0, HEAD_SIZE)
+            )
+        finally:
+            os.close(fd)
+    except (OSError, zstandard.ZstdError):
+        return None
+    return head[:HEAD_SIZE]
+
+
+async def _read_frames(path, table, offset=0, length=None):
+    """Yield the content ``offset:offset+length`` of a compressed file."""
+    stop = table.size if length is None else min(offset + length, table.size)
+    fd = await run_in_threadpool(os.open, path, os.O_RDONLY)
+    try:
+        for index in table.span(offset, stop):
+            data = await run_in_threadpool(read_frame, fd, table, index)
+            start = table.positions[index]
+            yield data[max(offset - start, 0) : stop - start]
+    finally:
+        os.close(fd)
+
+
+def _discard(f, tmp):
+    """Close and remove the temp file ``tmp`` written through ``f``."""
+    f.close()
+    os.unlink(tmp)
+
+
+def _clone(src, dst):
+    """Copy file ``src`` over ``dst`` in the kernel, sharing blocks if possible."""
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        try:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def _accepts_zstd(headers):
+    for coding in headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() != "zstd":
+            continue
+        q = params.strip()
+        try:
+            return not q.startswith("q=") or float(q[2:]) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def _packed_response(path, st, media_type, headers):
+    """Send the compressed file ``path`` as it is, as ``zstd`` content."""
+    headers = dict(headers, **{"content-encoding": "zstd", "vary": "Accept-Encoding"})
+    return SendfileResponse(
+        path, stat_result=st, headers=headers, media_type=media_type
+    )
+
+
+def _unpacked_response(path, table, media_type, headers):
+    headers = dict(
+        headers, **{"content-length": str(table.size), "vary": "Accept-Encoding"}
+    )
+    return StreamingResponse(
+        _read_frames(path, table), headers=headers, media_type=media_type
+    )
+
+
+def _ndjson(entries):
+    # start with a single entry so the first bytes go out right away
+    batch_size = 1
+    batch = []
+    for entry in entries:
+        batch.append(json.dumps(entry))
+        if len(batch) >= batch_size:
+            yield "\n".join(batch) + "\n"
+            batch = []
+            batch_size = min(batch_size * 2, STREAM_BATCH_SIZE)
+    if batch:
+        yield "\n".join(batch) + "\n"
 
 
 class FileSystemSettings(BaseModel):
     root_dir: str = Schema(..., title="Root Directory")
+    compression: str = Schema(
+        None,
+        regex="^zstd$",
+        description=(
+            "Store new objects compressed, only zstd is supported; objects "
+            "stored compressed are only found while this is set"
+        ),
+    )
+    compression_level: int = Schema(3, ge=1, le=22)
+    frame_size: int = Schema(
+        1024 ** 2,
+        gt=0,
+        description="Bytes of content per compressed frame, the unit of ranged reads",
+    )
+
+    @validator("compression")
+    def check_compression(cls, value):
+        if value is not None and zstandard is None:
+            raise ValueError("zstd is not available")
+        return value
 
 
 class FileSystemBucket(Bucket):
@@ -34,98 +203,474 @@ class FileSystemBucket(Bucket):
             raise HTTPException(HTTP_400_BAD_REQUEST, "escaping root_dir")
         return target
 
-    async def get(self, path, recursive=True):
-        def _get():
-            target = self._get_target(path)
-            if not os.path.exists(target):
+    def _find(self, path):
+        """Return the file storing ``path``, its stat, and its seek table if any.
+
+        Objects put while ``compression`` is set are stored compressed beside
+        where they'd be, with a ``PACKED_SUFFIX``; a plain file wins over that.
+        Without ``compression``, such files are taken as they are.
+        """
+        target = self._get_target(path)
+        try:
+            return target, os.stat(target), None
+        except FileNotFoundError:
+            if self.settings.compression is None:
                 raise HTTPException(HTTP_404_NOT_FOUND)
+        packed = target + PACKED_SUFFIX
+        try:
+            st = os.stat(packed)
+        except FileNotFoundError:
+            raise HTTPException(HTTP_404_NOT_FOUND)
+        if zstandard is None:
+            raise HTTPException(HTTP_501_NOT_IMPLEMENTED, "zstd is not available")
+        return packed, st, _seek_table(packed, st)
 
-            st = os.stat(target)
-            if stat.S_ISDIR(st.st_mode):
-                files = []
-                type_ = "Directory"
-                mime = "inode/directory"
-                preview = None
-                q = deque([iter(os.scandir(target))])
-                while q:
-                    it = q[-1]
-                    try:
-                        while True:
-                            entry = next(it)
-                            e_st = entry.stat()
-                            files.append(
-                                dict(
-                                    name=os.path.relpath(entry.path, target),
-                                    dir=entry.is_dir(),
-                                    size=e_st.st_size,
-                                    mtime=e_st.st_mtime,
-                                    mime=mimetypes.guess_type(entry.path, False)[0],
-                                )
-                            )
-                            if recursive and entry.is_dir(follow_symlinks=False):
-                                q.append(iter(os.scandir(entry.path)))
-                                break
-                    except StopIteration:
-                        q.pop()
-                    except PermissionError as e:
-                        logger.warning(e)
+    def _walk(self, target, recursive=True, max_depth=None, cursor=None, token=None):
+        """Yield entries under ``target`` depth-first, sorted by name.
+
+        The order is stable, so ``cursor`` - the name of the last entry a client
+        has seen - resumes the walk right after it, without re-reading the
+        subtrees before it.
+
+        The walk runs in a thread, it raises ``CancelledError`` at the next
+        entry once ``token`` is cancelled.
+        """
+        if not recursive:
+            max_depth = 1
+        packed = self.settings.compression is not None
+        display = _display if packed else str
+        after = tuple(cursor.split("/")) if cursor else None
+        stack = [((), iter(_scandir(target, packed)))]
+        previous = None
+        while stack:
+            parts, it = stack[-1]
+            entry = next(it, None)
+            if entry is None:
+                stack.pop()
+                continue
+            if token is not None:
+                token.check()
+            if entry.name.endswith(TEMP_SUFFIX):
+                continue
+            key = parts + (display(entry.name),)
+            if key == previous:
+                # a leftover compressed copy of the file before it
+                continue
+            previous = key
+            descend = entry.is_dir(follow_symlinks=False) and (
+                max_depth is None or len(key) < max_depth
+            )
+            if after is not None and key <= after:
+                if not (descend and after[: len(key)] == key):
+                    continue
             else:
-                files = preview = None
-                mime, type_ = self.guess_type(target)
-                # noinspection PyBroadException
                 try:
-                    with open(target) as f:
-                        preview = f.read(1024)
-                except Exception:
-                    pass
+                    e_st = entry.stat()
+                    size = e_st.st_size
+                    if entry.name != key[-1] and not stat.S_ISDIR(e_st.st_mode):
+                        size = _seek_table(entry.path, e_st).size
+                except (OSError, ValueError) as e:
+                    logger.warning("%s: %s", entry.path, e)
+                    continue
+                yield dict(
+                    name="/".join(key),
+                    dir=entry.is_dir(),
+                    size=size,
+                    mtime=e_st.st_mtime,
+                    mime=mimetypes.guess_type(key[-1], False)[0],
+                )
+            if descend:
+                try:
+                    stack.append((key, iter(_scandir(entry.path, packed))))
+                except PermissionError as e:
+                    logger.warning(e)
 
+    async def stat(self, path):
+        def _stat():
+            _, st, table = self._find(path)
             return dict(
                 name=path,
                 dir=stat.S_ISDIR(st.st_mode),
-                size=st.st_size,
+                size=st.st_size if table is None else table.size,
                 mtime=st.st_mtime,
-                type=type_,
-                mime=mime,
-                files=files,
-                preview=preview,
             )
 
-        return await run_in_threadpool(_get)
+        return await run_in_threadpool(_stat)
 
-    async def download(self, path):
+    async def get(
+        self,
+        path,
+        recursive=True,
+        max_depth=None,
+        limit=None,
+        cursor=None,
+        stream=False,
+        token=None,
+    ):
         def _get():
             target = self._get_target(path)
-            if not os.path.exists(target):
-                raise HTTPException(HTTP_404_NOT_FOUND)
-            elif os.path.isdir(target):
-                raise HTTPException(
-                    HTTP_400_BAD_REQUEST, "folder download not supported"
-                )
+            stored, st, table = self._find(path)
+            next_cursor = None
+            if stat.S_ISDIR(st.st_mode):
+                entries = self._walk(target, recursive, max_depth, cursor, token)
+                if limit is not None:
+                    entries = islice(entries, limit)
+                if stream:
+                    return StreamingResponse(
+                        _ndjson(entries), media_type="application/x-ndjson"
+                    )
+                files = list(entries)
+                if limit is not None and len(files) == limit:
+                    next_cursor = files[-1]["name"]
+                type_ = "Directory"
+                mime = "inode/directory"
+                head = None
             else:
-                return FileResponse(target)
+                files = type_ = mime = None
+                # read once for both the preview and the type detection
+                if table is None:
+                    head = read_head(target)
+                else:
+                    head = _read_head_packed(stored, table)
 
-        return await run_in_threadpool(_get)
+            return (
+                st,
+                head,
+                dict(
+                    name=path,
+                    dir=stat.S_ISDIR(st.st_mode),
+                    size=st.st_size if table is None else table.size,
+                    mtime=st.st_mtime,
+                    type=type_,
+                    mime=mime,
+                    files=files,
+                    next_cursor=next_cursor,
+                    preview=preview(head),
+                ),
+            )
+
+        target = self._get_target(path)
+        rv = await run_in_threadpool(_get)
+        if not isinstance(rv, tuple):
+            return rv
+        st, head, rv = rv
+        if not rv["dir"]:
+            rv["mime"], rv["type"] = await self.detect_type(
+                target, head, version=(st.st_ino, st.st_size, st.st_mtime_ns)
+            )
+        return rv
+
+    def _archive_entries(self, target):
+        for entry in self._walk(target):
+            path = os.path.join(target, entry["name"])
+            if entry["dir"] or os.path.lexists(path):
+                yield entry["name"], path
+            else:
+                path += PACKED_SUFFIX
+                yield entry["name"], path, partial(SeekableReader, path)
+
+    async def download(self, path, headers=None, archive="tar"):
+        headers = headers or {}
+        target = self._get_target(path)
+        stored, st, table = await run_in_threadpool(self._find, path)
+        if stat.S_ISDIR(st.st_mode):
+            check_format(archive)
+            media_type, ext = ARCHIVE_FORMATS[archive]
+            name = os.path.basename(path.rstrip("/")) or self.name
+            return StreamingResponse(
+                iterate_writer(write_archive, archive, self._archive_entries(target)),
+                media_type=media_type,
+                headers={"content-disposition": f'attachment; filename="{name}{ext}"'},
+            )
+        media_type = mimetypes.guess_type(target)[0]
+        if table is None:
+            return conditional_response(
+                headers,
+                size=st.st_size,
+                mtime=st.st_mtime,
+                etag=make_etag(st),
+                read_range=partial(self.read_range, path),
+                full_response=partial(SendfileResponse, target, stat_result=st),
+                media_type=media_type,
+            )
+        if "range" not in headers and _accepts_zstd(headers):
+            # pass the stored frames through, it's a valid zstd stream as is
+            return conditional_response(
+                headers,
+                size=st.st_size,
+                mtime=st.st_mtime,
+                etag=make_etag(st)[:-1] + '-zst"',
+                read_range=None,
+                full_response=partial(_packed_response, stored, st, media_type),
+                media_type=media_type,
+            )
+        return conditional_response(
+            headers,
+            size=table.size,
+            mtime=st.st_mtime,
+            etag=make_etag(st),
+            read_range=partial(_read_frames, stored, table),
+            full_response=partial(_unpacked_response, stored, table, media_type),
+            media_type=media_type,
+        )
+
+    async def read_range(self, path, offset=0, length=None):
+        target, _, table = await run_in_threadpool(self._find, path)
+        if table is not None:
+            async for chunk in _read_frames(target, table, offset, length):
+                yield chunk
+            return
+        fd = await run_in_threadpool(os.open, target, os.O_RDONLY)
+        try:
+            while length is None or length > 0:
+                size = BUFFER_SIZE if length is None else min(length, BUFFER_SIZE)
+                chunk = await run_in_threadpool(os.pread, fd, size, offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                if length is not None:
+                    length -= len(chunk)
+                yield chunk
+        finally:
+            os.close(fd)
+
+    def _create_temp(self, path):
+        """Create an empty temp file beside the target of ``path``.
+
+        Data is written there and renamed over the target once complete.
+        """
+        _check_name(path)
+        target = self._get_target(path)
+        if os.path.exists(target):
+            if os.path.isdir(target):
+                raise HTTPException(HTTP_409_CONFLICT, "cannot overwrite folder")
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = os.path.join(
+            os.path.dirname(target),
+            f".{os.path.basename(target)}.{uuid.uuid4().hex}{TEMP_SUFFIX}",
+        )
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        return target, tmp, fd
+
+    def _packer(self, f):
+        settings = self.settings
+        return SeekableWriter(f, settings.compression_level, settings.frame_size)
+
+    def _commit(self, tmp, target, packed):
+        """Rename ``tmp`` over ``target``, removing the other copy of it if any."""
+        if packed:
+            os.replace(tmp, target + PACKED_SUFFIX)
+            stale = target
+        else:
+            os.replace(tmp, target)
+            if self.settings.compression is None:
+                return
+            stale = target + PACKED_SUFFIX
+        try:
+            os.unlink(stale)
+        except FileNotFoundError:
+            pass
+
+    async def put(self, path, chunks):
+        def _open():
+            target, tmp, fd = self._create_temp(path)
+            return target, tmp, os.fdopen(fd, "wb")
 
-    async def put(self, path, file):
-        def _put():
+        packed = self.settings.compression is not None
+        target, tmp, f = await run_in_threadpool(_open)
+        size = 0
+        try:
+            # the packer buffers whole frames, so it takes chunks as they come
+            out = self._packer(f) if packed else f
+            buf = bytearray()
+            async for chunk in chunks:
+                buf += chunk
+                size += len(chunk)
+                if len(buf) >= BUFFER_SIZE:
+                    await run_in_threadpool(out.write, buf)
+                    buf = bytearray()
+            if buf:
+                await run_in_threadpool(out.write, buf)
+            if packed:
+                await run_in_threadpool(out.close)
+            await run_in_threadpool(f.close)
+            st = await run_in_threadpool(os.stat, tmp)
+            await run_in_threadpool(self._commit, tmp, target, packed)
+        except BaseException:
+            await run_in_threadpool(_discard, f, tmp)
+            raise
+        return {"size": size, "mtime": st.st_mtime}
+
+    async def create_upload(self, path, size, part_size):
+        def _create():
+            _, tmp, fd = self._create_temp(path)
+            try:
+                if size:
+                    if hasattr(os, "posix_fallocate"):
+                        os.posix_fallocate(fd, 0, size)
+                    else:  # pragma: no cover
+                        os.ftruncate(fd, size)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            finally:
+                os.close(fd)
+            return dict(tmp=os.path.relpath(tmp, self.settings.root_dir))
+
+        return await run_in_threadpool(_create)
+
+    async def put_part(self, path, state, offset, chunks):
+        tmp = self._get_target(state["tmp"])
+        try:
+            fd = await run_in_threadpool(os.open, tmp, os.O_WRONLY)
+        except FileNotFoundError:
+            raise HTTPException(HTTP_404_NOT_FOUND, "upload not found")
+
+        def _write(data, pos):
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(fd, view, pos)
+                view = view[written:]
+                pos += written
+
+        try:
+            buf = bytearray()
+            async for chunk in chunks:
+                buf += chunk
+                if len(buf) >= BUFFER_SIZE:
+                    await run_in_threadpool(_write, buf, offset)
+                    offset += len(buf)
+                    buf = bytearray()
+            if buf:
+                await run_in_threadpool(_write, buf, offset)
+        finally:
+            os.close(fd)
+
+    async def complete_upload(self, path, state):
+        def _complete():
             target = self._get_target(path)
-            if os.path.exists(target):
-                if os.path.isdir(target):
+            tmp = self._get_target(state["tmp"])
+            if os.path.isdir(target):
+                raise HTTPException(HTTP_409_CONFLICT, "cannot overwrite folder")
+            if self.settings.compression is None:
+                try:
+                    self._commit(tmp, target, False)
+                except FileNotFoundError:
+                    raise HTTPException(HTTP_404_NOT_FOUND, "upload not found")
+                st = os.stat(target)
+                return {"size": st.st_size, "mtime": st.st_mtime}
+            try:
+                src = open(tmp, "rb")
+            except FileNotFoundError:
+                raise HTTPException(HTTP_404_NOT_FOUND, "upload not found")
+            with src:
+                _, packed, fd = self._create_temp(path)
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        out = self._packer(f)
+                        shutil.copyfileobj(src, out, BUFFER_SIZE)
+                        out.close()
+                    st = os.stat(packed)
+                    self._commit(packed, target, True)
+                except BaseException:
+                    os.unlink(packed)
+                    raise
+                size = os.fstat(src.fileno()).st_size
+            os.unlink(tmp)
+            return {"size": size, "mtime": st.st_mtime}
+
+        return await run_in_threadpool(_complete)
+
+    async def abort_upload(self, path, state):
+        try:
+            await run_in_threadpool(os.unlink, self._get_target(state["tmp"]))
+        except FileNotFoundError:
+            pass
+
+    async def transfer(self, path, target, target_path, move=False):
+        if not isinstance(target, FileSystemBucket):
+            return None
+
+        def _transfer():
+            stored, st, table = self._find(path)
+            _check_name(target_path)
+            dest = target._get_target(target_path)
+            if stat.S_ISDIR(st.st_mode):
+                if not move or any(
+                    os.path.lexists(p) for p in (dest, dest + PACKED_SUFFIX)
+                ):
+                    return None
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                os.rename(stored, dest)
+                return {}
+            if (table is None) != (target.settings.compression is None):
+                # streamed, to be compressed or decompressed
+                return None
+            if move:
+                if os.path.isdir(dest):
                     raise HTTPException(HTTP_409_CONFLICT, "cannot overwrite folder")
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                target._commit(stored, dest, table is not None)
             else:
-                os.makedirs(os.path.dirname(target), exist_ok=True)
-            size = 0
-            with open(target, "wb") as f:
-                while True:
-                    chunk = file.file.read(BUFFER_SIZE)
-                    if not chunk:
-                        break
-                    f.write(chunk)
-                    size += len(chunk)
-            return {"size": size}
-
-        return await run_in_threadpool(_put)
-
-    async def delete(self, path):
+                # compressed files are copied as they are
+                _, tmp, fd = target._create_temp(target_path)
+                os.close(fd)
+                try:
+                    _clone(stored, tmp)
+                    st = os.stat(tmp)
+                    target._commit(tmp, dest, table is not None)
+                except BaseException:
+                    os.unlink(tmp)
+                    raise
+            return {
+                "size": st.st_size if table is None else table.size,
+                "mtime": st.st_mtime,
+            }
+
+        try:
+            return await run_in_threadpool(_transfer)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                # on another file system, it's streamed instead
+                return None
+            raise
+
+    async def delete(self, path, job=None):
         target = self._get_target(path)
-        shutil.rmtree(target)
+        progress = {} if job is None else job.progress
+        progress.update(entries=0, bytes=0)
+
+        def _remove(path_, st):
+            if stat.S_ISDIR(st.st_mode):
+                os.rmdir(path_)
+            else:
+                os.unlink(path_)
+                progress["bytes"] += st.st_size
+            progress["entries"] += 1
+
+        def _delete():
+            try:
+                st = os.lstat(target)
+            except FileNotFoundError:
+                if self.settings.compression is None:
+                    raise HTTPException(HTTP_404_NOT_FOUND)
+                try:
+                    st = os.lstat(target + PACKED_SUFFIX)
+                except FileNotFoundError:
+                    raise HTTPException(HTTP_404_NOT_FOUND)
+                _remove(target + PACKED_SUFFIX, st)
+                return
+            if not stat.S_ISDIR(st.st_mode):
+                _remove(target, st)
+                return
+            for root, dirs, files in os.walk(target, topdown=False):
+                for name in files + dirs:
+                    if job is not None:
+                        job.token.check()
+                    entry = os.path.join(root, name)
+                    _remove(entry, os.lstat(entry))
+            if target.rstrip("/") != self.settings.root_dir.rstrip("/"):
+                _remove(target, st)
+
+        await run_in_threadpool(_delete)
@@ -1,18 +1,36 @@
 import asyncio
+import calendar
+import collections
+import json
 import mimetypes
 import os
+import posixpath
 import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+from functools import partial
 
 import aioftp
-from pydantic import BaseModel
+from fastapi import HTTPException
+from pydantic import BaseModel, Schema
 from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND, HTTP_409_CONFLICT
 
 from ..bucket import Bucket
+from ..cache import PathCache
+from ..responses import conditional_response
+from ...server import logger
 from ...server.app import app
 
 BUFFER_SIZE = 65536
-CACHE_TIME = 300
-_cache = {}
+STREAM_QUEUE_SIZE = 1024
+TEMP_SUFFIX = ".gen3-upload"
+_DONE = object()
+_CONNECTION_ERRORS = (OSError, EOFError, asyncio.TimeoutError, aioftp.StatusCodeError)
+_pools = {}
+_caches = {}
 
 
 class FtpSettings(BaseModel):
@@ -22,6 +40,22 @@ class FtpSettings(BaseModel):
     path: str = "/"
     user: str = aioftp.DEFAULT_USER
     password: str = aioftp.DEFAULT_PASSWORD
+    connect_timeout: float = Schema(10, gt=0)
+    pool_min_size: int = Schema(0, ge=0)
+    pool_max_size: int = Schema(4, gt=0)
+    pool_idle_timeout: float = Schema(300, gt=0)
+    pool_check_after: float = Schema(
+        30, ge=0, description="Idle seconds before a NOOP check on reuse"
+    )
+    list_concurrency: int = Schema(
+        4, gt=0, description="Folders listed in parallel in recursive listings"
+    )
+    cache_ttl: float = Schema(
+        30,
+        ge=0,
+        description="Seconds to cache stats, listings and previews, 0 to disable",
+    )
+    cache_size: int = Schema(10000, gt=0)
 
 
 class FtpBucket(Bucket):
@@ -29,125 +63,569 @@ class FtpBucket(Bucket):
 
     settings: FtpSettings = {}
 
-    async def get(self, path, recursive=True):
-        if self.name not in _cache:
-            _cache[self.name] = CachedFtpServer(self)
-        async with _cache[self.name] as client:
-            full_path = os.path.join(self.settings.path, path)
-            stat = await client.stat(full_path)
-            preview = files = None
-            if stat["type"] == "dir":
-                type_ = "Directory"
-                mime = "inode/directory"
-                files = []
-                async for item, props in client.list(full_path, recursive=recursive):
-                    files.append(
-                        dict(
-                            name=str(item.relative_to(full_path)),
-                            dir=props["type"] == "dir",
-                            size=props.get("size", 0),
-                            mtime=props["modify"],
-                            mime=mimetypes.guess_type(str(item), False)[0],
-                        )
-                    )
+    def _full_path(self, path):
+        return os.path.join(self.settings.path, path)
+
+    async def _stat(self, full_path, client=None):
+        cache = _get_cache(self)
+        rv = cache.get("stat", full_path)
+        if rv is None:
+            if client is None:
+                async with _get_pool(self).connection() as client:
+                    rv = await _stat(client, full_path)
             else:
-                await client.command("TYPE I", "200")
-                ip, port = await client._do_epsv()
-                if ip in ("0.0.0.0", None):
-                    ip = client.server_host
-
-                def get_bytes():
-                    s = socket.create_connection((ip, port), timeout=1)
-                    buf = s.recv(1024)
-                    s.close()
-                    # noinspection PyBroadException
-                    try:
-                        preview_ = buf.decode()
-                    except Exception:
-                        preview_ = None
-                    return self.guess_type(full_path, buf), preview_
-
-                fut = asyncio.ensure_future(run_in_threadpool(get_bytes))
-                await client.command(f"RETR {full_path}", "1xx")
-                (mime, type_), preview = await fut
-                await client.command(None, ["2xx", "451"], "1xx")
-
-            return dict(
-                name=path,
-                dir=stat["type"] == "dir",
-                size=stat.get("size", 0),
-                mtime=stat["modify"],
-                type=type_,
-                mime=mime,
-                files=files,
-                preview=preview,
+                rv = await _stat(client, full_path)
+            cache.set("stat", full_path, rv)
+        return rv
+
+    async def _head(self, full_path, stat):
+        """Return the first KiB of a file and its text preview."""
+        cache = _get_cache(self)
+        version = stat.get("size"), stat["modify"]
+        rv = cache.get("head", full_path)
+        if rv is not None and rv[0] == version:
+            return rv[1:]
+        async with _get_pool(self).connection() as client:
+            await client.command("TYPE I", "200")
+            ip, port = await client._do_epsv()
+            if ip in ("0.0.0.0", None):
+                ip = client.server_host
+
+            def get_bytes():
+                s = socket.create_connection((ip, port), timeout=1)
+                buf = s.recv(1024)
+                s.close()
+                # noinspection PyBroadException
+                try:
+                    preview_ = buf.decode()
+                except Exception:
+                    preview_ = None
+                return buf, preview_
+
+            fut = asyncio.ensure_future(run_in_threadpool(get_bytes))
+            await client.command(f"RETR {full_path}", "1xx")
+            buf, preview = await fut
+            await client.command(None, ["2xx", "451"], "1xx")
+        cache.set("head", full_path, (version, buf, preview))
+        return buf, preview
+
+    async def stat(self, path):
+        stat = await self._stat(self._full_path(path))
+        return dict(
+            name=path,
+            dir=stat["type"] == "dir",
+            size=_size(stat),
+            mtime=_mtime(stat),
+        )
+
+    async def get(
+        self,
+        path,
+        recursive=True,
+        max_depth=None,
+        limit=None,
+        cursor=None,
+        stream=False,
+        token=None,
+    ):
+        pool = _get_pool(self)
+        full_path = self._full_path(path)
+        stat = await self._stat(full_path)
+        preview = files = next_cursor = None
+        if stat["type"] == "dir":
+            type_ = "Directory"
+            mime = "inode/directory"
+            if not recursive:
+                max_depth = 1
+            after = tuple(cursor.split("/")) if cursor else None
+            entries = _walk(
+                pool,
+                _get_cache(self),
+                full_path,
+                max_depth,
+                after,
+                self.settings.list_concurrency,
+                token,
+            )
+            if stream and limit is None and cursor is None:
+                # no pagination, so entries can go out as soon as they arrive
+                return StreamingResponse(
+                    (
+                        json.dumps(_entry(key, props)) + "\n"
+                        async for key, props in entries
+                    ),
+                    media_type="application/x-ndjson",
+                )
+            keyed = [(key, props) async for key, props in entries]
+            keyed.sort(key=lambda x: x[0])
+            files = [_entry(key, props) for key, props in keyed[:limit]]
+            if stream:
+                return StreamingResponse(
+                    (json.dumps(entry) + "\n" for entry in files),
+                    media_type="application/x-ndjson",
+                )
+            if limit is not None and len(files) == limit:
+                next_cursor = files[-1]["name"]
+        else:
+            buf, preview = await self._head(full_path, stat)
+            mime, type_ = await self.detect_type(
+                full_path, buf, version=(stat.get("size"), stat["modify"])
             )
 
-    async def download(self, path):
-        pass
+        return dict(
+            name=path,
+            dir=stat["type"] == "dir",
+            size=_size(stat),
+            mtime=_mtime(stat),
+            type=type_,
+            mime=mime,
+            files=files,
+            next_cursor=next_cursor,
+            preview=preview,
+        )
 
-    async def put(self, path, file):
-        pass
+    async def download(self, path, headers=None, archive="tar"):
+        stat = await self.stat(path)
+        if stat["dir"]:
+            raise HTTPException(
+                HTTP_400_BAD_REQUEST, "folder downloads are not supported over FTP"
+            )
+        size, mtime = stat["size"], stat["mtime"]
+        media_type = mimetypes.guess_type(path)[0]
 
-    async def delete(self, path):
-        pass
+        def full_response(headers):
+            headers["content-length"] = str(size)
+            return StreamingResponse(
+                self.read_range(path), media_type=media_type, headers=headers
+            )
 
+        return conditional_response(
+            headers or {},
+            size=size,
+            mtime=mtime,
+            etag=f'"{size:x}-{int(mtime * 1000):x}"',
+            read_range=partial(self.read_range, path),
+            full_response=full_response,
+            media_type=media_type,
+        )
 
-class CachedFtpServer:
-    def __init__(self, bucket: FtpBucket):
-        self._name = bucket.name
-        self._settings = bucket.settings
-        self._client = None
-        self._lock = asyncio.Lock()
-        self._expire = None
-        self._loop = asyncio.get_running_loop()
+    async def read_range(self, path, offset=0, length=None):
+        pool = _get_pool(self)
+        client = await pool.acquire()
+        stream = None
+        broken = True
+        try:
+            # REST makes the server start RETR at the offset
+            stream = await client.download_stream(self._full_path(path), offset=offset)
+            while length is None or length > 0:
+                size = BUFFER_SIZE if length is None else min(length, BUFFER_SIZE)
+                chunk = await stream.read(size)
+                if not chunk:
+                    break
+                if length is not None:
+                    length -= len(chunk)
+                yield chunk
+            if length is None:
+                await stream.finish()
+                stream = None
+                broken = False
+        finally:
+            if stream is not None:
+                # stopping a transfer halfway, at the end of the range or as
+                # the client went away, leaves an unknown number of replies
+                # behind, so the connection is not reused
+                stream.close()
+            pool.release(client, broken)
 
-    async def __aenter__(self):
-        await self._lock.acquire()
-        client = self._client
+    async def put(self, path, chunks):
+        full_path = self._full_path(path)
+        parent, name = posixpath.split(full_path)
+        tmp = posixpath.join(parent, f".{name}.{uuid.uuid4().hex}{TEMP_SUFFIX}")
+        pool = _get_pool(self)
+        async with pool.connection() as client:
+            try:
+                stat = await self._stat(full_path, client)
+            except HTTPException:
+                await client.make_directory(parent)
+            else:
+                if stat["type"] == "dir":
+                    raise HTTPException(HTTP_409_CONFLICT, "cannot overwrite folder")
+        client = await pool.acquire()
+        broken = True
+        size = 0
         try:
-            if client is None:
-                client = aioftp.Client()
-                await client.connect(self._settings.host, self._settings.port)
-                await client.login(
-                    self._settings.user, self._settings.password, aioftp.DEFAULT_ACCOUNT
-                )
-                self._client = client
-            if self._expire is not None:
-                self._expire.cancel()
-                self._expire = self._loop.call_later(
-                    CACHE_TIME, self._loop.create_task, self.close()
-                )
-            return client
+            stream = await client.upload_stream(tmp)
+            try:
+                async for chunk in chunks:
+                    await stream.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                stream.close()
+                raise
+            await stream.finish()
+            await _replace(client, tmp, full_path)
+            _get_cache(self).invalidate(full_path)
+            stat = await self._stat(full_path, client)
+            broken = False
+        except BaseException:
+            if broken:
+                asyncio.get_event_loop().create_task(self._remove_temp(tmp))
+            raise
+        finally:
+            pool.release(client, broken)
+        return {"size": size, "mtime": _mtime(stat)}
+
+    async def _remove_temp(self, tmp):
+        # noinspection PyBroadException
+        try:
+            async with _get_pool(self).connection() as client:
+                await client.remove_file(tmp)
         except Exception:
+            logger.warning("Failed to remove FTP upload leftover %s", tmp)
+
+    async def delete(self, path, job=None):
+        pool = _get_pool(self)
+        full_path = self._full_path(path)
+        progress = {} if job is None else job.progress
+        progress.update(entries=0, bytes=0)
+        stat = await self._stat(full_path)
+        try:
+            if stat["type"] == "dir":
+                await _remove_tree(pool, full_path, progress)
+            else:
+                await _remove_file(pool, full_path, stat, progress)
+        finally:
+            _get_cache(self).invalidate(full_path)
+
+    async def close(self):
+        cache = _caches.get(self.name)
+        if cache is not None and cache[0] == self.settings:
+            del _caches[self.name]
+        pool = _pools.get(self.name)
+        if pool is not None and pool.settings == self.settings:
+            del _pools[self.name]
+            await pool.close()
+
+
+async def _stat(client, path):
+    try:
+        return await client.stat(path)
+    except aioftp.StatusCodeError as e:
+        if any(code.matches("55x") for code in e.received_codes):
+            raise HTTPException(HTTP_404_NOT_FOUND)
+        raise
+
+
+async def _replace(client, source, target):
+    """Rename ``source`` to ``target``, replacing it if it exists.
+
+    Some servers refuse to rename over an existing file. The existing file is
+    then renamed aside first, and put back if the rename still fails, so it's
+    only removed once it has been replaced.
+    """
+    try:
+        await client.rename(source, target)
+    except aioftp.StatusCodeError as e:
+        if not any(
+            code.matches("550") or code.matches("553") for code in e.received_codes
+        ):
+            raise
+        try:
+            stat = await _stat(client, target)
+        except HTTPException:
+            raise e
+        if stat["type"] != "file":
+            raise
+        parent, name = posixpath.split(target)
+        aside = posixpath.join(parent, f".{name}.{uuid.uuid4().hex}{TEMP_SUFFIX}")
+        await client.rename(target, aside)
+        try:
+            await client.rename(source, target)
+        except BaseException:
+            await client.rename(aside, target)
+            raise
+        await client.remove_file(aside)
+
+
+def _entry(key, props):
+    return dict(
+        name="/".join(key),
+        dir=props["type"] == "dir",
+        size=_size(props),
+        mtime=_mtime(props),
+        mime=mimetypes.guess_type(key[-1], False)[0],
+    )
+
+
+async def _walk(
+    pool, cache, root, max_depth=None, after=None, concurrency=4, token=None
+):
+    """Yield ``(key, props)`` of everything under ``root``, as they are listed.
+
+    With ``after``, only entries sorting after that key are yielded.
+
+    Folders are listed with up to ``concurrency`` connections of ``pool`` at
+    once, so the time taken grows with the depth of the tree rather than the
+    number of folders. The order of entries is not defined.
+
+    Listing tasks outlive a consumer that stops iterating without closing the
+    walk, so they also stop once ``token`` is cancelled.
+    """
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    sem = asyncio.Semaphore(concurrency)
+    tasks = set()
+    pending = 0
+
+    async def list_dir(key):
+        try:
+            path = posixpath.join(root, *key)
+            entries = cache.get("list", path)
+            if entries is None:
+                async with sem:
+                    if token is not None:
+                        token.check(0)
+                    async with pool.connection() as client:
+                        entries = [
+                            (item.name, props)
+                            for item, props in await client.list(path)
+                            if not item.name.endswith(TEMP_SUFFIX)
+                            and props["type"] in ("dir", "file")
+                        ]
+                cache.set("list", path, entries)
+                for name, props in entries:
+                    cache.set("stat", posixpath.join(path, name), props)
+            for name, props in entries:
+                if token is not None:
+                    token.check()
+                child = key + (name,)
+                seen = after is not None and child <= after
+                if props["type"] == "dir" and (
+                    max_depth is None or len(child) < max_depth
+                ):
+                    # subtrees before the cursor are skipped unless it's in them
+                    if not seen or after[: len(child)] == child:
+                        schedule(child)
+                if not seen:
+                    await queue.put((child, props))
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await queue.put(_DONE)
+
+    def schedule(key):
+        nonlocal pending
+        pending += 1
+        task = loop.create_task(list_dir(key))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    schedule(())
+    try:
+        while pending:
+            item = await queue.get()
+            if item is _DONE:
+                pending -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        for task in list(tasks):
+            task.cancel()
+
+
+def _size(props):
+    return int(props.get("size", 0))
+
+
+def _mtime(props):
+    # MLSx "modify" facts are UTC, like 20191231235959 or 20191231235959.123
+    value = props["modify"]
+    seconds, _, fraction = value.partition(".")
+    rv = calendar.timegm(time.strptime(seconds, "%Y%m%d%H%M%S"))
+    return rv + float("0." + fraction) if fraction else float(rv)
+
+
+async def _remove_tree(pool, path, progress):
+    """Remove a folder recursively, spreading the commands over the pool."""
+    async with pool.connection() as client:
+        entries = await client.list(path)
+    results = await asyncio.gather(
+        *(
+            (
+                _remove_tree(pool, item, progress)
+                if info["type"] == "dir"
+                else _remove_file(pool, item, info, progress)
+            )
+            for item, info in entries
+            if info["type"] in ("dir", "file")
+        ),
+        return_exceptions=True,
+    )
+    for rv in results:
+        if isinstance(rv, BaseException):
+            raise rv
+    async with pool.connection() as client:
+        await client.remove_directory(path)
+    progress["entries"] += 1
+
+
+async def _remove_file(pool, path, props, progress):
+    async with pool.connection() as client:
+        await client.remove_file(path)
+    progress["entries"] += 1
+    progress["bytes"] += _size(props)
+
+
+class FtpPool:
+    """A pool of logged-in FTP control connections to one server.
+
+    Up to ``pool_max_size`` connections are used concurrently. Idle ones are
+    checked with ``NOOP`` before reuse and closed after ``pool_idle_timeout``,
+    keeping ``pool_min_size`` of them warm. A connection failing with anything
+    other than an FTP status code is dropped alone, the pool carries on.
+    """
+
+    def __init__(self, settings: FtpSettings):
+        self.settings = settings
+        self._idle = collections.deque()
+        self._sem = asyncio.Semaphore(settings.pool_max_size)
+        self._size = 0
+        self._closed = False
+        self._reaper = asyncio.get_event_loop().create_task(self._reap())
+
+    async def _connect(self):
+        client = aioftp.Client()
+        try:
+            await asyncio.wait_for(
+                client.connect(self.settings.host, self.settings.port),
+                self.settings.connect_timeout,
+            )
+            await asyncio.wait_for(
+                client.login(
+                    self.settings.user, self.settings.password, aioftp.DEFAULT_ACCOUNT
+                ),
+                self.settings.connect_timeout,
+            )
+        except BaseException:
             client.close()
-            self._lock.release()
             raise
+        self._size += 1
+        return client
 
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        self._lock.release()
-        if exc_val is not None:
-            await self.close()
+    def _discard(self, client):
+        self._size -= 1
+        client.close()
 
-    async def close(self):
-        async with self._lock:
-            client, self._client = self._client, None
-            if self._expire is not None:
-                self._expire.cancel()
-                self._expire = None
-            _cache.pop(self._name, None)
-            if client:
-                # noinspection PyBroadException
+    async def _healthy(self, client):
+        try:
+            await asyncio.wait_for(
+                client.command("NOOP", "2xx"), self.settings.connect_timeout
+            )
+        except aioftp.StatusCodeError:
+            # any answer means the connection is alive
+            pass
+        except _CONNECTION_ERRORS:
+            return False
+        return True
+
+    async def acquire(self):
+        await self._sem.acquire()
+        try:
+            while self._idle:
+                client, last_used = self._idle.pop()
+                if time.monotonic() - last_used < self.settings.pool_check_after:
+                    return client
+                if await self._healthy(client):
+                    return client
+                self._discard(client)
+            return await self._connect()
+        except BaseException:
+            self._sem.release()
+            raise
+
+    def release(self, client, broken=False):
+        if broken or self._closed:
+            self._discard(client)
+        else:
+            self._idle.append((client, time.monotonic()))
+        self._sem.release()
+
+    @asynccontextmanager
+    async def connection(self):
+        client = await self.acquire()
+        broken = True
+        try:
+            yield client
+            broken = False
+        except (aioftp.StatusCodeError, HTTPException):
+            # the server answered, so the connection itself is fine
+            broken = False
+            raise
+        finally:
+            self.release(client, broken)
+
+    async def _reap(self):
+        interval = self.settings.pool_idle_timeout / 2
+        while True:
+            await asyncio.sleep(interval)
+            expire = time.monotonic() - self.settings.pool_idle_timeout
+            while (
+                self._idle
+                and self._size > self.settings.pool_min_size
+                and self._idle[0][1] < expire
+            ):
+                self._discard(self._idle.popleft()[0])
+            while self._size < self.settings.pool_min_size:
                 try:
-                    await asyncio.wait_for(client.quit(), 0.1)
-                except Exception:
-                    pass
+                    client = await self._connect()
+                except _CONNECTION_ERRORS:
+                    logger.warning("Failed to connect to FTP server", exc_info=True)
+                    break
+                self._idle.appendleft((client, time.monotonic()))
+
+    async def close(self):
+        self._closed = True
+        self._reaper.cancel()
+        while self._idle:
+            client = self._idle.pop()[0]
+            # noinspection PyBroadException
+            try:
+                await asyncio.wait_for(client.quit(), 0.1)
+            except Exception:
+                self._discard(client)
+            else:
+                self._size -= 1
+
+
+def _get_cache(bucket):
+    cache = _caches.get(bucket.name)
+    if cache is None or cache[0] != bucket.settings:
+        settings = bucket.settings
+        cache = _caches[bucket.name] = (
+            settings,
+            PathCache(settings.cache_size, settings.cache_ttl),
+        )
+    return cache[1]
+
+
+def _get_pool(bucket):
+    pool = _pools.get(bucket.name)
+    if pool is not None and pool.settings != bucket.settings:
+        # the bucket was reconfigured
+        asyncio.get_event_loop().create_task(pool.close())
+        pool = None
+    if pool is None:
+        pool = _pools[bucket.name] = FtpPool(bucket.settings)
+    return pool
 
 
 @app.on_event("shutdown")
-async def clear_ftp_cache():
+async def clear_ftp_pools():
+    _caches.clear()
     fs = []
-    while _cache:
-        client = _cache.popitem()[1]
-        fs.append(client.close())
-    await asyncio.wait(fs)
+    while _pools:
+        fs.append(_pools.popitem()[1].close())
+    if fs:
+        await asyncio.wait(fs)
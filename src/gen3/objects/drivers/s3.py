@@ -0,0 +1,716 @@
+import asyncio
+import base64
+import calendar
+import hashlib
+import hmac
+import json
+import mimetypes
+import posixpath
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from functools import partial
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+import aiohttp
+from fastapi import HTTPException
+from pydantic import BaseModel, Schema
+from starlette.responses import RedirectResponse, StreamingResponse
+from starlette.status import (
+    HTTP_400_BAD_REQUEST,
+    HTTP_404_NOT_FOUND,
+    HTTP_409_CONFLICT,
+    HTTP_422_UNPROCESSABLE_ENTITY,
+    HTTP_502_BAD_GATEWAY,
+)
+from yarl import URL
+
+from .flat import cursor_after, limited, walk_keys
+from ..bucket import Bucket
+from ..mime import HEAD_SIZE, preview
+from ..responses import conditional_response
+from ...server import logger
+from ...server.app import app
+
+BUFFER_SIZE = 65536
+MAX_PARTS = 10000
+MIN_PART_SIZE = 5 * 1024 ** 2
+MAX_DELETE_KEYS = 1000
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+_NS = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+_sessions = {}
+
+
+class S3Settings(BaseModel):
+    bucket: str = Schema(..., title="S3 Bucket")
+    prefix: str = Schema("", description="Key prefix of the objects of this bucket")
+    region: str = "us-east-1"
+    endpoint_url: str = Schema(
+        None, description="Like http://localhost:9000 for MinIO, defaults to AWS"
+    )
+    virtual_host: bool = Schema(
+        False, description="Address the S3 bucket as a subdomain of the endpoint"
+    )
+    access_key_id: str = None
+    secret_access_key: str = None
+    session_token: str = None
+    connect_timeout: float = Schema(10, gt=0)
+    pool_size: int = Schema(32, gt=0, description="Max concurrent HTTP connections")
+    part_size: int = Schema(8 * 1024 ** 2, ge=MIN_PART_SIZE)
+    concurrency: int = Schema(
+        8, gt=0, description="Parts sent or fetched in parallel per transfer"
+    )
+    presign_threshold: int = Schema(
+        None,
+        ge=0,
+        description="Redirect downloads of this many bytes or more to presigned URLs",
+    )
+    presign_expires: int = Schema(3600, gt=0, le=604800)
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode(), hashlib.sha256).digest()
+
+
+def _quote(value, safe="-_.~"):
+    return quote(value, safe=safe)
+
+
+def _parse_iso(value):
+    # like 2019-12-31T23:59:59.000Z, S3 keeps whole seconds only
+    return float(calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")))
+
+
+class S3Client:
+    """Signs (AWS Signature Version 4) and sends requests to one S3 bucket."""
+
+    def __init__(self, settings: S3Settings):
+        self.settings = settings
+        endpoint = urlsplit(
+            settings.endpoint_url or f"https://s3.{settings.region}.amazonaws.com"
+        )
+        if settings.virtual_host:
+            self._host = f"{settings.bucket}.{endpoint.netloc}"
+            self._base = ""
+        else:
+            self._host = endpoint.netloc
+            self._base = "/" + _quote(settings.bucket)
+        self._origin = f"{endpoint.scheme}://{self._host}"
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=settings.pool_size),
+            timeout=aiohttp.ClientTimeout(sock_connect=settings.connect_timeout),
+            auto_decompress=False,
+        )
+
+    def _path(self, key):
+        return self._base + "/" + _quote(key, safe="/-_.~")
+
+    def _signing_key(self, date):
+        key = _hmac(f"AWS4{self.settings.secret_access_key}".encode(), date)
+        for part in (self.settings.region, "s3", "aws4_request"):
+            key = _hmac(key, part)
+        return key
+
+    def _sign(self, method, path, query, headers, payload_hash, amz_date):
+        """Return the signature and the signed header names of a request."""
+        canonical_query = "&".join(
+            f"{_quote(k)}={_quote(v)}"
+            for k, v in sorted((str(k), str(v)) for k, v in query.items())
+        )
+        names = sorted(headers)
+        canonical_request = "\n".join(
+            [
+                method,
+                path,
+                canonical_query,
+                "".join(f"{name}:{str(headers[name]).strip()}\n" for name in names),
+                ";".join(names),
+                payload_hash,
+            ]
+        )
+        date = amz_date[:8]
+        scope = f"{date}/{self.settings.region}/s3/aws4_request"
+        to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256",
+                amz_date,
+                scope,
+                hashlib.sha256(canonical_request.encode()).hexdigest(),
+            ]
+        )
+        signature = hmac.new(
+            self._signing_key(date), to_sign.encode(), hashlib.sha256
+        ).hexdigest()
+        return signature, scope, ";".join(names)
+
+    def _url(self, path, query):
+        rv = self._origin + path
+        if query:
+            rv += "?" + "&".join(
+                f"{_quote(str(k))}={_quote(str(v))}" if v != "" else _quote(str(k))
+                for k, v in query.items()
+            )
+        return rv
+
+    def presign(self, method, key, expires, params=None):
+        """Return a URL for anyone to run ``method`` on ``key`` until it expires."""
+        path = self._path(key)
+        query = dict(params or {})
+        if self.settings.access_key_id:
+            amz_date = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+            query.update(
+                {
+                    "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+                    "X-Amz-Credential": f"{self.settings.access_key_id}/"
+                    f"{amz_date[:8]}/{self.settings.region}/s3/aws4_request",
+                    "X-Amz-Date": amz_date,
+                    "X-Amz-Expires": expires,
+                    "X-Amz-SignedHeaders": "host",
+                }
+            )
+            if self.settings.session_token:
+                query["X-Amz-Security-Token"] = self.settings.session_token
+            query["X-Amz-Signature"] = self._sign(
+                method, path, query, dict(host=self._host), UNSIGNED_PAYLOAD, amz_date
+            )[0]
+        return self._url(path, query)
+
+    @asynccontextmanager
+    async def request(self, method, key="", query=None, headers=None, data=None):
+        """Send a request, raising ``HTTPException`` on errors.
+
+        Payloads are not signed, the transport takes care of their integrity.
+        """
+        path = self._path(key)
+        query = query or {}
+        headers = dict(headers or {})
+        if self.settings.access_key_id:
+            amz_date = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+            signed = {
+                "host": self._host,
+                "x-amz-date": amz_date,
+                "x-amz-content-sha256": UNSIGNED_PAYLOAD,
+            }
+            if self.settings.session_token:
+                signed["x-amz-security-token"] = self.settings.session_token
+            signature, scope, names = self._sign(
+                method, path, query, signed, UNSIGNED_PAYLOAD, amz_date
+            )
+            del signed["host"]
+            headers.update(signed)
+            headers["authorization"] = (
+                f"AWS4-HMAC-SHA256 "
+                f"Credential={self.settings.access_key_id}/{scope}, "
+                f"SignedHeaders={names}, Signature={signature}"
+            )
+        try:
+            async with self.session.request(
+                method,
+                URL(self._url(path, query), encoded=True),
+                headers=headers,
+                data=data,
+            ) as resp:
+                if resp.status >= 400:
+                    await _raise_for_error(resp)
+                yield resp
+        except aiohttp.ClientError as e:
+            raise HTTPException(HTTP_502_BAD_GATEWAY, f"S3 request failed: {e!r}")
+
+    async def fetch_xml(self, method, key="", query=None, headers=None, data=None):
+        async with self.request(method, key, query, headers, data) as resp:
+            body = await resp.read()
+        rv = ElementTree.fromstring(body)
+        if rv.tag == "Error":
+            # CompleteMultipartUpload may fail after a 200 OK
+            raise HTTPException(
+                HTTP_502_BAD_GATEWAY,
+                f"S3 {rv.findtext('Code')}: {rv.findtext('Message')}",
+            )
+        return rv
+
+    async def close(self):
+        await self.session.close()
+
+
+async def _raise_for_error(resp):
+    if resp.status == HTTP_404_NOT_FOUND:
+        raise HTTPException(HTTP_404_NOT_FOUND)
+    code = message = None
+    body = await resp.read()
+    if body:
+        try:
+            error = ElementTree.fromstring(body)
+        except ElementTree.ParseError:
+            pass
+        else:
+            code, message = error.findtext("Code"), error.findtext("Message")
+    raise HTTPException(
+        HTTP_502_BAD_GATEWAY, f"S3 {code or resp.status}: {message or resp.reason}"
+    )
+
+
+def _get_client(bucket):
+    client = _sessions.get(bucket.name)
+    if client is not None and client.settings != bucket.settings:
+        # the bucket was reconfigured
+        asyncio.get_event_loop().create_task(client.close())
+        client = None
+    if client is None:
+        client = _sessions[bucket.name] = S3Client(bucket.settings)
+    return client
+
+
+@app.on_event("shutdown")
+async def close_s3_sessions():
+    fs = []
+    while _sessions:
+        fs.append(_sessions.popitem()[1].close())
+    if fs:
+        await asyncio.wait(fs)
+
+
+class S3Bucket(Bucket):
+    """Amazon S3 or compatible object storage bucket."""
+
+    settings: S3Settings = {}
+
+    @property
+    def _client(self):
+        return _get_client(self)
+
+    def _key(self, path):
+        return posixpath.join(self.settings.prefix, path.lstrip("/"))
+
+    def _dir_prefix(self, path):
+        key = self._key(path).rstrip("/")
+        return key + "/" if key else ""
+
+    async def _head(self, path):
+        async with self._client.request("HEAD", self._key(path)) as resp:
+            return dict(
+                size=int(resp.headers["content-length"]),
+                mtime=parsedate_to_datetime(resp.headers["last-modified"]).timestamp(),
+                etag=resp.headers.get("etag"),
+            )
+
+    async def _is_dir(self, path):
+        page = await self._client.fetch_xml(
+            "GET", "", {"list-type": 2, "prefix": self._dir_prefix(path), "max-keys": 1}
+        )
+        return page.find(f"{_NS}Contents") is not None
+
+    async def stat(self, path):
+        if path.strip("/"):
+            if not path.endswith("/"):
+                try:
+                    rv = await self._head(path)
+                except HTTPException as e:
+                    if e.status_code != HTTP_404_NOT_FOUND:
+                        raise
+                else:
+                    return dict(
+                        name=path, dir=False, size=rv["size"], mtime=rv["mtime"]
+                    )
+            # folders only exist as the common prefix of the keys in them
+            if not await self._is_dir(path):
+                raise HTTPException(HTTP_404_NOT_FOUND)
+        return dict(name=path, dir=True, size=0, mtime=None)
+
+    async def _list(self, prefix, start_after=None, delimiter=None):
+        """Yield pages of ``ListObjectsV2`` as ``(key, size, mtime)`` sorted by key.
+
+        Common prefixes are included with a ``size`` of ``None``.
+        """
+        query = {"list-type": 2, "prefix": prefix}
+        if start_after:
+            query["start-after"] = start_after
+        if delimiter:
+            query["delimiter"] = delimiter
+        while True:
+            page = await self._client.fetch_xml("GET", "", query)
+            items = [
+                (
+                    item.findtext(f"{_NS}Key"),
+                    int(item.findtext(f"{_NS}Size")),
+                    _parse_iso(item.findtext(f"{_NS}LastModified")),
+                )
+                for item in page.iterfind(f"{_NS}Contents")
+            ]
+            items.extend(
+                (item.findtext(f"{_NS}Prefix"), None, None)
+                for item in page.iterfind(f"{_NS}CommonPrefixes")
+            )
+            items.sort(key=lambda item: item[0])
+            yield items
+            token = page.findtext(f"{_NS}NextContinuationToken")
+            if page.findtext(f"{_NS}IsTruncated") != "true" or not token:
+                break
+            query.pop("start-after", None)
+            query["continuation-token"] = token
+
+    def _walk(self, path, max_depth=None, cursor=None, token=None):
+        prefix = self._dir_prefix(path)
+        pages = self._list(
+            prefix,
+            start_after=prefix + cursor if cursor else None,
+            delimiter="/" if max_depth == 1 else None,
+        )
+        return walk_keys(pages, prefix, max_depth, cursor, token)
+
+    async def get(
+        self,
+        path,
+        recursive=True,
+        max_depth=None,
+        limit=None,
+        cursor=None,
+        stream=False,
+        token=None,
+    ):
+        stat = await self.stat(path)
+        preview_ = files = next_cursor = None
+        if stat["dir"]:
+            type_ = "Directory"
+            mime = "inode/directory"
+            if not recursive:
+                max_depth = 1
+            entries = self._walk(path, max_depth, cursor, token)
+            if limit is not None:
+                entries = limited(entries, limit)
+            if stream:
+                return StreamingResponse(
+                    (json.dumps(entry) + "\n" async for entry in entries),
+                    media_type="application/x-ndjson",
+                )
+            files = [entry async for entry in entries]
+            next_cursor = cursor_after(files, limit)
+        else:
+            head = b""
+            if stat["size"]:
+                async with self._client.request(
+                    "GET",
+                    self._key(path),
+                    headers=dict(range=f"bytes=0-{HEAD_SIZE - 1}"),
+                ) as resp:
+                    head = await resp.read()
+            preview_ = preview(head)
+            mime, type_ = await self.detect_type(
+                path, head, version=(stat["size"], stat["mtime"])
+            )
+
+        return dict(
+            name=path,
+            dir=stat["dir"],
+            size=stat["size"],
+            mtime=stat["mtime"],
+            type=type_,
+            mime=mime,
+            files=files,
+            next_cursor=next_cursor,
+            preview=preview_,
+        )
+
+    async def download(self, path, headers=None, archive="tar"):
+        stat = await self.stat(path)
+        if stat["dir"]:
+            raise HTTPException(
+                HTTP_400_BAD_REQUEST, "folder downloads are not supported over S3"
+            )
+        size, mtime = stat["size"], stat["mtime"]
+        threshold = self.settings.presign_threshold
+        if threshold is not None and size >= threshold:
+            # S3 serves the bytes, ranges and conditional requests itself
+            return RedirectResponse(
+                self._client.presign(
+                    "GET", self._key(path), self.settings.presign_expires
+                )
+            )
+        media_type = mimetypes.guess_type(path)[0]
+
+        def full_response(headers):
+            headers["content-length"] = str(size)
+            return StreamingResponse(
+                self.read_range(path, 0, size), media_type=media_type, headers=headers
+            )
+
+        return conditional_response(
+            headers or {},
+            size=size,
+            mtime=mtime,
+            etag=f'"{size:x}-{int(mtime * 1000):x}"',
+            read_range=partial(self.read_range, path),
+            full_response=full_response,
+            media_type=media_type,
+        )
+
+    async def _read(self, key, start, stop, headers=None):
+        headers = dict(headers or {}, range=f"bytes={start}-{stop - 1}")
+        async with self._client.request("GET", key, headers=headers) as resp:
+            async for chunk in resp.content.iter_chunked(BUFFER_SIZE):
+                yield chunk
+
+    async def _read_part(self, key, start, stop, etag):
+        # If-Match makes sure all parts come from the same version
+        headers = {"if-match": etag} if etag else None
+        rv = bytearray()
+        async for chunk in self._read(key, start, stop, headers):
+            rv += chunk
+        return rv
+
+    async def read_range(self, path, offset=0, length=None):
+        key = self._key(path)
+        part_size = self.settings.part_size
+        etag = None
+        if length is None or length > part_size:
+            stat = await self._head(path)
+            etag = stat["etag"]
+            if length is None:
+                length = max(stat["size"] - offset, 0)
+        stop = offset + length
+        if length <= part_size:
+            if length > 0:
+                async for chunk in self._read(key, offset, stop):
+                    yield chunk
+            return
+
+        # large reads go as parallel ranged GETs, each in memory once fetched
+        loop = asyncio.get_event_loop()
+        starts = iter(range(offset, stop, part_size))
+        tasks = []
+        try:
+            for start in starts:
+                tasks.append(
+                    loop.create_task(
+                        self._read_part(key, start, min(start + part_size, stop), etag)
+                    )
+                )
+                if len(tasks) >= self.settings.concurrency:
+                    break
+            while tasks:
+                data = await tasks.pop(0)
+                start = next(starts, None)
+                if start is not None:
+                    tasks.append(
+                        loop.create_task(
+                            self._read_part(
+                                key, start, min(start + part_size, stop), etag
+                            )
+                        )
+                    )
+                for pos in range(0, len(data), BUFFER_SIZE):
+                    yield bytes(data[pos : pos + BUFFER_SIZE])
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _upload_part(self, key, upload_id, number, data, length=None):
+        # S3 takes no chunked bodies, streamed ones need their length upfront
+        headers = None if length is None else {"content-length": str(length)}
+        async with self._client.request(
+            "PUT",
+            key,
+            {"partNumber": number, "uploadId": upload_id},
+            headers=headers,
+            data=data,
+        ) as resp:
+            return resp.headers["etag"]
+
+    async def _create_multipart(self, key):
+        rv = await self._client.fetch_xml("POST", key, {"uploads": ""})
+        return rv.findtext(f"{_NS}UploadId")
+
+    async def _complete_multipart(self, key, upload_id, etags):
+        body = "".join(
+            f"<Part><PartNumber>{number}</PartNumber><ETag>{escape(etag)}</ETag></Part>"
+            for number, etag in sorted(etags.items())
+        )
+        await self._client.fetch_xml(
+            "POST",
+            key,
+            {"uploadId": upload_id},
+            data=f"<CompleteMultipartUpload>{body}</CompleteMultipartUpload>",
+        )
+
+    async def _abort_multipart(self, key, upload_id):
+        # noinspection PyBroadException
+        try:
+            async with self._client.request("DELETE", key, {"uploadId": upload_id}):
+                pass
+        except Exception:
+            logger.warning("Failed to abort S3 multipart upload of %s", key)
+
+    async def put(self, path, chunks):
+        key = self._key(path)
+        if await self._is_dir(path):
+            raise HTTPException(HTTP_409_CONFLICT, "cannot overwrite folder")
+        part_size = self.settings.part_size
+        buf = bytearray()
+        size = 0
+        chunks = chunks.__aiter__()
+        eof = False
+
+        async def fill():
+            nonlocal eof, size
+            while len(buf) < part_size:
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    eof = True
+                    break
+                buf.extend(chunk)
+                size += len(chunk)
+
+        await fill()
+        if eof:
+            async with self._client.request("PUT", key, data=buf):
+                pass
+            return dict(size=size, mtime=(await self._head(path))["mtime"])
+
+        # parts go out in parallel while the next ones are received, up to
+        # concurrency parts are held in memory
+        upload_id = await self._create_multipart(key)
+        loop = asyncio.get_event_loop()
+        sem = asyncio.Semaphore(self.settings.concurrency)
+        tasks = {}
+
+        async def send(number, data):
+            try:
+                return await self._upload_part(key, upload_id, number, data)
+            finally:
+                sem.release()
+
+        try:
+            number = 0
+            while buf:
+                await sem.acquire()
+                for task in tasks.values():
+                    if task.done() and task.exception():
+                        raise task.exception()
+                number += 1
+                tasks[number] = loop.create_task(send(number, buf[:part_size]))
+                del buf[:part_size]
+                if not eof:
+                    await fill()
+            etags = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+            await self._complete_multipart(key, upload_id, etags)
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            loop.create_task(self._abort_multipart(key, upload_id))
+            raise
+        return dict(size=size, mtime=(await self._head(path))["mtime"])
+
+    async def _delete_keys(self, keys):
+        body = "".join(
+            f"<Object><Key>{escape(key)}</Key></Object>" for key in keys
+        ).join(["<Delete><Quiet>true</Quiet>", "</Delete>"])
+        md5 = base64.b64encode(hashlib.md5(body.encode()).digest()).decode()
+        rv = await self._client.fetch_xml(
+            "POST", "", {"delete": ""}, {"content-md5": md5}, body
+        )
+        error = rv.find(f"{_NS}Error")
+        if error is not None:
+            raise HTTPException(
+                HTTP_502_BAD_GATEWAY,
+                f"S3 {error.findtext(f'{_NS}Code')}: "
+                f"{error.findtext(f'{_NS}Message')}",
+            )
+
+    async def delete(self, path, job=None):
+        progress = {} if job is None else job.progress
+        progress.update(entries=0, bytes=0)
+        stat = await self.stat(path)
+        if not stat["dir"]:
+            async with self._client.request("DELETE", self._key(path)):
+                pass
+            progress.update(entries=1, bytes=stat["size"])
+            return
+        async for items in self._list(self._dir_prefix(path)):
+            if job is not None:
+                job.token.check()
+            for pos in range(0, len(items), MAX_DELETE_KEYS):
+                batch = items[pos : pos + MAX_DELETE_KEYS]
+                await self._delete_keys([key for key, _, _ in batch])
+                progress["entries"] += len(batch)
+                progress["bytes"] += sum(size for _, size, _ in batch)
+
+    async def create_upload(self, path, size, part_size):
+        if size > part_size and part_size < MIN_PART_SIZE:
+            # S3 only rejects the small parts when the upload is completed
+            raise HTTPException(
+                HTTP_422_UNPROCESSABLE_ENTITY,
+                [dict(loc=["part_size"], msg=f"must be at least {MIN_PART_SIZE}")],
+            )
+        # S3 part numbers only need to ascend, so they are derived from the
+        # offsets, in units small enough to keep parts apart
+        return dict(
+            upload_id=await self._create_multipart(self._key(path)),
+            unit=max(1, -(-size // MAX_PARTS)),
+            size=size,
+            part_size=part_size,
+        )
+
+    async def put_part(self, path, state, offset, chunks):
+        error = None
+
+        async def body():
+            nonlocal error
+            try:
+                async for chunk in chunks:
+                    yield chunk
+            except Exception as e:
+                # the transport wraps it, it's raised as is below
+                error = e
+                raise
+
+        # parts are streamed through, so the part size doesn't set the memory
+        # taken by a request
+        length = min(state["part_size"], state["size"] - offset)
+        try:
+            await self._upload_part(
+                self._key(path),
+                state["upload_id"],
+                offset // state["unit"] + 1,
+                body(),
+                length,
+            )
+        except HTTPException:
+            if error is not None:
+                raise error
+            raise
+
+    async def complete_upload(self, path, state):
+        key = self._key(path)
+        etags = {}
+        query = {"uploadId": state["upload_id"]}
+        while True:
+            page = await self._client.fetch_xml("GET", key, query)
+            for part in page.iterfind(f"{_NS}Part"):
+                etags[int(part.findtext(f"{_NS}PartNumber"))] = part.findtext(
+                    f"{_NS}ETag"
+                )
+            if page.findtext(f"{_NS}IsTruncated") != "true":
+                break
+            query["part-number-marker"] = page.findtext(f"{_NS}NextPartNumberMarker")
+        await self._complete_multipart(key, state["upload_id"], etags)
+        stat = await self._head(path)
+        return {"size": stat["size"], "mtime": stat["mtime"]}
+
+    async def abort_upload(self, path, state):
+        try:
+            async with self._client.request(
+                "DELETE", self._key(path), {"uploadId": state["upload_id"]}
+            ):
+                pass
+        except HTTPException as e:
+            if e.status_code != HTTP_404_NOT_FOUND:
+                raise
+
+    async def close(self):
+        client = _sessions.get(self.name)
+        if client is not None and client.settings == self.settings:
+            del _sessions[self.name]
+            await client.close()
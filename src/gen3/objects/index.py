@@ -0,0 +1,385 @@
+import base64
+import hashlib
+import posixpath
+import time
+
+from . import usage
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+SCHEMA = """\
+    type Object {
+        required property bucket -> str;
+        required property path -> str;
+        required property key -> str {
+            constraint exclusive;
+        }
+        property ext -> str;
+        property size -> int64;
+        property mtime -> float64;
+        property mime -> str;
+        property md5 -> str;
+        property sha256 -> str;
+        property crc32c -> str;
+        property indexed -> float64;
+
+        index object_bucket on (__subject__.bucket);
+        index object_path on (__subject__.path);
+        index object_ext on (__subject__.ext);
+        index object_mime on (__subject__.mime);
+        index object_size on (__subject__.size);
+        index object_mtime on (__subject__.mtime);
+        index object_indexed on (__subject__.indexed);
+    }
+"""
+HEAD_SIZE = 8192
+_FIELDS = dict(
+    size="int64", mtime="float64", mime="str", md5="str", sha256="str", crc32c="str"
+)
+_SEARCH_FIELDS = "bucket, path, " + ", ".join(_FIELDS)
+_DIGESTS = (("MD5", "md5"), ("SHA-256", "sha256"))
+
+
+class Hasher:
+    """Computes content digests incrementally over uploaded chunks."""
+
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256()
+        self._crc32c = 0
+        self.size = 0
+        self.head = bytearray()
+
+    def update(self, chunk):
+        self._md5.update(chunk)
+        self._sha256.update(chunk)
+        if crc32c is not None:
+            self._crc32c = crc32c.crc32c(chunk, self._crc32c)
+        if len(self.head) < HEAD_SIZE:
+            self.head += chunk[: HEAD_SIZE - len(self.head)]
+        self.size += len(chunk)
+
+    async def wrap(self, chunks):
+        async for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+    def digests(self):
+        return dict(
+            md5=self._md5.hexdigest(),
+            sha256=self._sha256.hexdigest(),
+            crc32c=None if crc32c is None else f"{self._crc32c:08x}",
+        )
+
+
+def _key(bucket_name, path):
+    return f"{bucket_name}/{path}"
+
+
+def _ext(path):
+    return posixpath.splitext(path)[1].lstrip(".").lower()
+
+
+def _like_prefix(prefix):
+    for char in "\\%_":
+        prefix = prefix.replace(char, "\\" + char)
+    return prefix + "%"
+
+
+async def record(conn, bucket_name, path, **values):
+    """Create or replace the index entry of an object."""
+    values = {
+        field: value
+        for field, value in values.items()
+        if field in _FIELDS and value is not None
+    }
+    sets = "".join(f"{field} := <{_FIELDS[field]}>${field},\n" for field in values)
+    async with conn.transaction():
+        old = await conn.fetchall(
+            "SELECT (DELETE objects::Object FILTER .key = <str>$key) { size }",
+            key=_key(bucket_name, path),
+        )
+        await usage.add(
+            conn,
+            bucket_name,
+            path,
+            values.get("size", 0) - sum(obj.size or 0 for obj in old),
+            1 - len(old),
+        )
+        await conn.fetchall(
+            f"""
+            INSERT objects::Object {{
+                bucket := <str>$bucket,
+                path := <str>$path,
+                key := <str>$key,
+                ext := <str>$ext,
+                indexed := <float64>$indexed,
+                {sets}}}
+            """,
+            bucket=bucket_name,
+            path=path,
+            key=_key(bucket_name, path),
+            ext=_ext(path),
+            indexed=time.time(),
+            **values,
+        )
+
+
+async def lookup(conn, bucket_name, path):
+    rv = await conn.fetchall(
+        f"""
+        SELECT objects::Object {{ {', '.join(_FIELDS)} }}
+        FILTER .key = <str>$key
+        """,
+        key=_key(bucket_name, path),
+    )
+    if rv:
+        return {field: getattr(rv[0], field) for field in _FIELDS}
+
+
+async def forget(conn, bucket_name, path=""):
+    """Remove the index entries of ``path`` and everything under it."""
+    prefix = path.rstrip("/") + "/" if path.strip("/") else ""
+    async with conn.transaction():
+        rv = await conn.fetchall(
+            """
+            SELECT (
+                DELETE objects::Object
+                FILTER .bucket = <str>$bucket AND (
+                    .path = <str>$path OR .path[:<int64>$length] = <str>$prefix
+                )
+            ) { size }
+            """,
+            bucket=bucket_name,
+            path=path,
+            length=len(prefix),
+            prefix=prefix,
+        )
+        await usage.forget(
+            conn, bucket_name, path, sum(obj.size or 0 for obj in rv), len(rv)
+        )
+
+
+async def move(conn, bucket_name, path, new_bucket_name, new_path):
+    """Move the index entries under folder ``path`` to folder ``new_path``.
+
+    Names and so extensions are kept, and neither path may be the root of its
+    bucket. Entries already under ``new_path`` are replaced.
+    """
+    path = path.rstrip("/")
+    new_path = new_path.rstrip("/")
+    async with conn.transaction():
+        await forget(conn, new_bucket_name, new_path)
+        rv = await conn.fetchall(
+            """
+            SELECT (
+                UPDATE objects::Object
+                FILTER .bucket = <str>$bucket AND (
+                    .path = <str>$path OR .path[:<int64>$length] = <str>$prefix
+                )
+                SET {
+                    bucket := <str>$new_bucket,
+                    path := <str>$new_path ++ .path[<int64>$length - 1:],
+                    key := <str>$new_key ++ .path[<int64>$length - 1:],
+                }
+            ) { size }
+            """,
+            bucket=bucket_name,
+            path=path,
+            length=len(path) + 1,
+            prefix=path + "/",
+            new_bucket=new_bucket_name,
+            new_path=new_path,
+            new_key=_key(new_bucket_name, new_path),
+        )
+        await usage.move(
+            conn,
+            bucket_name,
+            path,
+            new_bucket_name,
+            new_path,
+            sum(obj.size or 0 for obj in rv),
+            len(rv),
+        )
+
+
+async def refresh(conn, bucket_name, files, indexed):
+    """Bring the index entries of crawled ``files`` up to date.
+
+    ``files`` are listing entries with ``name``, ``size``, ``mtime`` and
+    ``mime``. Entries still matching the files are only marked as seen at
+    ``indexed``, keeping their digests; the others are replaced. Returns the
+    number of replaced entries.
+    """
+    files = {_key(bucket_name, f["name"]): f for f in files}
+    async with conn.transaction():
+        existing = await conn.fetchall(
+            """
+            SELECT objects::Object { key, size, mtime }
+            FILTER .key IN array_unpack(<array<str>>$keys)
+            """,
+            keys=list(files),
+        )
+        fresh = [
+            obj.key
+            for obj in existing
+            if matches(dict(size=obj.size, mtime=obj.mtime), files[obj.key])
+        ]
+        await conn.fetchall(
+            """
+            UPDATE objects::Object
+            FILTER .key IN array_unpack(<array<str>>$keys)
+            SET { indexed := <float64>$indexed }
+            """,
+            keys=fresh,
+            indexed=indexed,
+        )
+        for key in fresh:
+            del files[key]
+        await conn.fetchall(
+            "DELETE objects::Object FILTER .key IN array_unpack(<array<str>>$keys)",
+            keys=list(files),
+        )
+        for key, f in files.items():
+            await conn.fetchall(
+                """
+                INSERT objects::Object {
+                    bucket := <str>$bucket,
+                    path := <str>$path,
+                    key := <str>$key,
+                    ext := <str>$ext,
+                    size := <int64>$size,
+                    mtime := <float64>$mtime,
+                    mime := <str>$mime,
+                    indexed := <float64>$indexed,
+                }
+                """,
+                bucket=bucket_name,
+                path=f["name"],
+                key=key,
+                ext=_ext(f["name"]),
+                size=f["size"],
+                mtime=f["mtime"],
+                mime=f.get("mime") or "",
+                indexed=indexed,
+            )
+    return len(files)
+
+
+async def prune(conn, bucket_name, indexed):
+    """Remove entries of ``bucket_name`` not seen since ``indexed``."""
+    rv = await conn.fetchall(
+        """
+        DELETE objects::Object
+        FILTER .bucket = <str>$bucket AND .indexed < <float64>$indexed
+        """,
+        bucket=bucket_name,
+        indexed=indexed,
+    )
+    return len(rv)
+
+
+async def search(
+    conn,
+    *,
+    bucket=None,
+    prefix=None,
+    ext=None,
+    mime=None,
+    min_size=None,
+    max_size=None,
+    modified_after=None,
+    modified_before=None,
+    cursor=None,
+    limit=100,
+):
+    """Find indexed objects matching all the given criteria, ordered by key.
+
+    ``mime`` may end with ``/*`` to match a whole type. ``cursor`` is the key
+    of the last object of the previous page.
+    """
+    filters = []
+    args = {}
+    if bucket is not None:
+        filters.append(".bucket = <str>$bucket")
+        args["bucket"] = bucket
+    if prefix:
+        filters.append(".path LIKE <str>$prefix")
+        args["prefix"] = _like_prefix(prefix.lstrip("/"))
+    if ext is not None:
+        filters.append(".ext = <str>$ext")
+        args["ext"] = ext.lstrip(".").lower()
+    if mime is not None:
+        if mime.endswith("/*"):
+            filters.append(".mime LIKE <str>$mime")
+            args["mime"] = _like_prefix(mime[:-1])
+        else:
+            filters.append(".mime = <str>$mime")
+            args["mime"] = mime
+    if min_size is not None:
+        filters.append(".size >= <int64>$min_size")
+        args["min_size"] = min_size
+    if max_size is not None:
+        filters.append(".size <= <int64>$max_size")
+        args["max_size"] = max_size
+    if modified_after is not None:
+        filters.append(".mtime >= <float64>$modified_after")
+        args["modified_after"] = modified_after
+    if modified_before is not None:
+        filters.append(".mtime < <float64>$modified_before")
+        args["modified_before"] = modified_before
+    if cursor is not None:
+        filters.append(".key > <str>$cursor")
+        args["cursor"] = cursor
+    rv = await conn.fetchall(
+        f"""
+        SELECT objects::Object {{ key, {_SEARCH_FIELDS} }}
+        {"FILTER " + " AND ".join(filters) if filters else ""}
+        ORDER BY .key
+        LIMIT <int64>$limit
+        """,
+        limit=limit,
+        **args,
+    )
+    objects = [
+        {field: getattr(obj, field) for field in ["bucket", "path", *_FIELDS]}
+        for obj in rv
+    ]
+    next_cursor = rv[-1].key if len(rv) == limit else None
+    return objects, next_cursor
+
+
+def matches(info, stat):
+    """Whether an index entry still describes the object with ``stat``."""
+    return (
+        info is not None
+        and info["size"] == stat["size"]
+        and info["mtime"] == stat["mtime"]
+    )
+
+
+def parse_digest(value):
+    """Parse an RFC 3230 ``Digest`` header into hex digests by index field."""
+    rv = {}
+    for part in (value or "").split(","):
+        name, _, digest = part.strip().partition("=")
+        field = {name.lower(): field for name, field in _DIGESTS}.get(name.lower())
+        if field and digest:
+            try:
+                rv[field] = base64.b64decode(digest, validate=True).hex()
+            except ValueError:
+                pass
+    return rv
+
+
+def digest_header(info):
+    """Format the digests of an index entry as an RFC 3230 ``Digest`` header."""
+    parts = []
+    for name, field in _DIGESTS:
+        if info.get(field):
+            value = base64.b64encode(bytes.fromhex(info[field])).decode()
+            parts.append(f"{name}={value}")
+    return ",".join(parts)
@@ -0,0 +1,115 @@
+import asyncio
+import time
+import uuid
+
+from fastapi import HTTPException
+from starlette.status import HTTP_404_NOT_FOUND
+
+from .cache import TTLCache
+from .cancel import CancelToken
+from .server import mod
+from ..server import config, logger
+
+_jobs = TTLCache()
+
+
+class Job:
+    """A long-running task of this process, with progress that can be polled."""
+
+    def __init__(self, kind, **params):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.params = params
+        self.progress = {}
+        self.state = "running"
+        self.result = None
+        self.error = None
+        self.exception = None
+        self.token = CancelToken(kind)
+        self.created = time.time()
+        self.finished = None
+        self._task = None
+
+    @property
+    def done(self):
+        return self.state != "running"
+
+    @property
+    def cancelled(self):
+        return self.token.cancelled
+
+    def cancel(self):
+        if not self.done:
+            # driver code in threads cannot be cancelled, only told to stop
+            self.token.cancel()
+            self._task.cancel()
+
+    async def wait(self, timeout=None):
+        """Wait up to ``timeout`` seconds, returns whether the job is done."""
+        await asyncio.wait([self._task], timeout=timeout)
+        return self.done
+
+    async def _run(self, coro):
+        try:
+            self.result = await coro
+        except asyncio.CancelledError:
+            self.state = "cancelled"
+        except Exception as e:
+            self.state = "failed"
+            self.exception = e
+            self.error = getattr(e, "detail", None) or repr(e)
+            if not isinstance(e, HTTPException):
+                logger.exception("Job %s (%s) failed", self.id, self.kind)
+        else:
+            self.state = "done"
+        self.finished = time.time()
+        # finished jobs are kept for a while so clients can see how they ended
+        _jobs.set(self.id, self, ttl=config.OBJECTS_JOB_TTL)
+
+    def dict(self):
+        return dict(
+            id=self.id,
+            kind=self.kind,
+            params=self.params,
+            state=self.state,
+            progress=self.progress,
+            result=self.result,
+            error=self.error,
+            created=self.created,
+            finished=self.finished,
+        )
+
+
+def start_job(kind, func, *args, **params):
+    """Run ``func(job, *args)`` in the background as a new :class:`Job`."""
+    job = Job(kind, **params)
+    _jobs.set(job.id, job, ttl=None)
+    job._task = asyncio.get_event_loop().create_task(job._run(func(job, *args)))
+    return job
+
+
+def get_job(job_id):
+    return _jobs.get(job_id)
+
+
+@mod.get("/jobs")
+async def list_jobs():
+    return [job.dict() for job in list(_jobs.values())]
+
+
+@mod.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(HTTP_404_NOT_FOUND, f"job {job_id} not found")
+    return job.dict()
+
+
+@mod.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(HTTP_404_NOT_FOUND, f"job {job_id} not found")
+    job.cancel()
+    await job.wait()
+    return job.dict()
@@ -0,0 +1,54 @@
+import time
+
+import edgedb
+
+SCHEMA = """\
+    type Lease {
+        required property name -> str {
+            constraint exclusive;
+        }
+        required property expires -> float64;
+    }
+"""
+# how often workers check whether a periodic task is due
+POLL_INTERVAL = 60
+
+
+async def take(pool, name, ttl):
+    """Take the lease ``name`` for ``ttl`` seconds, unless it's still held.
+
+    Returns whether it was taken. A lease is never released: workers sharing
+    the database take turns running a periodic task, at most once every
+    ``ttl`` seconds, by taking its lease before each run.
+    """
+    now = time.time()
+    async with pool.acquire() as conn:
+        try:
+            if await conn.fetchall(
+                """
+                UPDATE objects::Lease
+                FILTER .name = <str>$name AND .expires <= <float64>$now
+                SET { expires := <float64>$expires }
+                """,
+                name=name,
+                now=now,
+                expires=now + ttl,
+            ):
+                return True
+            await conn.fetchall(
+                """
+                INSERT objects::Lease {
+                    name := <str>$name,
+                    expires := <float64>$expires,
+                }
+                """,
+                name=name,
+                expires=now + ttl,
+            )
+        except (
+            edgedb.ConstraintViolationError,
+            edgedb.TransactionSerializationError,
+        ):
+            # held, or just taken by another worker
+            return False
+    return True
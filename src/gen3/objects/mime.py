@@ -0,0 +1,108 @@
+import asyncio
+import codecs
+import mimetypes
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import magic
+except ImportError:
+    magic = None
+from starlette.concurrency import run_in_threadpool
+
+from .cache import TTLCache
+from ..server import config
+
+HEAD_SIZE = 65536
+PREVIEW_SIZE = 1024
+_WEAK_MIMES = [None, "text/plain", "application/x-empty", "application/octet-stream"]
+_cache = TTLCache(maxsize=config.OBJECTS_TYPE_CACHE_SIZE)
+_executor = None
+
+
+def read_head(path, size=HEAD_SIZE):
+    """Read the leading bytes of a file, or ``None`` if it cannot be read."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(size)
+    except OSError:
+        return None
+
+
+def preview(data):
+    """Decode the start of ``data`` as text, or ``None`` if it's not text."""
+    if data is None:
+        return None
+    try:
+        # incremental decoding tolerates a character cut at the end of the head
+        text = codecs.getincrementaldecoder("utf-8")().decode(data[: PREVIEW_SIZE * 4])
+    except UnicodeDecodeError:
+        return None
+    return text[:PREVIEW_SIZE]
+
+
+def guess_type(path=None, data=None):
+    """Guess ``(mime, type)`` from the leading bytes ``data`` of ``path``.
+
+    libmagic only looks at ``data``; without it, the head of ``path`` is read
+    once for both queries.
+    """
+    ext_mime = mimetypes.guess_type(path, False)[0] if path else None
+    mime = type_ = None
+    if magic:
+        if data is None and path:
+            data = read_head(path)
+        if data is not None:
+            type_ = magic.from_buffer(data)
+            mime = magic.from_buffer(data, mime=True)
+    if mime in _WEAK_MIMES and ext_mime:
+        mime = ext_mime
+    if not mime:
+        mime = "unknown"
+    if not type_:
+        type_ = mime
+    return mime, type_
+
+
+def start():
+    """Start the processes running libmagic, if it's there and they're wanted.
+
+    They're spawned afresh rather than forked, so they don't inherit the
+    event loop, database connections or locks held by other threads.
+    """
+    global _executor
+    if _executor is not None or not magic or config.OBJECTS_MAGIC_PROCESSES <= 0:
+        return
+    _executor = ProcessPoolExecutor(
+        config.OBJECTS_MAGIC_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+    )
+    # spawn the processes now rather than on the first request
+    _executor.submit(guess_type)
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+async def detect_type(path, data, key=None):
+    """Run :func:`guess_type` off the event loop, with an LRU cache.
+
+    ``key`` identifies the exact version of the object, like its bucket, path,
+    inode, size and mtime, so cached results never outlive a change.
+    """
+    if key is not None:
+        rv = _cache.get(key)
+        if rv is not None:
+            return rv
+    if _executor is None:
+        rv = await run_in_threadpool(guess_type, path, data)
+    else:
+        # libmagic is CPU-bound, keep it out of the shared threadpool
+        loop = asyncio.get_event_loop()
+        rv = await loop.run_in_executor(_executor, guess_type, path, data)
+    if key is not None:
+        _cache.set(key, rv)
+    return rv
@@ -0,0 +1,256 @@
+import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, Response
+from starlette.status import (
+    HTTP_206_PARTIAL_CONTENT,
+    HTTP_304_NOT_MODIFIED,
+    HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+)
+
+MAX_RANGES = 64
+PATHSEND = "http.response.pathsend"
+ZEROCOPYSEND = "http.response.zerocopysend"
+
+
+def make_etag(st):
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def _etag_matches(value, etag):
+    if value.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in value.split(",")]
+    weak = etag[2:] if etag.startswith("W/") else etag
+    return any((tag[2:] if tag.startswith("W/") else tag) == weak for tag in tags)
+
+
+def _parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def is_not_modified(headers, etag, mtime):
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    since = _parse_http_date(headers.get("if-modified-since"))
+    return since is not None and int(mtime) <= since
+
+
+def _if_range_matches(headers, etag, mtime):
+    value = headers.get("if-range")
+    if value is None:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith("W/"):
+        # weak validators never match If-Range
+        return not value.startswith("W/") and value == etag
+    since = _parse_http_date(value)
+    return since is not None and int(mtime) == since
+
+
+def parse_range(value, size):
+    """Parse a ``Range`` header into a list of ``(start, stop)`` byte offsets.
+
+    Returns ``None`` if the header should be ignored, in which case the full
+    content is served.
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    ranges = []
+    for part in spec.split(","):
+        first, sep, last = part.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                stop = int(last) + 1 if last else size
+                if last and start >= stop:
+                    return None
+            else:
+                start, stop = max(size - int(last), 0), size
+        except ValueError:
+            return None
+        if start < size and stop > start:
+            ranges.append((start, min(stop, size)))
+    if not ranges:
+        raise HTTPException(
+            HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            "range not satisfiable",
+            headers={"content-range": f"bytes */{size}"},
+        )
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+class RangeResponse(Response):
+    """A 206 response for one or more byte ranges read from ``read_range``.
+
+    ``read_range(offset, length)`` must return an async iterator of bytes.
+    Multiple ranges are sent as ``multipart/byteranges``.
+    """
+
+    def __init__(self, read_range, size, ranges, media_type=None, headers=None):
+        self.read_range = read_range
+        self.size = size
+        self.ranges = ranges
+        self.status_code = HTTP_206_PARTIAL_CONTENT
+        self.background = None
+        self.init_headers(headers)
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            self.parts = [(b"", start, stop)]
+            self.tail = b""
+            self.media_type = media_type
+            self.headers["content-range"] = f"bytes {start}-{stop - 1}/{size}"
+        else:
+            boundary = uuid.uuid4().hex
+            self.parts = []
+            for start, stop in ranges:
+                head = f"--{boundary}\r\n"
+                if media_type:
+                    head += f"Content-Type: {media_type}\r\n"
+                head += f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n"
+                if self.parts:
+                    head = "\r\n" + head
+                self.parts.append((head.encode("latin-1"), start, stop))
+            self.tail = f"\r\n--{boundary}--\r\n".encode("latin-1")
+            self.media_type = f"multipart/byteranges; boundary={boundary}"
+        if self.media_type is not None:
+            self.headers["content-type"] = self.media_type
+        self.headers["content-length"] = str(
+            sum(len(head) + stop - start for head, start, stop in self.parts)
+            + len(self.tail)
+        )
+
+    async def __call__(self, scope, receive, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        for head, start, stop in self.parts:
+            if head:
+                await send(
+                    {"type": "http.response.body", "body": head, "more_body": True}
+                )
+            async for chunk in self.read_range(start, stop - start):
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+        await send({"type": "http.response.body", "body": self.tail})
+        if self.background is not None:
+            await self.background()
+
+
+class SendfileResponse(FileResponse):
+    """Serve a whole file, letting the server send it without user-space copies.
+
+    If the ASGI server advertises the ``http.response.pathsend`` or
+    ``http.response.zerocopysend`` extension, the file is handed over by path or
+    by file descriptor so the server can ``sendfile()`` it. Otherwise it falls
+    back to :class:`FileResponse`, reading in larger chunks.
+    """
+
+    chunk_size = 262144
+
+    def __init__(self, path, *args, file=None, **kwargs):
+        super().__init__(path, *args, **kwargs)
+        # an already open ``file`` is sent instead, as ``path`` may be gone
+        self.file = file
+
+    async def _send_open_file(self, send, zerocopy):
+        size = self.stat_result.st_size
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if zerocopy:
+            await send({"type": ZEROCOPYSEND, "file": self.file, "count": size})
+        else:
+            fd = self.file.fileno()
+            offset = 0
+            more_body = True
+            while more_body:
+                chunk = await run_in_threadpool(os.pread, fd, self.chunk_size, offset)
+                offset += len(chunk)
+                more_body = bool(chunk) and offset < size
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": more_body,
+                    }
+                )
+
+    async def __call__(self, scope, receive, send):
+        extensions = scope.get("extensions") or {}
+        if self.file is not None and not self.send_header_only:
+            await self._send_open_file(send, ZEROCOPYSEND in extensions)
+            if self.background is not None:
+                await self.background()
+            return
+        if self.send_header_only or (
+            PATHSEND not in extensions and ZEROCOPYSEND not in extensions
+        ):
+            await super().__call__(scope, receive, send)
+            return
+
+        if self.stat_result is None:
+            self.stat_result = await run_in_threadpool(os.stat, self.path)
+            self.set_stat_headers(self.stat_result)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if PATHSEND in extensions:
+            await send({"type": PATHSEND, "path": self.path})
+        else:
+            f = await run_in_threadpool(open, self.path, "rb")
+            try:
+                await send(
+                    {"type": ZEROCOPYSEND, "file": f, "count": self.stat_result.st_size}
+                )
+            finally:
+                f.close()
+        if self.background is not None:
+            await self.background()
+
+
+def conditional_response(
+    headers, *, size, mtime, etag, read_range, full_response, media_type=None
+):
+    """Answer conditional and ``Range`` requests for a single object.
+
+    ``full_response(headers=...)`` builds the plain 200 response if no range applies.
+    """
+    validators = {
+        "etag": etag,
+        "last-modified": formatdate(mtime, usegmt=True),
+        "accept-ranges": "bytes",
+    }
+    if is_not_modified(headers, etag, mtime):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers=validators)
+    range_header = headers.get("range")
+    if range_header and _if_range_matches(headers, etag, mtime):
+        ranges = parse_range(range_header, size)
+        if ranges:
+            return RangeResponse(read_range, size, ranges, media_type, validators)
+    return full_response(headers=validators)
@@ -0,0 +1,125 @@
+import asyncio
+import collections
+import time
+from datetime import datetime
+
+from fastapi import Depends, Query
+from starlette.requests import Request
+from starlette.status import HTTP_202_ACCEPTED
+
+from . import index, lease, usage
+from .bucket import _get_bucket, installed_drivers, registry
+from .jobs import start_job
+from .server import mod
+from ..server import config, logger
+from ..server.app import app, db_pool
+
+_scanner = None
+
+
+@mod.get("/search")
+async def search_objects(
+    bucket: str = None,
+    prefix: str = None,
+    ext: str = None,
+    mime: str = None,
+    min_size: int = Query(None, ge=0),
+    max_size: int = Query(None, ge=0),
+    modified_after: datetime = None,
+    modified_before: datetime = None,
+    cursor: str = None,
+    limit: int = Query(100, gt=0, le=1000),
+    pool=Depends(db_pool),
+):
+    async with pool.acquire() as conn:
+        objects, next_cursor = await index.search(
+            conn,
+            bucket=bucket,
+            prefix=prefix,
+            ext=ext,
+            mime=mime,
+            min_size=min_size,
+            max_size=max_size,
+            modified_after=modified_after and modified_after.timestamp(),
+            modified_before=modified_before and modified_before.timestamp(),
+            cursor=cursor,
+            limit=limit,
+        )
+    return dict(objects=objects, next_cursor=next_cursor)
+
+
+async def _crawl(job, pool, bucket):
+    started = time.time()
+    job.progress.update(scanned=0, indexed=0, removed=0)
+    # bytes and files by folder, to reconcile the usage with
+    totals = collections.defaultdict(lambda: [0, 0])
+    cursor = None
+    while True:
+        rv = await bucket.get(
+            "", limit=config.OBJECTS_CRAWL_BATCH_SIZE, cursor=cursor, token=job.token
+        )
+        files = [f for f in rv["files"] if not f["dir"]]
+        for f in files:
+            for folder in usage.folders(f["name"]):
+                totals[folder][0] += f["size"]
+                totals[folder][1] += 1
+        async with pool.acquire() as conn:
+            job.progress["indexed"] += await index.refresh(
+                conn, bucket.name, files, started
+            )
+        job.progress["scanned"] += len(files)
+        cursor = rv["next_cursor"]
+        if cursor is None:
+            break
+    async with pool.acquire() as conn:
+        job.progress["removed"] = await index.prune(conn, bucket.name, started)
+        await usage.reset(conn, bucket.name, totals, started)
+    return job.progress
+
+
+@mod.post("/index/{bucket_name}", status_code=HTTP_202_ACCEPTED)
+async def crawl_bucket(
+    request: Request, bucket=Depends(_get_bucket), pool=Depends(db_pool)
+):
+    """Index the existing objects of a bucket in the background."""
+    job = start_job("crawl", _crawl, pool, bucket, bucket=bucket.name)
+    return dict(job.dict(), href=request.url_for("get_job_status", job_id=job.id))
+
+
+async def _crawl_all():
+    interval = config.OBJECTS_CRAWL_INTERVAL
+    while True:
+        await asyncio.sleep(min(interval, lease.POLL_INTERVAL))
+        try:
+            pool = await app.pool
+            # every worker runs this loop, only the one taking the lease crawls
+            if not await lease.take(pool, "objects.crawl", interval):
+                continue
+            async with pool.acquire() as conn:
+                buckets = await conn.fetchall(
+                    "SELECT objects::Bucket { name } FILTER .enabled"
+                )
+            for row in buckets:
+                bucket = await registry.get(pool, row.name)
+                if bucket is None or bucket.driver not in installed_drivers:
+                    continue
+                # one at a time, not to load the storage all at once
+                job = start_job("crawl", _crawl, pool, bucket, bucket=bucket.name)
+                await job.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Failed to crawl buckets")
+
+
+@app.on_event("startup")
+def start_crawling():
+    global _scanner
+    if config.OBJECTS_CRAWL_INTERVAL > 0:
+        _scanner = asyncio.get_event_loop().create_task(_crawl_all())
+
+
+@app.on_event("shutdown")
+def stop_crawling():
+    if _scanner is not None:
+        _scanner.cancel()
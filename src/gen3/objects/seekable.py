@@ -0,0 +1,150 @@
+"""The zstd seekable format: independent frames, followed by a table of them.
+
+Each frame holds up to ``frame_size`` bytes of content, so a range of it can be
+read by decompressing only the frames it spans. The table is a skippable frame,
+so the whole file is still a valid zstd stream for any decoder.
+"""
+
+import bisect
+import os
+import struct
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+_ENTRY = struct.Struct("<II")
+_FOOTER = struct.Struct("<IBI")
+_CHECKSUM_FLAG = 0x80
+
+
+class SeekTable:
+    """Compressed and content offsets of the frames in a seekable file."""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.offsets = []
+        self.positions = []
+        offset = position = 0
+        for c_size, d_size in frames:
+            self.offsets.append(offset)
+            self.positions.append(position)
+            offset += c_size
+            position += d_size
+        self.size = position
+
+    def span(self, start, stop):
+        """Return the indexes of the frames holding content ``start:stop``."""
+        if start >= stop:
+            return range(0)
+        first = bisect.bisect_right(self.positions, start) - 1
+        last = bisect.bisect_left(self.positions, stop)
+        return range(max(first, 0), last)
+
+
+def read_table(fd):
+    """Read the seek table at the end of the open file ``fd``.
+
+    Raises ``ValueError`` if the file isn't in the seekable format.
+    """
+    size = os.fstat(fd).st_size
+    if size < _FOOTER.size:
+        raise ValueError("not a seekable zstd file")
+    count, descriptor, magic = _FOOTER.unpack(
+        os.pread(fd, _FOOTER.size, size - _FOOTER.size)
+    )
+    if magic != SEEKABLE_MAGIC:
+        raise ValueError("not a seekable zstd file")
+    entry_size = _ENTRY.size + (4 if descriptor & _CHECKSUM_FLAG else 0)
+    table_size = 8 + count * entry_size + _FOOTER.size
+    if table_size > size:
+        raise ValueError("truncated seek table")
+    data = os.pread(fd, table_size - 8 - _FOOTER.size, size - table_size + 8)
+    return SeekTable([_ENTRY.unpack_from(data, i * entry_size) for i in range(count)])
+
+
+def read_frame(fd, table, index):
+    """Return the decompressed content of frame ``index``."""
+    c_size, d_size = table.frames[index]
+    data = os.pread(fd, c_size, table.offsets[index])
+    return zstandard.ZstdDecompressor().decompress(data, max_output_size=d_size)
+
+
+class SeekableWriter:
+    """Compress what's written to ``f`` into frames of ``frame_size`` bytes.
+
+    :meth:`close` writes the last frame and the seek table, but leaves ``f``
+    open. Writes block while frames are compressed, so use it in threads.
+    """
+
+    def __init__(self, f, level=3, frame_size=1024 ** 2):
+        self._f = f
+        self._cctx = zstandard.ZstdCompressor(level=level, write_checksum=True)
+        self._frame_size = frame_size
+        self._buf = bytearray()
+        self._frames = []
+
+    def _flush(self, data):
+        frame = self._cctx.compress(bytes(data))
+        self._f.write(frame)
+        self._frames.append((len(frame), len(data)))
+
+    def write(self, data):
+        self._buf += data
+        while len(self._buf) >= self._frame_size:
+            self._flush(self._buf[: self._frame_size])
+            del self._buf[: self._frame_size]
+        return len(data)
+
+    def close(self):
+        if self._buf or not self._frames:
+            self._flush(self._buf)
+            self._buf = bytearray()
+        entries = b"".join(_ENTRY.pack(*frame) for frame in self._frames)
+        footer = _FOOTER.pack(len(self._frames), 0, SEEKABLE_MAGIC)
+        self._f.write(
+            struct.pack("<II", SKIPPABLE_MAGIC, len(entries) + len(footer))
+            + entries
+            + footer
+        )
+
+
+class SeekableReader:
+    """Blocking file object over the content of a seekable file, for archives."""
+
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDONLY)
+        try:
+            self.table = read_table(self._fd)
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self._index = 0
+        self._buf = b""
+
+    @property
+    def size(self):
+        return self.table.size
+
+    def read(self, size=-1):
+        while (size is None or size < 0 or len(self._buf) < size) and (
+            self._index < len(self.table.frames)
+        ):
+            self._buf += read_frame(self._fd, self.table, self._index)
+            self._index += 1
+        if size is None or size < 0:
+            size = len(self._buf)
+        rv, self._buf = self._buf[:size], self._buf[size:]
+        return rv
+
+    def close(self):
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
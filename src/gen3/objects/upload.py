@@ -0,0 +1,309 @@
+import asyncio
+import datetime
+import json
+import uuid
+
+import edgedb
+from fastapi import Depends, HTTPException, Path
+from pydantic import BaseModel, Schema
+from starlette.requests import Request
+from starlette.status import (
+    HTTP_201_CREATED,
+    HTTP_204_NO_CONTENT,
+    HTTP_400_BAD_REQUEST,
+    HTTP_404_NOT_FOUND,
+    HTTP_409_CONFLICT,
+    HTTP_422_UNPROCESSABLE_ENTITY,
+)
+from starlette.responses import Response
+
+from . import index, usage
+from .bucket import _get_bucket, registry
+from .server import mod
+from ..server import config, logger
+from ..server.app import app, db_pool
+
+SCHEMA = """\
+    type Upload {
+        required property bucket -> str;
+        required property path -> str;
+        required property size -> int64;
+        required property part_size -> int64;
+        required property state -> json;
+        property created -> datetime {
+            default := datetime_current();
+        }
+    }
+
+    type UploadPart {
+        required link upload -> Upload;
+        required property number -> int64;
+        required property key -> str {
+            constraint exclusive;
+        }
+    }
+"""
+MAX_PARTS = 10000
+_expirer = None
+
+
+class CreateUpload(BaseModel):
+    size: int = Schema(..., ge=0)
+    part_size: int = Schema(None, gt=0)
+
+
+class _Upload:
+    def __init__(self, obj, bucket):
+        self.id = obj.id
+        self.bucket = bucket
+        self.path = obj.path
+        self.size = obj.size
+        self.part_size = obj.part_size
+        self.state = json.loads(obj.state)
+
+    @property
+    def parts(self):
+        return max(1, -(-self.size // self.part_size))
+
+    def part_range(self, number):
+        offset = (number - 1) * self.part_size
+        return offset, min(self.part_size, self.size - offset)
+
+
+async def _get_upload(upload_id: uuid.UUID, pool=Depends(db_pool)):
+    async with pool.acquire() as conn:
+        rv = await conn.fetchall(
+            """
+            SELECT objects::Upload {bucket, path, size, part_size, state}
+            FILTER .id = <uuid>$id
+            """,
+            id=upload_id,
+        )
+    if not rv:
+        raise HTTPException(HTTP_404_NOT_FOUND, f"upload {upload_id} not found")
+    bucket = await registry.get(pool, rv[0].bucket)
+    if bucket is None:
+        raise HTTPException(HTTP_404_NOT_FOUND, f"bucket {rv[0].bucket} not found")
+    return _Upload(rv[0], bucket)
+
+
+async def _received_parts(conn, upload_id):
+    rv = await conn.fetchall(
+        "SELECT objects::UploadPart { number } FILTER .upload.id = <uuid>$id",
+        id=upload_id,
+    )
+    return sorted(set(part.number for part in rv))
+
+
+async def _limit(chunks, length):
+    received = 0
+    async for chunk in chunks:
+        received += len(chunk)
+        if received > length:
+            raise HTTPException(
+                HTTP_400_BAD_REQUEST, f"part is larger than {length} bytes"
+            )
+        yield chunk
+    if received != length:
+        raise HTTPException(
+            HTTP_400_BAD_REQUEST, f"expected {length} bytes, got {received}"
+        )
+
+
+@mod.post("/buckets/{bucket_name}/{path:path}", status_code=HTTP_201_CREATED)
+async def create_upload(
+    upload: CreateUpload,
+    request: Request,
+    path: str = None,
+    bucket=Depends(_get_bucket),
+    pool=Depends(db_pool),
+):
+    part_size = upload.part_size or config.OBJECTS_UPLOAD_PART_SIZE
+    parts = max(1, -(-upload.size // part_size))
+    if parts > MAX_PARTS:
+        raise HTTPException(
+            HTTP_422_UNPROCESSABLE_ENTITY,
+            [dict(loc=["part_size"], msg=f"too many parts: {parts} > {MAX_PARTS}")],
+        )
+    await usage.check_quota(pool, bucket, upload.size)
+    state = await bucket.create_upload(path, upload.size, part_size)
+    try:
+        async with pool.acquire() as conn:
+            rv = await conn.fetchone(
+                """
+                INSERT objects::Upload {
+                    bucket := <str>$bucket,
+                    path := <str>$path,
+                    size := <int64>$size,
+                    part_size := <int64>$part_size,
+                    state := to_json(<str>$state),
+                }
+                """,
+                bucket=bucket.name,
+                path=path,
+                size=upload.size,
+                part_size=part_size,
+                state=json.dumps(state),
+            )
+    except BaseException:
+        await bucket.abort_upload(path, state)
+        raise
+    return dict(
+        id=str(rv.id),
+        part_size=part_size,
+        parts=parts,
+        href=request.url_for("get_upload", upload_id=str(rv.id)),
+    )
+
+
+@mod.get("/uploads/{upload_id}")
+async def get_upload(upload=Depends(_get_upload), pool=Depends(db_pool)):
+    async with pool.acquire() as conn:
+        received = await _received_parts(conn, upload.id)
+    return dict(
+        id=str(upload.id),
+        bucket=upload.bucket.name,
+        path=upload.path,
+        size=upload.size,
+        part_size=upload.part_size,
+        parts=upload.parts,
+        received=received,
+        missing=sorted(set(range(1, upload.parts + 1)) - set(received)),
+    )
+
+
+@mod.put("/uploads/{upload_id}/{part_number}")
+async def put_upload_part(
+    request: Request,
+    part_number: int = Path(..., gt=0),
+    upload=Depends(_get_upload),
+    pool=Depends(db_pool),
+):
+    if part_number > upload.parts:
+        raise HTTPException(HTTP_404_NOT_FOUND, f"upload has only {upload.parts} parts")
+    offset, length = upload.part_range(part_number)
+    await upload.bucket.put_part(
+        upload.path, upload.state, offset, _limit(request.stream(), length)
+    )
+    async with pool.acquire() as conn:
+        try:
+            await conn.fetchall(
+                """
+                INSERT objects::UploadPart {
+                    upload := (
+                        SELECT objects::Upload FILTER .id = <uuid>$id LIMIT 1
+                    ),
+                    number := <int64>$number,
+                    key := <str>$key,
+                }
+                """,
+                id=upload.id,
+                number=part_number,
+                key=f"{upload.id}/{part_number}",
+            )
+        except edgedb.ConstraintViolationError:
+            # the part was uploaded before, and has just been rewritten in place
+            pass
+    return dict(number=part_number, size=length)
+
+
+async def _delete_upload(conn, upload_id):
+    async with conn.transaction():
+        await conn.fetchall(
+            "DELETE objects::UploadPart FILTER .upload.id = <uuid>$id", id=upload_id
+        )
+        await conn.fetchall(
+            "DELETE objects::Upload FILTER .id = <uuid>$id", id=upload_id
+        )
+
+
+@mod.post("/uploads/{upload_id}")
+async def complete_upload(upload=Depends(_get_upload), pool=Depends(db_pool)):
+    async with pool.acquire() as conn:
+        received = await _received_parts(conn, upload.id)
+    missing = sorted(set(range(1, upload.parts + 1)) - set(received))
+    if missing:
+        raise HTTPException(
+            HTTP_409_CONFLICT, dict(msg="upload is incomplete", missing=missing)
+        )
+    rv = await upload.bucket.complete_upload(upload.path, upload.state)
+    async with pool.acquire() as conn:
+        await _delete_upload(conn, upload.id)
+        # parts may arrive in any order, so there are no content digests here
+        await index.record(conn, upload.bucket.name, upload.path, **rv)
+    return rv
+
+
+@mod.delete("/uploads/{upload_id}", status_code=HTTP_204_NO_CONTENT)
+async def abort_upload(upload=Depends(_get_upload), pool=Depends(db_pool)):
+    await upload.bucket.abort_upload(upload.path, upload.state)
+    async with pool.acquire() as conn:
+        await _delete_upload(conn, upload.id)
+    return Response(status_code=HTTP_204_NO_CONTENT)
+
+
+async def expire_uploads(pool):
+    """Abort the uploads created more than ``OBJECTS_UPLOAD_TTL`` seconds ago.
+
+    Each one is claimed by deleting it first, so workers expiring at the same
+    time don't abort the same upload twice.
+    """
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+        seconds=config.OBJECTS_UPLOAD_TTL
+    )
+    async with pool.acquire() as conn:
+        expired = await conn.fetchall(
+            "SELECT objects::Upload { id } FILTER .created < <datetime>$cutoff",
+            cutoff=cutoff,
+        )
+    count = 0
+    for row in expired:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.fetchall(
+                    "DELETE objects::UploadPart FILTER .upload.id = <uuid>$id",
+                    id=row.id,
+                )
+                rv = await conn.fetchall(
+                    """
+                    SELECT (
+                        DELETE objects::Upload FILTER .id = <uuid>$id
+                    ) { bucket, path, state }
+                    """,
+                    id=row.id,
+                )
+        if not rv:
+            continue
+        count += 1
+        bucket = await registry.get(pool, rv[0].bucket)
+        if bucket is None:
+            continue
+        try:
+            await bucket.abort_upload(rv[0].path, json.loads(rv[0].state))
+        except Exception:
+            logger.warning("Failed to abort expired upload %s", row.id, exc_info=True)
+    return count
+
+
+async def _expire_all():
+    while True:
+        await asyncio.sleep(config.OBJECTS_UPLOAD_EXPIRE_INTERVAL)
+        try:
+            await expire_uploads(await app.pool)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Failed to expire uploads")
+
+
+@app.on_event("startup")
+def start_upload_expiry():
+    global _expirer
+    if config.OBJECTS_UPLOAD_EXPIRE_INTERVAL > 0:
+        _expirer = asyncio.get_event_loop().create_task(_expire_all())
+
+
+@app.on_event("shutdown")
+def stop_upload_expiry():
+    if _expirer is not None:
+        _expirer.cancel()
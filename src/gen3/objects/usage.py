@@ -0,0 +1,361 @@
+import asyncio
+import collections
+import posixpath
+import time
+
+from fastapi import Depends, HTTPException
+from starlette.status import HTTP_507_INSUFFICIENT_STORAGE
+
+from . import lease
+from .server import mod
+from ..server import config, logger
+from ..server.app import app, db_pool
+
+SCHEMA = """\
+    type Usage {
+        required property bucket -> str;
+        required property path -> str;
+        required property key -> str {
+            constraint exclusive;
+        }
+        required property parent -> str;
+        property bytes -> int64;
+        property files -> int64;
+
+        index usage_bucket on (__subject__.bucket);
+        index usage_parent on (__subject__.parent);
+    }
+
+    type UsageDelta {
+        required property bucket -> str;
+        required property path -> str;
+        required property key -> str;
+        required property parent -> str;
+        property bytes -> int64;
+        property files -> int64;
+        property created -> float64;
+
+        index usage_delta_bucket on (__subject__.bucket);
+        index usage_delta_key on (__subject__.key);
+        index usage_delta_parent on (__subject__.parent);
+    }
+"""
+_TYPES = ("objects::Usage", "objects::UsageDelta")
+_compactor = None
+
+
+def _key(bucket_name, folder):
+    return f"{bucket_name}/{folder}"
+
+
+def _parent_key(bucket_name, folder):
+    return _key(bucket_name, posixpath.dirname(folder)) if folder else ""
+
+
+def folders(path):
+    """Return the folders holding ``path``, from the bucket root down."""
+    parts = path.strip("/").split("/")[:-1]
+    return [""] + ["/".join(parts[: i + 1]) for i in range(len(parts))]
+
+
+async def add(conn, bucket_name, path, bytes_, files):
+    """Count ``bytes_`` and ``files`` more in the folders holding ``path``.
+
+    Changes are kept as deltas, which concurrent writers insert without
+    conflicting on the same totals, and :func:`compact` folds them later.
+    """
+    if not bytes_ and not files:
+        return
+    now = time.time()
+    for folder in folders(path):
+        await conn.fetchall(
+            """
+            INSERT objects::UsageDelta {
+                bucket := <str>$bucket,
+                path := <str>$path,
+                key := <str>$key,
+                parent := <str>$parent,
+                bytes := <int64>$bytes,
+                files := <int64>$files,
+                created := <float64>$created,
+            }
+            """,
+            bucket=bucket_name,
+            path=folder,
+            key=_key(bucket_name, folder),
+            parent=_parent_key(bucket_name, folder),
+            bytes=bytes_,
+            files=files,
+            created=now,
+        )
+
+
+async def forget(conn, bucket_name, path, bytes_, files):
+    """Drop the usage under ``path``, which held ``bytes_`` and ``files``."""
+    path = path.strip("/")
+    prefix = _key(bucket_name, path + "/" if path else "")
+    for type_ in _TYPES:
+        await conn.fetchall(
+            f"""
+            DELETE {type_}
+            FILTER .bucket = <str>$bucket AND (
+                .key = <str>$key OR .key[:<int64>$length] = <str>$prefix
+            )
+            """,
+            bucket=bucket_name,
+            key=_key(bucket_name, path),
+            length=len(prefix),
+            prefix=prefix,
+        )
+    if path:
+        await add(conn, bucket_name, path, -bytes_, -files)
+
+
+async def move(conn, bucket_name, path, new_bucket_name, new_path, bytes_, files):
+    """Move the usage of folder ``path``, which holds ``bytes_`` and ``files``.
+
+    Nothing must be left at ``new_path``.
+    """
+    path = path.strip("/")
+    new_path = new_path.strip("/")
+    key = _key(bucket_name, path)
+    new_key = _key(new_bucket_name, new_path)
+    for type_ in _TYPES:
+        await conn.fetchall(
+            f"""
+            UPDATE {type_}
+            FILTER .bucket = <str>$bucket AND (
+                .key = <str>$key OR .key[:<int64>$length] = <str>$prefix
+            )
+            SET {{
+                bucket := <str>$new_bucket,
+                path := <str>$new_path ++ .path[<int64>$path_length:],
+                key := <str>$new_key ++ .key[<int64>$length - 1:],
+                parent := <str>$new_key ++ .parent[<int64>$length - 1:],
+            }}
+            """,
+            bucket=bucket_name,
+            key=key,
+            length=len(key) + 1,
+            prefix=key + "/",
+            path_length=len(path),
+            new_bucket=new_bucket_name,
+            new_path=new_path,
+            new_key=new_key,
+        )
+        # the folder itself was in another one
+        await conn.fetchall(
+            f"UPDATE {type_} FILTER .key = <str>$key SET {{ parent := <str>$parent }}",
+            key=new_key,
+            parent=_parent_key(new_bucket_name, new_path),
+        )
+    await add(conn, bucket_name, path, -bytes_, -files)
+    await add(conn, new_bucket_name, new_path, bytes_, files)
+
+
+async def get_usage(conn, bucket_name, path=""):
+    """Return the usage of folder ``path``, with that of the folders in it."""
+    path = path.strip("/")
+    key = _key(bucket_name, path)
+    totals = collections.defaultdict(lambda: [0, 0])
+    for type_ in _TYPES:
+        rows = await conn.fetchall(
+            f"""
+            SELECT {type_} {{ path, key, bytes, files }}
+            FILTER .key = <str>$key OR .parent = <str>$key
+            """,
+            key=key,
+        )
+        for row in rows:
+            total = totals[row.path]
+            total[0] += row.bytes or 0
+            total[1] += row.files or 0
+    bytes_, files = totals.pop(path, (0, 0))
+    return dict(
+        bytes=bytes_,
+        files=files,
+        folders=[
+            dict(name=name, bytes=total[0], files=total[1])
+            for name, total in sorted(totals.items())
+            if total[1] > 0
+        ],
+    )
+
+
+async def compact(conn, bucket_name):
+    """Fold the usage deltas of ``bucket_name`` into its totals."""
+    async with conn.transaction():
+        deltas = await conn.fetchall(
+            """
+            SELECT objects::UsageDelta { id, path, key, parent, bytes, files }
+            FILTER .bucket = <str>$bucket
+            """,
+            bucket=bucket_name,
+        )
+        if not deltas:
+            return 0
+        changes = {}
+        for delta in deltas:
+            change = changes.setdefault(delta.key, [delta, 0, 0])
+            change[1] += delta.bytes or 0
+            change[2] += delta.files or 0
+        existing = await conn.fetchall(
+            """
+            SELECT objects::Usage { key }
+            FILTER .key IN array_unpack(<array<str>>$keys)
+            """,
+            keys=list(changes),
+        )
+        existing = {row.key for row in existing}
+        for key, (delta, bytes_, files) in changes.items():
+            if key in existing:
+                await conn.fetchall(
+                    """
+                    UPDATE objects::Usage FILTER .key = <str>$key SET {
+                        bytes := .bytes + <int64>$bytes,
+                        files := .files + <int64>$files,
+                    }
+                    """,
+                    key=key,
+                    bytes=bytes_,
+                    files=files,
+                )
+            else:
+                await conn.fetchall(
+                    """
+                    INSERT objects::Usage {
+                        bucket := <str>$bucket,
+                        path := <str>$path,
+                        key := <str>$key,
+                        parent := <str>$parent,
+                        bytes := <int64>$bytes,
+                        files := <int64>$files,
+                    }
+                    """,
+                    bucket=bucket_name,
+                    path=delta.path,
+                    key=key,
+                    parent=delta.parent,
+                    bytes=bytes_,
+                    files=files,
+                )
+        await conn.fetchall(
+            "DELETE objects::UsageDelta FILTER .id IN array_unpack(<array<uuid>>$ids)",
+            ids=[delta.id for delta in deltas],
+        )
+        await conn.fetchall(
+            "DELETE objects::Usage FILTER .bucket = <str>$bucket AND .files <= 0",
+            bucket=bucket_name,
+        )
+    return len(deltas)
+
+
+async def reset(conn, bucket_name, totals, started):
+    """Replace the usage of ``bucket_name`` with ``totals`` of a scan.
+
+    ``totals`` maps folders to ``[bytes, files]``. Deltas made since the scan
+    ``started`` are kept, they may not be in it.
+    """
+    async with conn.transaction():
+        await conn.fetchall(
+            "DELETE objects::Usage FILTER .bucket = <str>$bucket", bucket=bucket_name
+        )
+        await conn.fetchall(
+            """
+            DELETE objects::UsageDelta
+            FILTER .bucket = <str>$bucket AND .created < <float64>$started
+            """,
+            bucket=bucket_name,
+            started=started,
+        )
+        for folder, (bytes_, files) in totals.items():
+            await conn.fetchall(
+                """
+                INSERT objects::Usage {
+                    bucket := <str>$bucket,
+                    path := <str>$path,
+                    key := <str>$key,
+                    parent := <str>$parent,
+                    bytes := <int64>$bytes,
+                    files := <int64>$files,
+                }
+                """,
+                bucket=bucket_name,
+                path=folder,
+                key=_key(bucket_name, folder),
+                parent=_parent_key(bucket_name, folder),
+                bytes=bytes_,
+                files=files,
+            )
+
+
+async def check_quota(pool, bucket, size=0):
+    """Raise if ``size`` more bytes would exceed the quota of ``bucket``.
+
+    Returns how many more bytes it may hold, or ``None`` without a quota.
+    """
+    if bucket.quota is None:
+        return None
+    async with pool.acquire() as conn:
+        left = bucket.quota - (await get_usage(conn, bucket.name))["bytes"]
+    if left <= 0 or size > left:
+        raise HTTPException(
+            HTTP_507_INSUFFICIENT_STORAGE, f"bucket {bucket.name} is over quota"
+        )
+    return left
+
+
+async def limited(chunks, left, bucket_name):
+    """Pass ``chunks`` through, raising once more than ``left`` bytes came."""
+    async for chunk in chunks:
+        left -= len(chunk)
+        if left < 0:
+            raise HTTPException(
+                HTTP_507_INSUFFICIENT_STORAGE, f"bucket {bucket_name} is over quota"
+            )
+        yield chunk
+
+
+async def _compact_all():
+    interval = config.OBJECTS_USAGE_COMPACT_INTERVAL
+    while True:
+        await asyncio.sleep(min(interval, lease.POLL_INTERVAL))
+        try:
+            pool = await app.pool
+            # one worker at a time, see _crawl_all()
+            if not await lease.take(pool, "objects.usage.compact", interval):
+                continue
+            async with pool.acquire() as conn:
+                buckets = await conn.fetchall(
+                    "SELECT DISTINCT objects::UsageDelta.bucket"
+                )
+                for bucket_name in buckets:
+                    await compact(conn, bucket_name)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Failed to compact usage")
+
+
+@app.on_event("startup")
+def start_usage_compaction():
+    global _compactor
+    if config.OBJECTS_USAGE_COMPACT_INTERVAL > 0:
+        _compactor = asyncio.get_event_loop().create_task(_compact_all())
+
+
+@app.on_event("shutdown")
+def stop_usage_compaction():
+    if _compactor is not None:
+        _compactor.cancel()
+
+
+@mod.get("/usage/{bucket_name}/{path:path}")
+async def get_path_usage(bucket_name: str, path: str = None, pool=Depends(db_pool)):
+    """Bytes and files under a folder and under each folder in it.
+
+    Kept up to date as objects are put and deleted through the API, and
+    reconciled by crawling the bucket.
+    """
+    async with pool.acquire() as conn:
+        return dict(path=path or "", **await get_usage(conn, bucket_name, path or ""))
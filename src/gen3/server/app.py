@@ -1,13 +1,15 @@
 import asyncio
+import time
 
 import click
 import edgedb
 import pkg_resources
 from fastapi import FastAPI, Depends, APIRouter
-from starlette.responses import HTMLResponse
+from starlette.responses import HTMLResponse, Response
+from starlette.routing import Match
 from starlette.staticfiles import StaticFiles
 
-from . import logger, config
+from . import logger, config, metrics
 from .utils import ensure_module
 
 
@@ -42,16 +44,26 @@ api = APIRouter()
 
 
 class Pool(edgedb.AsyncIOPool):
+    @property
+    def open_count(self):
+        # noinspection PyProtectedMember
+        return len(
+            [0 for con in self._holders if con._con and not con._con.is_closed()]
+        )
+
+    @property
+    def in_use_count(self):
+        # noinspection PyProtectedMember
+        return len([0 for con in self._holders if con._in_use])
+
     def __repr__(self):
         # noinspection PyProtectedMember
         return "<{classname} max={max} min={min} cur={cur} use={use}>".format(
             classname=self.__class__.__name__,
             max=self._maxsize,
             min=self._minsize,
-            cur=len(
-                [0 for con in self._holders if con._con and not con._con.is_closed()]
-            ),
-            use=len([0 for con in self._holders if con._in_use]),
+            cur=self.open_count,
+            use=self.in_use_count,
         )
 
     @property
@@ -61,25 +73,84 @@ class Pool(edgedb.AsyncIOPool):
             classname=click.style(self.__class__.__name__, fg="green"),
             max=click.style(repr(self._maxsize), fg="cyan"),
             min=click.style(repr(self._minsize), fg="cyan"),
-            cur=click.style(
-                repr(
-                    len(
-                        [
-                            0
-                            for con in self._holders
-                            if con._con and not con._con.is_closed()
-                        ]
-                    )
-                ),
-                fg="cyan",
-            ),
-            use=click.style(
-                repr(len([0 for con in self._holders if con._in_use])), fg="cyan"
-            ),
+            cur=click.style(repr(self.open_count), fg="cyan"),
+            use=click.style(repr(self.in_use_count), fg="cyan"),
         )
 
+    async def _acquire(self, timeout):
+        with _acquire_seconds.time():
+            return await super()._acquire(timeout)
+
+
+def _pool_metric(func):
+    def collect():
+        pool = app._pool
+        if pool is None or not pool.done() or pool.exception() is not None:
+            return {}
+        return {(): func(pool.result())}
+
+    return collect
+
+
+_pool_size = metrics.Gauge(
+    "gen3_db_pool_max_size",
+    "Connections the database pool may open (DB_MAX_SIZE).",
+    # noinspection PyProtectedMember
+    collect=_pool_metric(lambda pool: pool._maxsize),
+)
+_pool_open = metrics.Gauge(
+    "gen3_db_pool_connections",
+    "Open connections in the database pool.",
+    collect=_pool_metric(lambda pool: pool.open_count),
+)
+_pool_in_use = metrics.Gauge(
+    "gen3_db_pool_connections_in_use",
+    "Connections acquired from the database pool.",
+    collect=_pool_metric(lambda pool: pool.in_use_count),
+)
+_acquire_seconds = metrics.Histogram(
+    "gen3_db_pool_acquire_seconds",
+    "Time waited to acquire a connection from the database pool.",
+    buckets=(0.0005, 0.001, 0.0025) + metrics.DEFAULT_BUCKETS,
+)
+_requests_in_flight = metrics.Gauge(
+    "gen3_http_requests_in_flight",
+    "Requests being handled, by route.",
+    labels=("method", "route"),
+)
+_request_seconds = metrics.Histogram(
+    "gen3_http_request_duration_seconds",
+    "Time to handle requests, by route, until the response is sent.",
+    labels=("method", "route", "status"),
+)
+
+
+_UNKNOWN = object()
+
 
 class Connection(edgedb.asyncio_con.AsyncIOConnection):
+    _module = None
+
+    async def set_module(self, module=None):
+        """Make ``module`` the default module, or reset it if ``None``.
+
+        The module stays set while the connection goes back to the pool and out
+        again, so it's only changed when it differs from the one last set.
+        """
+        if module == self._module:
+            return
+        # in case it's cancelled or failed half-way
+        self._module = _UNKNOWN
+        if module is None:
+            await self.execute("RESET MODULE")
+        else:
+            await self.execute(f"SET MODULE {module}")
+        self._module = module
+
+    def forget_module(self):
+        """Set the module again on next use, e.g. after running user queries."""
+        self._module = _UNKNOWN
+
     def transaction(self, *, isolation=None, readonly=None, deferrable=None):
         return Transaction(self, isolation, readonly, deferrable)
 
@@ -148,6 +219,51 @@ class ClientDisconnectMiddleware:
             waiter.cancel()
 
 
+def _route_path(scope):
+    partial = None
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    # not found, or a method that isn't allowed
+    return partial or "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app_):
+        self._app = app_
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self._app(scope, receive, send)
+            return
+
+        status = None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        labels = dict(method=scope["method"], route=_route_path(scope))
+        _requests_in_flight.inc(**labels)
+        start = time.perf_counter()
+        try:
+            await self._app(scope, receive, send_wrapper)
+        except asyncio.CancelledError:
+            # the client went away, like nginx logs it
+            status = status or 499
+            raise
+        finally:
+            _requests_in_flight.dec(**labels)
+            _request_seconds.observe(
+                time.perf_counter() - start, status=status or 500, **labels
+            )
+
+
 @app.on_event("startup")
 async def create_db_pool():
     args = dict(
@@ -202,18 +318,14 @@ async def db_pool():
 def connection(module=None):
     async def _connection(pool=Depends(db_pool)):
         async with pool.acquire() as conn:
-            if module is not None:
-                await conn.execute(f"SET MODULE {module}")
-            try:
-                yield conn
-            finally:
-                if module is not None:
-                    await conn.execute("RESET MODULE")
+            await conn.set_module(module)
+            yield conn
 
     return _connection
 
 
 def load_extras():
+    app.add_middleware(MetricsMiddleware)
     app.add_middleware(ClientDisconnectMiddleware)
 
     if config.SERVER_WEB_DIR:
@@ -324,6 +436,11 @@ CREATE MIGRATION {module}::migs TO {{
                 tx.raise_rollback()
 
 
+@api.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @api.get("/version")
 def get_version():
     return pkg_resources.get_distribution("gen3").version
@@ -27,6 +27,30 @@ SERVER_USE_FORWARDED_HOST = config(
     "SERVER_USE_FORWARDED_HOST", cast=bool, default=False
 )
 
+OBJECTS_BUCKET_CACHE_TTL = config("OBJECTS_BUCKET_CACHE_TTL", cast=float, default=60)
+OBJECTS_BUCKET_CACHE_CHECK_INTERVAL = config(
+    "OBJECTS_BUCKET_CACHE_CHECK_INTERVAL", cast=float, default=1
+)
+OBJECTS_UPLOAD_PART_SIZE = config(
+    "OBJECTS_UPLOAD_PART_SIZE", cast=int, default=64 * 1024 * 1024
+)
+OBJECTS_UPLOAD_TTL = config("OBJECTS_UPLOAD_TTL", cast=float, default=7 * 86400)
+OBJECTS_UPLOAD_EXPIRE_INTERVAL = config(
+    "OBJECTS_UPLOAD_EXPIRE_INTERVAL", cast=float, default=3600
+)
+OBJECTS_TYPE_CACHE_SIZE = config("OBJECTS_TYPE_CACHE_SIZE", cast=int, default=10000)
+OBJECTS_MAGIC_PROCESSES = config("OBJECTS_MAGIC_PROCESSES", cast=int, default=2)
+OBJECTS_DELETE_WAIT = config("OBJECTS_DELETE_WAIT", cast=float, default=1)
+OBJECTS_JOB_TTL = config("OBJECTS_JOB_TTL", cast=float, default=3600)
+OBJECTS_CRAWL_BATCH_SIZE = config("OBJECTS_CRAWL_BATCH_SIZE", cast=int, default=1000)
+OBJECTS_CRAWL_INTERVAL = config("OBJECTS_CRAWL_INTERVAL", cast=float, default=86400)
+OBJECTS_USAGE_COMPACT_INTERVAL = config(
+    "OBJECTS_USAGE_COMPACT_INTERVAL", cast=float, default=60
+)
+OBJECTS_COPY_WAIT = config("OBJECTS_COPY_WAIT", cast=float, default=1)
+OBJECTS_COPY_CONCURRENCY = config("OBJECTS_COPY_CONCURRENCY", cast=int, default=8)
+OBJECTS_COPY_RETRIES = config("OBJECTS_COPY_RETRIES", cast=int, default=2)
+
 if TESTING:
     DB_DATABASE_ROOT = "edgedb"
     DB_DATABASE = "test_" + (DB_DATABASE or "gen3")
@@ -1,4 +1,5 @@
 import io
+import re
 from typing import Dict
 
 import edgedb
@@ -10,11 +11,12 @@ from starlette.status import HTTP_400_BAD_REQUEST
 
 from .server import mod
 from ..server import logger
-from ..server.app import connection
+from ..server.app import connection, db_pool
 from ..server.utils import ensure_module, ID_REGEX
 
 _TYPES = {"string": "str", "boolean": "bool", "float": "float64", "long": "int64"}
 _ESCAPE = {"Case": "Case_"}
+_MODULE_REGEX = re.compile(r"\bMODULE\b", re.IGNORECASE)
 
 
 def _make_node_name(name):
@@ -127,17 +129,20 @@ class Query(BaseModel):
 @mod.post("/{schema}/edgeql")
 async def query_edgeql(
     query: Query,
-    conn=Depends(connection()),
+    pool=Depends(db_pool),
     schema: str = Path(..., regex="^[a-zA-Z_][a-zA-Z0-9_]*$"),
 ):
     schema = "gen3_" + schema
-    await conn.execute(f"SET MODULE {schema}")
-    try:
-        return Response(
-            await conn.fetchall_json(query.query, **query.args),
-            media_type="application/json",
-        )
-    except edgedb.errors.QueryError as e:
-        raise HTTPException(HTTP_400_BAD_REQUEST, str(e))
-    finally:
-        await conn.execute("RESET MODULE")
+    async with pool.acquire() as conn:
+        await conn.set_module(schema)
+        try:
+            return Response(
+                await conn.fetchall_json(query.query, **query.args),
+                media_type="application/json",
+            )
+        except edgedb.errors.QueryError as e:
+            raise HTTPException(HTTP_400_BAD_REQUEST, str(e))
+        finally:
+            if _MODULE_REGEX.search(query.query):
+                # the query may have set another module
+                conn.forget_module()
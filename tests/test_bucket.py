@@ -1,5 +1,16 @@
+import asyncio
+import base64
+import hashlib
+import io
+import json
 import os
+import struct
+import tarfile
+import time
 import uuid
+import zipfile
+
+import pytest
 
 
 def test_schema(client):
@@ -56,6 +67,90 @@ def test_crud(client):
     assert client.get("/objects/buckets").json() == []
 
 
+def test_ttl_cache():
+    from gen3.objects.cache import TTLCache
+
+    now = [0]
+    cache = TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # "b" is the least recently used
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert len(cache) == 2
+
+    now[0] = 9
+    assert cache.get("a") == 1
+    cache.set("d", 4, ttl=None)
+    now[0] = 10
+    assert cache.get("a") is None
+    assert list(cache.values()) == [4]
+
+    cache = TTLCache()
+    for key in ("a/1", "a/2", "b/1"):
+        cache.set(key, key)
+    cache.pop_if(lambda key: key.startswith("a/"))
+    assert list(cache.values()) == ["b/1"]
+    assert cache.pop("b/1") == "b/1"
+    assert cache.pop("b/1") is None
+
+
+def test_bucket_registry(client, tmpdir, monkeypatch):
+    from gen3.objects import bucket as bucket_module
+    from gen3.objects.drivers.fs import FileSystemBucket
+    from gen3.server import config
+    from gen3.server.app import app
+
+    closed = []
+
+    async def close(self):
+        closed.append(self.settings.root_dir)
+
+    monkeypatch.setattr(FileSystemBucket, "close", close)
+    monkeypatch.setattr(config, "OBJECTS_BUCKET_CACHE_CHECK_INTERVAL", 0)
+    registry = bucket_module.registry
+    loop = asyncio.get_event_loop()
+    pool = loop.run_until_complete(app.pool)
+
+    def get():
+        rv = loop.run_until_complete(registry.get(pool, "tBreg"))
+        # let scheduled closes run
+        loop.run_until_complete(asyncio.sleep(0))
+        return rv
+
+    async def bump_version():
+        async with pool.acquire() as conn:
+            await bucket_module._bump_version(conn)
+
+    dir_a, dir_b = os.path.join(tmpdir, "a"), os.path.join(tmpdir, "b")
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBreg", driver="fs", settings=dict(root_dir=dir_a)),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+    first = get()
+    assert get() is first
+
+    # a change by another worker reloads the bucket, the same one is kept open
+    loop.run_until_complete(bump_version())
+    second = get()
+    assert second is not first
+    assert second.settings == first.settings
+    assert closed == []
+
+    # reconfigured and deleted buckets are closed
+    resp = client.put(href, json=dict(settings=dict(root_dir=dir_b)))
+    assert resp.status_code == 200, resp.json()
+    assert get().settings.root_dir == dir_b
+    assert closed == [dir_a]
+    assert client.delete(href).status_code == 200
+    loop.run_until_complete(asyncio.sleep(0))
+    assert closed == [dir_a, dir_b]
+    assert get() is None
+
+
 def test_fs(client, tmpdir):
     resp = client.post(
         "/objects/buckets",
@@ -127,3 +222,1099 @@ def test_fs(client, tmpdir):
 
     assert client.get(href).status_code == 404
     assert client.get("/objects/buckets").json() == []
+
+
+def test_fs_listing(client, tmpdir):
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBcls", driver="fs", settings=dict(root_dir=str(tmpdir))),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+
+    for name in ("b/y", "a/x/z", "c"):
+        os.makedirs(os.path.join(tmpdir, name))
+    with open(os.path.join(tmpdir, "a/f.txt"), "w") as f:
+        f.write("f")
+    names = ["a", "a/f.txt", "a/x", "a/x/z", "b", "b/y", "c"]
+
+    resp = client.get("/objects/buckets/tBcls/").json()
+    assert [e["name"] for e in resp["files"]] == names
+    assert resp["next_cursor"] is None
+
+    pages = []
+    cursor = None
+    while True:
+        params = dict(limit=3)
+        if cursor:
+            params["cursor"] = cursor
+        resp = client.get("/objects/buckets/tBcls/", params=params).json()
+        pages.append([e["name"] for e in resp["files"]])
+        cursor = resp["next_cursor"]
+        if cursor is None:
+            break
+    assert sum(pages, []) == names
+    assert pages[0] == names[:3]
+
+    resp = client.get("/objects/buckets/tBcls/", params=dict(max_depth=2)).json()
+    assert [e["name"] for e in resp["files"]] == [
+        "a",
+        "a/f.txt",
+        "a/x",
+        "b",
+        "b/y",
+        "c",
+    ]
+
+    resp = client.get("/objects/buckets/tBcls/", params=dict(stream=True))
+    assert resp.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line)["name"] for line in resp.text.splitlines()] == names
+
+    assert client.delete(href).status_code == 200
+
+
+def test_fs_listing_cancel(client, tmpdir):
+    from gen3.objects.cancel import CancelToken
+    from gen3.objects.drivers.fs import FileSystemBucket
+
+    for i in range(10):
+        os.makedirs(os.path.join(tmpdir, f"d{i}/e"))
+    bucket = FileSystemBucket(
+        name="tBccn", driver="fs", settings=dict(root_dir=str(tmpdir))
+    )
+    before = client.get("/objects/cancellations").json().get("get", {})
+
+    token = CancelToken("get")
+    seen = []
+    with pytest.raises(asyncio.CancelledError):
+        for entry in bucket._walk(str(tmpdir), token=token):
+            seen.append(entry["name"])
+            if len(seen) == 3:
+                token.cancel()
+    assert seen == ["d0", "d0/e", "d1"]
+
+    after = client.get("/objects/cancellations").json()["get"]
+    assert after["cancelled"] == before.get("cancelled", 0) + 1
+    assert after["stopped"] == before.get("stopped", 0) + 1
+    assert after["entries"] == before.get("entries", 0) + 3
+
+
+def test_fs_download_range(client, tmpdir):
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBcrg", driver="fs", settings=dict(root_dir=str(tmpdir))),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+
+    data = bytes(range(256)) * 16
+    with open(os.path.join(tmpdir, "data.bin"), "wb") as f:
+        f.write(data)
+    url = "/objects/buckets/tBcrg/data.bin?download=true"
+
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert resp.content == data
+    assert resp.headers["accept-ranges"] == "bytes"
+    etag = resp.headers["etag"]
+
+    resp = client.get(url, headers={"range": "bytes=10-19"})
+    assert resp.status_code == 206
+    assert resp.headers["content-range"] == f"bytes 10-19/{len(data)}"
+    assert resp.content == data[10:20]
+
+    resp = client.get(url, headers={"range": "bytes=-4"})
+    assert resp.status_code == 206
+    assert resp.content == data[-4:]
+
+    resp = client.get(url, headers={"range": "bytes=0-1,100-101"})
+    assert resp.status_code == 206
+    assert resp.headers["content-type"].startswith("multipart/byteranges")
+    assert data[0:2] in resp.content
+    assert data[100:102] in resp.content
+
+    resp = client.get(url, headers={"range": f"bytes={len(data)}-"})
+    assert resp.status_code == 416
+
+    assert client.get(url, headers={"if-none-match": etag}).status_code == 304
+    resp = client.get(url, headers={"range": "bytes=0-1", "if-range": '"stale"'})
+    assert resp.status_code == 200
+
+    assert client.delete(href).status_code == 200
+
+
+def test_fs_raw_upload(client, tmpdir):
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBcup", driver="fs", settings=dict(root_dir=str(tmpdir))),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+
+    data = os.urandom(200000)
+    resp = client.put(
+        "/objects/buckets/tBcup/abc/raw.bin",
+        data=data,
+        headers={"content-type": "application/octet-stream"},
+    )
+    assert resp.status_code == 200, resp.json()
+    assert resp.json()["size"] == len(data)
+    with open(os.path.join(tmpdir, "abc/raw.bin"), "rb") as f:
+        assert f.read() == data
+    assert os.listdir(os.path.join(tmpdir, "abc")) == ["raw.bin"]
+
+    # like curl --data-binary, which labels the body as a form
+    resp = client.put(
+        "/objects/buckets/tBcup/abc/form.txt",
+        data=b"a=1&b=2",
+        headers={"content-type": "application/x-www-form-urlencoded"},
+    )
+    assert resp.status_code == 200, resp.json()
+    with open(os.path.join(tmpdir, "abc/form.txt"), "rb") as f:
+        assert f.read() == b"a=1&b=2"
+    resp = client.put(
+        "/objects/buckets/tBcup/abc/form.txt", files=dict(other=("a.txt", b"x"))
+    )
+    assert resp.status_code == 422
+
+    assert client.put("/objects/buckets/tBcup/abc", data=b"x").status_code == 409
+
+    assert client.delete(href).status_code == 200
+
+
+def test_fs_upload_digests(client, tmpdir):
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBcdg", driver="fs", settings=dict(root_dir=str(tmpdir))),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+
+    data = os.urandom(100000)
+    resp = client.put("/objects/buckets/tBcdg/abc/hashed.bin", data=data)
+    assert resp.status_code == 200, resp.json()
+    md5 = hashlib.md5(data)
+    assert resp.json()["md5"] == md5.hexdigest()
+    assert resp.json()["sha256"] == hashlib.sha256(data).hexdigest()
+
+    resp = client.get("/objects/buckets/tBcdg/abc/hashed.bin")
+    assert resp.json()["md5"] == md5.hexdigest()
+    resp = client.get("/objects/buckets/tBcdg/abc/hashed.bin?download=true")
+    assert resp.content == data
+    assert "digest" not in resp.headers
+    resp = client.get(
+        "/objects/buckets/tBcdg/abc/hashed.bin?download=true",
+        headers={"want-digest": "MD5"},
+    )
+    assert resp.content == data
+    md5_b64 = base64.b64encode(md5.digest()).decode()
+    assert f"MD5={md5_b64}" in resp.headers["digest"]
+
+    # changed behind our back, the stale digests are not served
+    with open(os.path.join(tmpdir, "abc/hashed.bin"), "ab") as f:
+        f.write(b"more")
+    resp = client.get("/objects/buckets/tBcdg/abc/hashed.bin")
+    assert resp.json().get("md5") is None
+    resp = client.get(
+        "/objects/buckets/tBcdg/abc/hashed.bin?download=true",
+        headers={"want-digest": "MD5"},
+    )
+    assert "digest" not in resp.headers
+
+    assert client.delete(href).status_code == 200
+
+
+def test_search(client, tmpdir):
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBcsr", driver="fs", settings=dict(root_dir=str(tmpdir))),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+
+    client.put("/objects/buckets/tBcsr/runs/small.cram", data=b"x")
+    client.put("/objects/buckets/tBcsr/runs/big.cram", data=b"x" * 1000)
+    client.put("/objects/buckets/tBcsr/runs/big.txt", data=b"x" * 1000)
+    resp = client.get("/objects/search?bucket=tBcsr&ext=cram&min_size=100")
+    assert [o["path"] for o in resp.json()["objects"]] == ["runs/big.cram"]
+
+    # files created out of band are picked up by the crawler
+    os.makedirs(os.path.join(tmpdir, "old"))
+    with open(os.path.join(tmpdir, "old/legacy.cram"), "wb") as f:
+        f.write(b"x" * 2000)
+    os.unlink(os.path.join(tmpdir, "runs/small.cram"))
+    resp = client.post("/objects/index/tBcsr")
+    assert resp.status_code == 202, resp.json()
+    job_href = resp.json()["href"]
+    for _ in range(100):
+        job = client.get(job_href).json()
+        if job["state"] != "running":
+            break
+        time.sleep(0.05)
+    assert job["state"] == "done", job
+    assert job["progress"]["removed"] == 1
+
+    resp = client.get("/objects/search?bucket=tBcsr&ext=.cram&limit=1")
+    assert [o["path"] for o in resp.json()["objects"]] == ["old/legacy.cram"]
+    cursor = resp.json()["next_cursor"]
+    resp = client.get(f"/objects/search?bucket=tBcsr&ext=cram&cursor={cursor}")
+    assert [o["path"] for o in resp.json()["objects"]] == ["runs/big.cram"]
+    assert resp.json()["next_cursor"] is None
+
+    assert client.delete(href).status_code == 200
+    resp = client.get("/objects/search?bucket=tBcsr")
+    assert resp.json()["objects"] == []
+
+
+def test_fs_delete(client, tmpdir, monkeypatch):
+    from gen3.server import config
+
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBcdl", driver="fs", settings=dict(root_dir=str(tmpdir))),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+
+    client.put("/objects/buckets/tBcdl/one.txt", data=b"x")
+    assert client.delete("/objects/buckets/tBcdl/one.txt").status_code == 204
+    assert not os.path.exists(os.path.join(tmpdir, "one.txt"))
+    assert client.delete("/objects/buckets/tBcdl/one.txt").status_code == 404
+
+    for i in range(10):
+        os.makedirs(os.path.join(tmpdir, f"many/{i}"))
+        for j in range(10):
+            with open(os.path.join(tmpdir, f"many/{i}/{j}"), "wb") as f:
+                f.write(b"xy")
+    # without waiting, the delete carries on as a job
+    monkeypatch.setattr(config, "OBJECTS_DELETE_WAIT", 0)
+    resp = client.delete("/objects/buckets/tBcdl/many")
+    assert resp.status_code == 202, resp.text
+    for _ in range(100):
+        job = client.get(resp.json()["href"]).json()
+        if job["state"] != "running":
+            break
+        time.sleep(0.05)
+    assert job["state"] == "done", job
+    assert job["progress"] == dict(entries=111, bytes=200)
+    assert not os.path.exists(os.path.join(tmpdir, "many"))
+
+    # while one that finishes in time answers right away
+    monkeypatch.setattr(config, "OBJECTS_DELETE_WAIT", 30)
+    os.makedirs(os.path.join(tmpdir, "few/0"))
+    with open(os.path.join(tmpdir, "few/0/0"), "wb") as f:
+        f.write(b"xy")
+    assert client.delete("/objects/buckets/tBcdl/few").status_code == 204
+    assert not os.path.exists(os.path.join(tmpdir, "few"))
+
+    # a cancelled delete stops within a folder
+    from gen3.objects.drivers.fs import FileSystemBucket
+    from gen3.objects.jobs import Job
+
+    os.makedirs(os.path.join(tmpdir, "flat"))
+    for i in range(100):
+        with open(os.path.join(tmpdir, f"flat/{i}"), "wb") as f:
+            f.write(b"xy")
+    job = Job("delete")
+
+    class CancelAfterFive(dict):
+        def __setitem__(self, key, value):
+            super().__setitem__(key, value)
+            if key == "entries" and value == 5:
+                job.token.cancel()
+
+    job.progress = CancelAfterFive()
+    bucket = FileSystemBucket(
+        name="tBcdl", driver="fs", settings=dict(root_dir=str(tmpdir))
+    )
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.get_event_loop().run_until_complete(bucket.delete("flat", job))
+    assert job.progress["entries"] == 5
+    assert len(os.listdir(os.path.join(tmpdir, "flat"))) == 95
+
+    assert client.delete(href).status_code == 200
+
+
+@pytest.mark.skipif(
+    not os.environ.get("TEST_S3_ENDPOINT_URL"),
+    reason="needs an S3 stand-in like moto or MinIO at TEST_S3_ENDPOINT_URL",
+)
+def test_s3(client):
+    pytest.importorskip("aiohttp")
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(
+            name="tBcs3",
+            driver="s3",
+            settings=dict(
+                bucket=os.environ.get("TEST_S3_BUCKET", "gen3-test"),
+                prefix=f"tBcs3-{uuid.uuid4().hex}",
+                endpoint_url=os.environ["TEST_S3_ENDPOINT_URL"],
+                access_key_id=os.environ.get("TEST_S3_ACCESS_KEY_ID", "testing"),
+                secret_access_key=os.environ.get("TEST_S3_SECRET_KEY", "testing"),
+                part_size=5 * 1024 * 1024,
+                presign_threshold=10 * 1024 * 1024,
+            ),
+        ),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+
+    resp = client.put("/objects/buckets/tBcs3/a/small.txt", data=b"abc")
+    assert resp.json()["size"] == 3
+    data = os.urandom(12 * 1024 * 1024)
+    resp = client.put("/objects/buckets/tBcs3/a/b/big.bin", data=data)
+    assert resp.status_code == 200, resp.json()
+    assert resp.json()["size"] == len(data)
+    assert client.put("/objects/buckets/tBcs3/a", data=b"x").status_code == 409
+
+    resp = client.get("/objects/buckets/tBcs3/").json()
+    assert [(e["name"], e["dir"]) for e in resp["files"]] == [
+        ("a", True),
+        ("a/b", True),
+        ("a/b/big.bin", False),
+        ("a/small.txt", False),
+    ]
+    resp = client.get("/objects/buckets/tBcs3/", params=dict(limit=2)).json()
+    resp = client.get(
+        "/objects/buckets/tBcs3/", params=dict(cursor=resp["next_cursor"])
+    ).json()
+    assert [e["name"] for e in resp["files"]] == ["a/b/big.bin", "a/small.txt"]
+
+    resp = client.get("/objects/buckets/tBcs3/a/small.txt").json()
+    assert resp["preview"] == "abc"
+    resp = client.get(
+        "/objects/buckets/tBcs3/a/small.txt?download=true",
+        headers=dict(range="bytes=1-"),
+    )
+    assert resp.status_code == 206
+    assert resp.content == b"bc"
+
+    resp = client.get(
+        "/objects/buckets/tBcs3/a/b/big.bin?download=true", allow_redirects=False
+    )
+    assert resp.status_code == 307
+    assert resp.headers["location"].startswith(os.environ["TEST_S3_ENDPOINT_URL"])
+
+    assert client.delete("/objects/buckets/tBcs3/a").status_code == 204
+    assert client.get("/objects/buckets/tBcs3/a/small.txt").status_code == 404
+
+    resp = client.post(
+        "/objects/buckets/tBcs3/a/parts.bin",
+        json=dict(size=2 * 1024 * 1024, part_size=1024 * 1024),
+    )
+    assert resp.status_code == 422
+
+    assert client.delete(href).status_code == 200
+
+
+def test_ftp(client, tmpdir, monkeypatch):
+    import pathlib
+
+    import aioftp
+    from gen3.objects.drivers import ftp
+
+    loop = asyncio.get_event_loop()
+    server = aioftp.Server([aioftp.User(base_path=pathlib.Path(str(tmpdir)))])
+    loop.run_until_complete(server.start("127.0.0.1", 0))
+    try:
+        settings = dict(host="127.0.0.1", port=server.address[1], pool_max_size=2)
+        resp = client.post(
+            "/objects/buckets",
+            json=dict(name="tBftp", driver="ftp", settings=settings),
+        )
+        assert resp.status_code == 201, resp.json()
+        href = resp.json()["href"]
+
+        data = os.urandom(300000)
+        resp = client.put("/objects/buckets/tBftp/abc/a.bin", data=data)
+        assert resp.status_code == 200, resp.json()
+        assert resp.json()["size"] == len(data)
+        assert tmpdir.join("abc", "a.bin").read_binary() == data
+        assert os.listdir(tmpdir.join("abc")) == ["a.bin"]
+
+        url = "/objects/buckets/tBftp/abc/a.bin?download=true"
+        assert client.get(url).content == data
+        resp = client.get(url, headers=dict(range="bytes=1000-50999"))
+        assert resp.status_code == 206
+        assert resp.content == data[1000:51000]
+
+        tmpdir.join("abc", "sub", "deep").ensure(dir=True)
+        tmpdir.join("abc", "sub", "deep", "b.txt").write("b")
+        resp = client.get("/objects/buckets/tBftp/abc/").json()
+        assert [e["name"] for e in resp["files"]] == [
+            "a.bin",
+            "sub",
+            "sub/deep",
+            "sub/deep/b.txt",
+        ]
+
+        # listings are cached until changed through the bucket
+        tmpdir.join("abc", "c.txt").write("c")
+        resp = client.get("/objects/buckets/tBftp/abc/?recursive=false").json()
+        assert [e["name"] for e in resp["files"]] == ["a.bin", "sub"]
+        resp = client.put("/objects/buckets/tBftp/abc/d.txt", data=b"d")
+        assert resp.status_code == 200
+        resp = client.get("/objects/buckets/tBftp/abc/?recursive=false").json()
+        assert [e["name"] for e in resp["files"]] == ["a.bin", "c.txt", "d.txt", "sub"]
+
+        # concurrent reads share the pool, and give back what they took
+        bucket = ftp.FtpBucket(name="tBftp", driver="ftp", settings=settings)
+        pool = ftp._pools["tBftp"]
+
+        async def read(path):
+            return b"".join([chunk async for chunk in bucket.read_range(path)])
+
+        async def read_all():
+            return await asyncio.gather(*(read("abc/a.bin") for _ in range(5)))
+
+        assert loop.run_until_complete(read_all()) == [data] * 5
+        assert pool._size <= 2
+        assert pool._size == len(pool._idle)
+
+        # a read stopped early closes its data connection
+        closed = []
+        stream_close = aioftp.DataConnectionThrottleStreamIO.close
+        monkeypatch.setattr(
+            aioftp.DataConnectionThrottleStreamIO,
+            "close",
+            lambda self: closed.append(self) or stream_close(self),
+        )
+
+        async def read_first():
+            chunks = bucket.read_range("abc/a.bin")
+            try:
+                return await chunks.__anext__()
+            finally:
+                await chunks.aclose()
+
+        assert data.startswith(loop.run_until_complete(read_first()))
+        assert len(closed) == 1
+        assert pool._size == len(pool._idle)
+        assert loop.run_until_complete(read("abc/a.bin")) == data
+
+        assert client.delete("/objects/buckets/tBftp/abc").status_code == 204
+        assert not tmpdir.join("abc").exists()
+        assert client.delete(href).status_code == 200
+    finally:
+        loop.run_until_complete(server.close())
+
+
+def test_cas(client, tmpdir, monkeypatch):
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBcas", driver="cas", settings=dict(root_dir=str(tmpdir))),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+
+    def blobs():
+        return sum(len(files) for _, _, files in os.walk(os.path.join(tmpdir, "blobs")))
+
+    data = os.urandom(100000)
+    sha256 = hashlib.sha256(data).hexdigest()
+    for path in ("a/one.bin", "b/two.bin"):
+        resp = client.put(f"/objects/buckets/tBcas/{path}", data=data)
+        assert resp.status_code == 200, resp.json()
+        assert resp.json()["sha256"] == sha256
+    assert blobs() == 1
+
+    digest = "SHA-256=" + base64.b64encode(bytes.fromhex(sha256)).decode()
+    resp = client.put(
+        "/objects/buckets/tBcas/c/three.bin", data=b"", headers=dict(digest=digest)
+    )
+    assert resp.status_code == 200, resp.json()
+    assert resp.json()["size"] == len(data)
+
+    resp = client.get("/objects/buckets/tBcas/").json()
+    assert [e["name"] for e in resp["files"]] == [
+        "a",
+        "a/one.bin",
+        "b",
+        "b/two.bin",
+        "c",
+        "c/three.bin",
+    ]
+    resp = client.get("/objects/buckets/tBcas/c/three.bin", params=dict(download=True))
+    assert resp.content == data
+    assert resp.headers["etag"] == f'"{sha256}"'
+
+    assert client.delete("/objects/buckets/tBcas/a").status_code == 204
+    assert client.delete("/objects/buckets/tBcas/b/two.bin").status_code == 204
+    assert blobs() == 1
+    # buckets with another blob directory don't keep blobs of this one
+    other = os.path.join(tmpdir, "other")
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBcas2", driver="cas", settings=dict(root_dir=other)),
+    )
+    assert resp.status_code == 201, resp.json()
+    other_href = resp.json()["href"]
+    assert client.put("/objects/buckets/tBcas2/d.bin", data=data).status_code == 200
+    assert client.delete("/objects/buckets/tBcas/c").status_code == 204
+    assert blobs() == 0
+    assert client.get("/objects/buckets/tBcas2/d.bin?download=true").content == data
+
+    # a put failing once linked leaves no blob behind
+    from fastapi import HTTPException
+    from gen3.objects.drivers.cas import CasBucket
+
+    async def _record(*args):
+        raise HTTPException(503)
+
+    with monkeypatch.context() as m:
+        m.setattr(CasBucket, "_record", _record)
+        assert client.put("/objects/buckets/tBcas/e.bin", data=data).status_code == 503
+    assert blobs() == 0
+    assert os.listdir(os.path.join(tmpdir, "tmp")) == []
+
+    # deleting a bucket with files frees their blobs, and forgets them
+    assert client.delete(other_href).status_code == 200
+    assert os.listdir(os.path.join(other, "blobs", sha256[:2], sha256[2:4])) == []
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBcas2", driver="cas", settings=dict(root_dir=other)),
+    )
+    assert resp.status_code == 201, resp.json()
+    assert client.get("/objects/buckets/tBcas2/").json()["files"] == []
+    assert client.get("/objects/buckets/tBcas2/d.bin").status_code == 404
+
+    assert client.delete(other_href).status_code == 200
+    assert client.delete(href).status_code == 200
+
+
+def test_fs_resumable_upload(client, tmpdir, monkeypatch):
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBcmp", driver="fs", settings=dict(root_dir=str(tmpdir))),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+
+    data = os.urandom(2500)
+    resp = client.post(
+        "/objects/buckets/tBcmp/abc/big.bin", json=dict(size=len(data), part_size=1000)
+    )
+    assert resp.status_code == 201, resp.json()
+    upload = resp.json()
+    assert upload["parts"] == 3
+    upload_href = upload["href"]
+
+    assert client.put(upload_href + "/3", data=data[2000:]).status_code == 200
+    assert client.put(upload_href + "/1", data=data[:999]).status_code == 400
+    assert client.put(upload_href + "/1", data=data[:1000]).status_code == 200
+    assert client.get(upload_href).json()["missing"] == [2]
+    assert client.post(upload_href).status_code == 409
+
+    assert client.put(upload_href + "/2", data=data[1000:2000]).status_code == 200
+    resp = client.post(upload_href)
+    assert resp.status_code == 200, resp.json()
+    assert resp.json()["size"] == len(data)
+    with open(os.path.join(tmpdir, "abc/big.bin"), "rb") as f:
+        assert f.read() == data
+    assert client.get(upload_href).status_code == 404
+
+    resp = client.post("/objects/buckets/tBcmp/abc/gone.bin", json=dict(size=10))
+    assert client.delete(resp.json()["href"]).status_code == 204
+    assert os.listdir(os.path.join(tmpdir, "abc")) == ["big.bin"]
+
+    # forgotten uploads expire
+    from gen3.objects import upload as upload_module
+    from gen3.server import config
+    from gen3.server.app import app
+
+    resp = client.post("/objects/buckets/tBcmp/abc/forgotten.bin", json=dict(size=10))
+    assert len(os.listdir(os.path.join(tmpdir, "abc"))) == 2
+    loop = asyncio.get_event_loop()
+    pool = loop.run_until_complete(app.pool)
+    assert loop.run_until_complete(upload_module.expire_uploads(pool)) == 0
+    monkeypatch.setattr(config, "OBJECTS_UPLOAD_TTL", -60)
+    assert loop.run_until_complete(upload_module.expire_uploads(pool)) == 1
+    assert client.get(resp.json()["href"]).status_code == 404
+    assert os.listdir(os.path.join(tmpdir, "abc")) == ["big.bin"]
+
+    assert client.delete(href).status_code == 200
+
+
+def test_fs_folder_download(client, tmpdir):
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBcar", driver="fs", settings=dict(root_dir=str(tmpdir))),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+
+    os.makedirs(os.path.join(tmpdir, "abc/sub"))
+    data = str(uuid.uuid4()).encode()
+    with open(os.path.join(tmpdir, "abc/sub/test.txt"), "wb") as f:
+        f.write(data)
+
+    resp = client.get("/objects/buckets/tBcar/abc", params=dict(download=True))
+    assert resp.status_code == 200
+    assert resp.headers["content-disposition"] == 'attachment; filename="abc.tar"'
+    with tarfile.open(fileobj=io.BytesIO(resp.content)) as tar:
+        assert tar.getnames() == ["sub", "sub/test.txt"]
+        assert tar.extractfile("sub/test.txt").read() == data
+
+    resp = client.get(
+        "/objects/buckets/tBcar/abc", params=dict(download=True, archive="zip")
+    )
+    assert resp.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(resp.content)) as zf:
+        assert zf.read("sub/test.txt") == data
+
+    resp = client.get(
+        "/objects/buckets/tBcar/abc", params=dict(download=True, archive="rar")
+    )
+    assert resp.status_code == 400
+
+    assert client.delete(href).status_code == 200
+
+
+def test_fs_extract_upload(client, tmpdir):
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBcex", driver="fs", settings=dict(root_dir=str(tmpdir))),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+
+    data = os.urandom(100000)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for name, content in (("sub/a.bin", data), ("../escape.txt", b"x")):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    resp = client.put(
+        "/objects/buckets/tBcex/abc",
+        params=dict(extract="tar"),
+        data=buf.getvalue(),
+        headers={"content-type": "application/octet-stream"},
+    )
+    assert resp.status_code == 200, resp.json()
+    rv = resp.json()
+    assert rv["errors"] == 1
+    assert rv["files"][0] == dict(name="sub/a.bin", size=len(data))
+    assert "error" in rv["files"][1]
+    with open(os.path.join(tmpdir, "abc/sub/a.bin"), "rb") as f:
+        assert f.read() == data
+    assert not os.path.exists(os.path.join(tmpdir, "escape.txt"))
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("z.txt", "zipped")
+    resp = client.put(
+        "/objects/buckets/tBcex/abc",
+        params=dict(extract="zip"),
+        data=buf.getvalue(),
+        headers={"content-type": "application/octet-stream"},
+    )
+    assert resp.status_code == 200, resp.json()
+    with open(os.path.join(tmpdir, "abc/z.txt")) as f:
+        assert f.read() == "zipped"
+
+    # zip64 sizes in the header, but only one of them in the extra field
+    extra = struct.pack("<HHQ", 0x0001, 8, 1)
+    header = struct.pack(
+        "<4sHHHHHIIIHH",
+        b"PK\x03\x04",
+        45,
+        0,
+        0,
+        0,
+        0,
+        0,
+        0xFFFFFFFF,
+        0xFFFFFFFF,
+        5,
+        len(extra),
+    )
+    for fmt, body in (
+        ("zip", header + b"z.txt" + extra),
+        ("zip", b"not an archive"),
+        ("tar", b"not an archive"),
+    ):
+        resp = client.put(
+            "/objects/buckets/tBcex/abc",
+            params=dict(extract=fmt),
+            data=body,
+            headers={"content-type": "application/octet-stream"},
+        )
+        assert resp.status_code == 400, resp.json()
+
+    assert client.delete(href).status_code == 200
+
+
+def test_fs_compression(client, tmpdir):
+    zstandard = pytest.importorskip("zstandard")
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(
+            name="tBzst",
+            driver="fs",
+            settings=dict(root_dir=str(tmpdir), compression="zstd", frame_size=1000),
+        ),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+
+    data = b"".join(b"chr1\t%d\tA\tG\n" % i for i in range(1000))
+    assert client.put("/objects/buckets/tBzst/abc/a.tsv", data=data).status_code == 200
+    packed = os.path.join(tmpdir, "abc/a.tsv.gen3-zst")
+    assert os.listdir(os.path.join(tmpdir, "abc")) == ["a.tsv.gen3-zst"]
+    assert os.path.getsize(packed) < len(data)
+    resp = client.put("/objects/buckets/tBzst/abc/b.tsv.gen3-zst", data=b"x")
+    assert resp.status_code == 400
+
+    # without compression, compressed files are plain files like any other
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBraw", driver="fs", settings=dict(root_dir=str(tmpdir))),
+    )
+    assert resp.status_code == 201, resp.json()
+    raw_href = resp.json()["href"]
+    resp = client.get("/objects/buckets/tBraw/abc/")
+    assert [f["name"] for f in resp.json()["files"]] == ["a.tsv.gen3-zst"]
+    assert client.get("/objects/buckets/tBraw/abc/a.tsv").status_code == 404
+    assert client.delete(raw_href).status_code == 200
+
+    resp = client.get("/objects/buckets/tBzst/abc/")
+    assert [(f["name"], f["size"]) for f in resp.json()["files"]] == [
+        ("a.tsv", len(data))
+    ]
+    assert (
+        client.get("/objects/buckets/tBzst/abc/a.tsv")
+        .json()["preview"]
+        .startswith("chr1\t0\t")
+    )
+
+    url = "/objects/buckets/tBzst/abc/a.tsv?download=true"
+    resp = client.get(url, headers={"accept-encoding": "identity"})
+    assert resp.content == data
+    assert "content-encoding" not in resp.headers
+    resp = client.get(url, headers={"range": "bytes=900-3100"})
+    assert resp.status_code == 206
+    assert resp.content == data[900:3101]
+
+    # the stored frames are sent as they are, as a valid zstd stream
+    resp = client.get(url, headers={"accept-encoding": "gzip, zstd"}, stream=True)
+    assert resp.headers["content-encoding"] == "zstd"
+    body = resp.raw.read(decode_content=False)
+    with open(packed, "rb") as f:
+        assert body == f.read()
+    assert zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)).read() == data
+
+    resp = client.get("/objects/buckets/tBzst/abc/?download=true")
+    with tarfile.open(fileobj=io.BytesIO(resp.content)) as tar:
+        assert tar.extractfile("a.tsv").read() == data
+
+    assert client.delete("/objects/buckets/tBzst/abc/a.tsv").status_code == 204
+    assert os.listdir(os.path.join(tmpdir, "abc")) == []
+
+    assert client.delete(href).status_code == 200
+
+
+def test_copy(client, tmpdir):
+    hrefs = []
+    for name in ("tBcp1", "tBcp2"):
+        os.makedirs(os.path.join(tmpdir, name))
+        resp = client.post(
+            "/objects/buckets",
+            json=dict(
+                name=name,
+                driver="fs",
+                settings=dict(root_dir=os.path.join(tmpdir, name)),
+            ),
+        )
+        assert resp.status_code == 201, resp.json()
+        hrefs.append(resp.json()["href"])
+
+    for i in range(10):
+        assert (
+            client.put(f"/objects/buckets/tBcp1/abc/{i}.txt", data=str(i)).status_code
+            == 200
+        )
+
+    def copy(source, target, move=False):
+        return client.post(
+            "/objects/copy",
+            json=dict(
+                source=dict(bucket=source[0], path=source[1]),
+                target=dict(bucket=target[0], path=target[1]),
+                move=move,
+            ),
+        )
+
+    assert copy(("tBcp1", "abc"), ("tBcp1", "abc/def")).status_code == 400
+    resp = copy(("tBcp1", "abc/1.txt"), ("tBcp2", "one.txt"))
+    assert resp.status_code == 200, resp.json()
+    assert client.get("/objects/buckets/tBcp2/one.txt").json()["sha256"] == (
+        hashlib.sha256(b"1").hexdigest()
+    )
+
+    resp = copy(("tBcp1", "abc"), ("tBcp2", "copied"))
+    assert resp.status_code == 200, resp.json()
+    assert resp.json()["files"] == 10
+    # copying again skips what is already copied
+    resp = copy(("tBcp1", "abc"), ("tBcp2", "copied"))
+    assert resp.json()["skipped"] == 10
+    assert client.get("/objects/buckets/tBcp2/copied/9.txt?download=true").text == "9"
+
+    resp = copy(("tBcp2", "copied"), ("tBcp2", "moved/here"), move=True)
+    assert resp.status_code == 200, resp.json()
+    assert client.get("/objects/buckets/tBcp2/copied").status_code == 404
+    resp = client.get("/objects/buckets/tBcp2/moved/here/")
+    assert len(resp.json()["files"]) == 10
+    resp = client.get("/objects/search", params=dict(bucket="tBcp2", prefix="moved/"))
+    assert len(resp.json()["objects"]) == 10
+
+    # a newer target of the same size but other content is replaced, not kept
+    assert client.put("/objects/buckets/tBcp1/x.txt", data="aaa").status_code == 200
+    assert client.put("/objects/buckets/tBcp2/x.txt", data="bbb").status_code == 200
+    resp = copy(("tBcp1", "x.txt"), ("tBcp2", "x.txt"), move=True)
+    assert resp.status_code == 200, resp.json()
+    assert resp.json()["files"] == 1 and resp.json()["skipped"] == 0
+    assert client.get("/objects/buckets/tBcp2/x.txt?download=true").text == "aaa"
+    assert client.get("/objects/buckets/tBcp1/x.txt").status_code == 404
+
+    for href in hrefs:
+        assert client.delete(href).status_code == 200
+
+
+def test_usage_quota(client, tmpdir):
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(
+            name="tBusage", driver="fs", settings=dict(root_dir=str(tmpdir)), quota=10
+        ),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+
+    assert client.put("/objects/buckets/tBusage/top", data="1234").status_code == 200
+    assert client.put("/objects/buckets/tBusage/a/b", data="56").status_code == 200
+    assert client.put("/objects/buckets/tBusage/a/b", data="567").status_code == 200
+    assert client.get(href).json()["usage"] == dict(bytes=7, files=2)
+    resp = client.get("/objects/usage/tBusage/")
+    assert resp.json()["folders"] == [dict(name="a", bytes=3, files=1)]
+    assert client.get("/objects/usage/tBusage/a").json()["bytes"] == 3
+
+    resp = client.put("/objects/buckets/tBusage/c", data="12345")
+    assert resp.status_code == 507
+    assert client.get("/objects/buckets/tBusage/c").status_code == 404
+
+    assert client.put(href, json=dict(quota=0)).status_code == 200
+    assert client.put("/objects/buckets/tBusage/c", data="12345").status_code == 200
+
+    assert client.delete("/objects/buckets/tBusage/a").status_code == 204
+    assert client.get(href).json()["usage"] == dict(bytes=9, files=2)
+    assert client.delete(href).status_code == 200
+
+
+def test_metrics(client, tmpdir):
+    resp = client.post(
+        "/objects/buckets",
+        json=dict(name="tBmetrics", driver="fs", settings=dict(root_dir=str(tmpdir))),
+    )
+    assert resp.status_code == 201, resp.json()
+    href = resp.json()["href"]
+    assert client.put("/objects/buckets/tBmetrics/a.txt", data="abc").status_code == 200
+    resp = client.get("/objects/buckets/tBmetrics/a.txt?download=true")
+    assert resp.text == "abc"
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = resp.text.splitlines()
+    assert "gen3_db_pool_connections_in_use 0" in lines
+    assert any(line.startswith("gen3_db_pool_acquire_seconds_count ") for line in lines)
+    assert any(
+        line.startswith(
+            'gen3_http_request_duration_seconds_count{method="PUT",'
+            'route="/objects/buckets/{bucket_name}/{path:path}",status="200"}'
+        )
+        for line in lines
+    )
+    assert any(
+        line.startswith('gen3_objects_driver_bytes_total{driver="fs",operation="put"}')
+        for line in lines
+    )
+    assert client.delete(href).status_code == 200
+
+
+def _response_body(response):
+    body = []
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    scope = {"type": "http", "method": "GET", "headers": []}
+    asyncio.get_event_loop().run_until_complete(response(scope, receive, send))
+    return b"".join(body)
+
+
+def test_cached(client, tmpdir, monkeypatch):
+    from gen3.objects.drivers import cached
+    from gen3.objects.drivers.fs import FileSystemBucket
+
+    upstream_dir = os.path.join(tmpdir, "upstream")
+    cache_dir = os.path.join(tmpdir, "cache")
+    os.makedirs(upstream_dir)
+    data = {}
+    for name in ("a", "b", "c"):
+        data[name] = os.urandom(100)
+        with open(os.path.join(upstream_dir, name), "wb") as f:
+            f.write(data[name])
+
+    reads = []
+    read_range = FileSystemBucket.read_range
+
+    async def counted_read_range(self, path, offset=0, length=None):
+        reads.append(path)
+        await asyncio.sleep(0.01)
+        async for chunk in read_range(self, path, offset, length):
+            yield chunk
+
+    monkeypatch.setattr(FileSystemBucket, "read_range", counted_read_range)
+    settings = dict(
+        upstream=dict(driver="fs", settings=dict(root_dir=upstream_dir)),
+        cache_dir=cache_dir,
+        max_bytes=250,
+    )
+    bucket = cached.CachedBucket(name="tBcached", driver="cached", settings=settings)
+    loop = asyncio.get_event_loop()
+
+    def download(path, headers=None):
+        return loop.run_until_complete(bucket.download(path, headers))
+
+    def settle():
+        # let fetches running in the background finish
+        fetches = list(cached._caches[cache_dir]._fetches.values())
+        if fetches:
+            loop.run_until_complete(asyncio.wait(fetches))
+
+    # a miss is read from upstream as it's cached, a hit doesn't read upstream
+    assert _response_body(download("a")) == data["a"]
+    settle()
+    assert _response_body(download("a")) == data["a"]
+    assert reads == ["a"]
+
+    # conditional and ranged misses don't wait for the object to be cached
+    etag = download("b").headers["etag"]
+    assert download("b", {"if-none-match": etag}).status_code == 304
+    assert reads == ["a"]
+    response = download("b", {"range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert _response_body(response) == data["b"][10:20]
+    settle()
+    assert reads == ["a", "b", "b"]
+    assert _response_body(download("b")) == data["b"]
+    assert reads == ["a", "b", "b"]
+
+    # "a" is the least recently used, and an open "b" survives its eviction
+    response = download("b")
+    assert _response_body(download("c")) == data["c"]
+    settle()
+    cache = cached._caches[cache_dir]
+    assert bucket._name("a") not in cache._entries
+    assert cache.total == 200
+    assert _response_body(download("a")) == data["a"]
+    settle()
+    assert bucket._name("b") not in cache._entries
+    assert _response_body(response) == data["b"]
+    assert reads == ["a", "b", "b", "c", "a"]
+
+    # a restarted worker takes over the objects cached before
+    cache.close()
+    del cached._caches[cache_dir]
+    assert _response_body(download("c")) == data["c"]
+    assert _response_body(download("a")) == data["a"]
+    assert reads == ["a", "b", "b", "c", "a"]
+    assert cached._caches[cache_dir].slot_dir == cache.slot_dir
+    cached._caches.pop(cache_dir).close()
+
+
+def test_mime(client, tmpdir, monkeypatch):
+    from gen3.objects import mime
+    from gen3.objects.cache import TTLCache
+
+    path = os.path.join(tmpdir, "a.csv")
+    with open(path, "wb") as f:
+        f.write(b"a,b\n1,2\n")
+    assert mime.read_head(path) == b"a,b\n1,2\n"
+    assert mime.read_head(path, 3) == b"a,b"
+    assert mime.read_head(os.path.join(tmpdir, "missing")) is None
+
+    assert mime.preview(None) is None
+    assert mime.preview(b"\xff\xfe\xfd") is None
+    # a character cut at the end of the head is left out
+    assert mime.preview("hé".encode()[:-1]) == "h"
+    assert len(mime.preview(b"x" * 10000)) == mime.PREVIEW_SIZE
+
+    # libmagic, if there, runs in the processes started with the app
+    assert mime.guess_type(path)[0] == "text/csv"
+    loop = asyncio.get_event_loop()
+    assert loop.run_until_complete(mime.detect_type(path, None))[0] == "text/csv"
+
+    calls = []
+
+    def guess_type(path, data):
+        calls.append(path)
+        return "text/x-test", "test"
+
+    monkeypatch.setattr(mime, "_executor", None)
+    monkeypatch.setattr(mime, "guess_type", guess_type)
+    monkeypatch.setattr(mime, "_cache", TTLCache(maxsize=2))
+
+    def detect(key):
+        return loop.run_until_complete(mime.detect_type(path, None, key))
+
+    # results are cached by the version of the object, least recently used out
+    assert detect(("a.csv", 1)) == ("text/x-test", "test")
+    assert detect(("a.csv", 1)) == ("text/x-test", "test")
+    assert len(calls) == 1
+    detect(("a.csv", 2))
+    assert len(calls) == 2
+    detect(("a.csv", 1))
+    detect(("b.csv", 1))
+    assert len(calls) == 3
+    detect(("a.csv", 1))
+    assert len(calls) == 3
+    detect(("a.csv", 2))
+    assert len(calls) == 4
+    detect(None)
+    detect(None)
+    assert len(calls) == 6
+
+    # without libmagic, by the extension only
+    monkeypatch.undo()
+    monkeypatch.setattr(mime, "magic", None)
+    assert mime.guess_type(path) == ("text/csv", "text/csv")
+    assert mime.guess_type(os.path.join(tmpdir, "noext")) == ("unknown", "unknown")
+
+
+def test_lease(client):
+    from gen3.objects import lease
+    from gen3.server.app import app
+
+    loop = asyncio.get_event_loop()
+    pool = loop.run_until_complete(app.pool)
+    name = f"test-{uuid.uuid4().hex}"
+
+    def take(ttl):
+        return loop.run_until_complete(lease.take(pool, name, ttl))
+
+    # only one of the workers sharing the database runs each time
+    assert take(60)
+    assert not take(60)
+    assert not take(0)
+
+    other = f"test-{uuid.uuid4().hex}"
+    assert loop.run_until_complete(lease.take(pool, other, 0))
+    # an expired lease is taken again
+    assert loop.run_until_complete(lease.take(pool, other, 60))